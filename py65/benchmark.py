@@ -0,0 +1,149 @@
+#!/usr/bin/env python -u
+
+"""py65bench -- measure the speed and size of the simulated MPUs
+
+Usage: %s [options]
+
+Options:
+-h, --help                 : Show this message
+-m, --mpu <device>         : Only measure this MPU device (default is all)
+-n, --instructions <count> : Instructions to execute per run (default 200000)
+-r, --repeat <count>       : Runs per measurement, best is kept (default 3)
+
+Each MPU runs a small loop of loads, stores, arithmetic and branches, once
+as the slotted class and once as an otherwise identical class that keeps
+its registers in an instance __dict__, and the time per instruction and
+the size of one instance are reported for both.
+"""
+
+import os
+import sys
+
+sys.path.append(os.getcwd())
+
+import getopt
+import time
+
+from devices.mpu6502 import MPU as NMOS6502
+from devices.mpu65c02 import MPU as CMOS65C02
+from devices.mpu65org16 import MPU as V65Org16
+from devices.mpuM65C02A import MPU as M65C02A
+
+Microprocessors = {'6502': NMOS6502, '65C02': CMOS65C02,
+                   '65Org16': V65Org16, 'M65C02A': M65C02A}
+
+# $0200 LDX #$00
+# $0202 LDY #$00
+# $0204 LDA $10
+# $0206 CLC
+# $0207 ADC #$01
+# $0209 STA $10
+# $020B DEY
+# $020C BNE $0204
+# $020E DEX
+# $020F BNE $0204
+# $0211 JMP $0200
+PROGRAM = (0xA2, 0x00, 0xA0, 0x00, 0xA5, 0x10, 0x18, 0x69, 0x01, 0x85, 0x10,
+           0x88, 0xD0, 0xF6, 0xCA, 0xD0, 0xF3, 0x4C, 0x00, 0x02)
+
+
+def unslotted(klass):
+    """ Return a copy of an MPU class whose instances keep their registers
+    in a __dict__, for comparison with the slotted original.
+    """
+    namespace = {}
+    for base in reversed(klass.__mro__[:-1]):
+        for name, value in vars(base).items():
+            if name in ('__slots__', '__dict__', '__weakref__'):
+                continue
+            if name in getattr(base, '__slots__', ()):
+                continue
+            namespace[name] = value
+    return type(klass.__name__, (object,), namespace)
+
+
+def instance_size(mpu):
+    size = sys.getsizeof(mpu)
+    if hasattr(mpu, '__dict__'):
+        size += sys.getsizeof(mpu.__dict__)
+    return size
+
+
+def make_mpu(klass):
+    if klass.ADDR_WIDTH > 16:
+        memory = 0x40000 * [0x00]
+    else:
+        memory = 0x10000 * [0x00]
+    mpu = klass(memory=memory, pc=0x0200)
+    mpu.memory[0x0200:0x0200 + len(PROGRAM)] = PROGRAM
+    mpu.pc = 0x0200
+    return mpu
+
+
+def measure(klass, instructions, repeat):
+    """ Return the best time per instruction, in seconds, over repeat runs.
+    """
+    # warm up, so that lazily built tables are not timed
+    make_mpu(klass).run(max_instructions=2000)
+
+    best = None
+    for _ in range(repeat):
+        mpu = make_mpu(klass)
+        start = time.perf_counter()
+        mpu.run(max_instructions=instructions)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best / instructions
+
+
+def usage():
+    print(__doc__ % sys.argv[0])
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+
+    shortopts = 'hm:n:r:'
+    longopts = ['help', 'mpu=', 'instructions=', 'repeat=']
+    try:
+        options, args = getopt.getopt(args, shortopts, longopts)
+    except getopt.GetoptError as exc:
+        print(exc.args[0])
+        usage()
+        return 1
+
+    names = sorted(Microprocessors.keys())
+    instructions = 200000
+    repeat = 3
+    for name, value in options:
+        if name in ('-h', '--help'):
+            usage()
+            return 0
+        if name in ('-m', '--mpu'):
+            if value not in Microprocessors:
+                print("Available MPUs: %s" % ', '.join(names))
+                return 1
+            names = [value]
+        if name in ('-n', '--instructions'):
+            instructions = int(value)
+        if name in ('-r', '--repeat'):
+            repeat = int(value)
+
+    print("%-8s %14s %14s %7s %10s %10s" % ('MPU', 'slots us/inst',
+                                            'dict us/inst', 'gain',
+                                            'slots size', 'dict size'))
+    for name in names:
+        klass = Microprocessors[name]
+        plain = unslotted(klass)
+        slotted_time = measure(klass, instructions, repeat)
+        plain_time = measure(plain, instructions, repeat)
+        gain = (plain_time - slotted_time) / plain_time * 100
+        print("%-8s %14.3f %14.3f %6.1f%% %10d %10d" % (
+            name, slotted_time * 1e6, plain_time * 1e6, gain,
+            instance_size(make_mpu(klass)), instance_size(make_mpu(plain))))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,199 @@
+"""Record the bus cycles of an M65C02A in compact binary form.
+
+The dbgD trace of the M65C02A formats and prints every bus cycle twice,
+which slows a run down by orders of magnitude.  A BusTrace instead
+keeps (cycle, kind, address, data, pc) records in preallocated arrays
+and writes them to a file a chunk at a time:
+
+    trace = BusTrace('boot.bus')
+    mpu.enable_bus_trace(trace)
+    mpu.run(stop_pcs=[0xF000])
+    mpu.disable_bus_trace()
+    trace.close()
+
+Without a path, the arrays are a ring that keeps the latest records.
+The decoder renders a file in the text format of the dbgD trace, so
+the tracing can be done at full speed and the reading left for later:
+
+    py65bustrace boot.bus > trace.txt
+
+A file is the magic bytes followed by chunks, each a little-endian
+32-bit record count and then one column after another: cycles as
+64-bit values, kinds as bytes, addresses as 32-bit values, data as
+16-bit values and the PC of the instruction as 32-bit values.
+"""
+
+import struct
+import sys
+
+from array import array
+
+BUS_MAGIC = b'py65bus1'
+
+# kinds of bus cycle
+FETCH = 0       # opcode fetch
+PROGRAM = 1     # operand read from program memory
+READ = 2        # data memory read
+WRITE = 3       # data memory write
+DUMMY = 4       # dummy cycle, no data
+
+# the columns, with typecodes of a fixed size on every platform
+_U32 = 'I' if array('I').itemsize == 4 else 'L'
+_columns = (('cycles', 'Q'), ('kinds', 'B'), ('addresses', _U32),
+            ('data', 'H'), ('pcs', _U32))
+
+
+class BusTrace:
+    """Preallocated columns of bus cycle records.  With a path, a full
+    set of columns is written to the file and refilled; without one,
+    the oldest records are overwritten.  pc is the address of the
+    instruction the cycles belong to, set at each opcode fetch.
+    """
+
+    def __init__(self, path=None, size=65536):
+        self.path = path
+        self.size = size
+        self.pc = 0
+        self.count = 0                  # records written, including flushed
+        self._next = 0
+        self._wrapped = False
+        for name, typecode in _columns:
+            empty = bytes(array(typecode).itemsize * size)
+            setattr(self, name, array(typecode, empty))
+        if path is None:
+            self._file = None
+        else:
+            self._file = open(path, 'wb')
+            self._file.write(BUS_MAGIC)
+
+    def record(self, cycle, kind, address, data):
+        n = self._next
+        self.cycles[n] = cycle
+        self.kinds[n] = kind
+        self.addresses[n] = address
+        self.data[n] = data
+        self.pcs[n] = self.pc
+        self.count += 1
+        n += 1
+        if n == self.size:
+            if self._file is None:
+                self._wrapped = True
+            else:
+                self._write(n)
+            n = 0
+        self._next = n
+
+    def records(self):
+        """ Return the records held in memory, oldest first, as a list of
+        (cycle, kind, address, data, pc) tuples.
+        """
+        n = self._next
+        if self._wrapped:
+            order = list(range(n, self.size)) + list(range(n))
+        else:
+            order = range(n)
+        return [(self.cycles[i], self.kinds[i], self.addresses[i],
+                 self.data[i], self.pcs[i]) for i in order]
+
+    def flush(self):
+        if self._file is not None and self._next:
+            self._write(self._next)
+            self._next = 0
+        if self._file is not None:
+            self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self.flush()
+            self._file.close()
+            self._file = None
+
+    def _write(self, n):
+        f = self._file
+        f.write(struct.pack('<I', n))
+        for name, typecode in _columns:
+            chunk = getattr(self, name)[:n]
+            if sys.byteorder != 'little':
+                chunk.byteswap()
+            f.write(chunk.tobytes())
+
+
+# Decoding
+
+def read_records(path):
+    """ Yield the (cycle, kind, address, data, pc) records of a file.
+    """
+    f = open(path, 'rb')
+    try:
+        if f.read(len(BUS_MAGIC)) != BUS_MAGIC:
+            raise ValueError("%s is not a bus trace" % path)
+        while True:
+            header = f.read(4)
+            if len(header) < 4:
+                break
+            n, = struct.unpack('<I', header)
+            columns = []
+            for name, typecode in _columns:
+                column = array(typecode)
+                column.frombytes(f.read(n * column.itemsize))
+                if sys.byteorder != 'little':
+                    column.byteswap()
+                columns.append(column)
+            for record in zip(*columns):
+                yield record
+    finally:
+        f.close()
+
+
+def format_record(record):
+    """ Return a record as a line of the dbgD trace.  The registers that
+    the trace prints after each opcode fetch are not recorded, so an
+    opcode fetch is shown on a line of its own.
+    """
+    cycle, kind, address, data, pc = record
+    if kind == FETCH:
+        return '   IR: %02X <= mem[%04X] ' % (data, address)
+    if kind == PROGRAM:
+        return ' rdPM: %02X <= mem[%04X]' % (data, address)
+    if kind == READ:
+        return ' rdDM: %02X <= mem[%04X]' % (data, address)
+    if kind == WRITE:
+        return ' wrDM: %02X => mem[%04X]' % (data, address)
+    return ' rwDM: -- <> mem[%04X]' % address
+
+
+def decode(path, out, cycles=False):
+    """ Write the records of a file to out in the dbgD text format, with
+    each line prefixed by its cycle number if cycles is true.
+    """
+    for record in read_records(path):
+        line = format_record(record)
+        if cycles:
+            line = '%10d %s' % (record[0], line)
+        out.write(line + '\n')
+
+
+def main(args=None):
+    import getopt
+    if args is None:
+        args = sys.argv[1:]
+    usage = "Usage: py65bustrace [-c] <file>\n"
+    try:
+        options, args = getopt.getopt(args, 'c')
+    except getopt.GetoptError:
+        sys.stderr.write(usage)
+        return 1
+    if len(args) != 1:
+        sys.stderr.write(usage)
+        return 1
+    cycles = ('-c', '') in options
+    try:
+        decode(args[0], sys.stdout, cycles)
+    except (IOError, ValueError) as exc:
+        sys.stderr.write("%s\n" % exc)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,5 +1,11 @@
+from memory import ObservableMemory
+from profiler import AddressProfile, CallProfile, OpcodeProfile
+from utils.alu import adc_table, sbc_table
 from utils.conversions import itoa
-from utils.devices import make_instruction_decorator
+from utils.devices import make_instruction_decorator, make_variant_class
+from utils.flags import compare_table, nz_table
+from utils.snapshot import (clone_mpu, read_state_file, restore_snapshot,
+                            take_snapshot, write_state_file)
 
 
 class MPU:
@@ -23,6 +29,19 @@ class MPU:
     ADDR_WIDTH = 16
     ADDR_FORMAT = "%04x"
 
+    # set by the variants, see _select_variant(); an INSTRUMENTED variant
+    # runs one step() at a time
+    FUNCTIONAL = False
+    INSTRUMENTED = False
+
+    # register file: subclasses add their own names to __slots__
+    __slots__ = ('name', 'byteMask', 'addrMask', 'addrHighMask', 'spBase',
+                 'nzFlags', 'cmpFlags',
+                 'pc', 'sp', 'a', 'x', 'y', 'p',
+                 'excycles', 'addcycles', 'processorCycles', 'waiting',
+                 'memory', 'start_pc', '_decoded', '_translator',
+                 '_opcode_profile', '_address_profile', '_call_profile')
+
     def __init__(self, memory=None, pc=0x0000):
         # config
         self.name = '6502'
@@ -30,11 +49,19 @@ class MPU:
         self.addrMask = ((1 << self.ADDR_WIDTH) - 1)
         self.addrHighMask = (self.byteMask << self.BYTE_WIDTH)
         self.spBase = 1 << self.BYTE_WIDTH
+        self._init_flag_tables()
 
         # vm status
         self.excycles = 0
         self.addcycles = False
         self.processorCycles = 0
+        # only the CMOS derivatives can be parked by WAI
+        self.waiting = False
+        self._decoded = None
+        self._translator = None
+        self._opcode_profile = None
+        self._address_profile = None
+        self._call_profile = None
 
         if memory is None:
             memory = 0x10000 * [0x00]
@@ -65,6 +92,259 @@ class MPU:
         self.processorCycles += self.cycletime[instructCode] + self.excycles
         return self
 
+    def run(self, max_cycles=None, max_instructions=None,
+            stop_pcs=(), stop_opcodes=()):
+        """ Execute instructions until a stop condition is met.  Budgets
+        are checked before each instruction; stop_pcs and stop_opcodes are
+        checked after each instruction against the new PC, so a run always
+        makes progress.  Returns a tuple of (reason, cycles, instructions)
+        where reason is one of 'cycles', 'instructions', 'opcode', 'pc',
+        or 'waiting' (a parked core with no cycle budget to burn).
+        """
+        if self._translator is not None:
+            return self._translator.run(max_cycles, max_instructions,
+                                        stop_pcs, stop_opcodes)
+
+        memory = self.memory
+        instruct = self.instruct
+        cycletime = self.cycletime
+        extracycles = self.extracycles
+        addrMask = self.addrMask
+        decoded = self._decoded
+        if decoded is not None:
+            physMask = memory.physMask
+        stop_pcs = frozenset(stop_pcs)
+        stop_opcodes = frozenset(stop_opcodes)
+
+        start_cycles = self.processorCycles
+        if max_cycles is None:
+            cycle_limit = None
+        else:
+            cycle_limit = start_cycles + max_cycles
+        instructions = 0
+
+        while True:
+            if cycle_limit is not None and self.processorCycles >= cycle_limit:
+                reason = 'cycles'
+                break
+            if instructions == max_instructions:
+                reason = 'instructions'
+                break
+
+            if self.waiting:
+                if cycle_limit is None:
+                    reason = 'waiting'
+                    break
+                self.processorCycles += 1
+                continue
+
+            pc = self.pc
+            if decoded is None:
+                instructCode = memory[pc]
+                handler = instruct[instructCode]
+                cycles = cycletime[instructCode]
+                extra = extracycles[instructCode]
+            else:
+                entry = decoded.get(pc & physMask)
+                if entry is None:
+                    entry = self._decode(pc)
+                instructCode, handler, cycles, extra = entry
+
+            self.pc = (pc + 1) & addrMask
+            self.excycles = 0
+            self.addcycles = extra
+            handler(self)
+            self.pc &= addrMask
+            self.processorCycles += cycles + self.excycles
+            instructions += 1
+
+            if stop_opcodes:
+                if decoded is None:
+                    nextCode = memory[self.pc]
+                else:
+                    entry = decoded.get(self.pc & physMask)
+                    if entry is None:
+                        entry = self._decode(self.pc)
+                    nextCode = entry[0]
+                if nextCode in stop_opcodes:
+                    reason = 'opcode'
+                    break
+            if self.pc in stop_pcs:
+                reason = 'pc'
+                break
+
+        return reason, self.processorCycles - start_cycles, instructions
+
+    # Decode cache
+
+    def enable_decode_cache(self):
+        """ Cache the decoded opcode, handler and cycle counts for each
+        address that run() executes, so that loops skip the fetch and the
+        table lookups after their first pass.  Entries are dropped when
+        ObservableMemory sees a write to a cached opcode byte, which keeps
+        self-modifying code correct; a plain list memory is wrapped in an
+        ObservableMemory so that the MPU's own writes are seen.  Bulk loads
+        through ObservableMemory.write() bypass the subscribers, so call
+        enable_decode_cache() again after using it.
+        """
+        if not isinstance(self.memory, ObservableMemory):
+            self.memory = ObservableMemory(subject=self.memory,
+                                           addrWidth=self.ADDR_WIDTH)
+        self._decoded = {}
+
+    def disable_decode_cache(self):
+        self._decoded = None
+
+    def _decode(self, pc):
+        memory = self.memory
+        address = pc & memory.physMask
+        instructCode = memory[address]
+        entry = (instructCode,
+                 self.instruct[instructCode],
+                 self.cycletime[instructCode],
+                 self.extracycles[instructCode])
+        memory.subscribe_to_write([address], self._invalidate_decoded)
+        self._decoded[address] = entry
+        return entry
+
+    def _invalidate_decoded(self, address, value):
+        if self._decoded is not None:
+            self._decoded.pop(address, None)
+
+    # Block translation
+
+    def enable_translation(self):
+        """ Have run() execute translated basic blocks, see translator.py.
+        step() is unaffected.  As with the decode cache, bulk loads through
+        ObservableMemory.write() are not seen, so call enable_translation()
+        again after using it.
+        """
+        from translator import Translator
+        self._translator = Translator(self)
+
+    def disable_translation(self):
+        self._translator = None
+
+    # Functional mode
+
+    def enable_functional_mode(self):
+        """ Switch to a variant of this MPU's class whose step(), run() and
+        indexed addressing modes do no cycle or page-crossing bookkeeping,
+        for runs where only the results matter.  processorCycles stands
+        still, so run() takes no cycle budget.  The switch swaps the class
+        rather than testing a flag on every instruction, and can be undone
+        at any instruction boundary, such as a breakpoint, by
+        disable_functional_mode().
+        """
+        self._select_variant(True)
+
+    def disable_functional_mode(self):
+        self._select_variant(False)
+        self.excycles = 0
+
+    def _select_variant(self, functional):
+        mixins = ()
+        if self._opcode_profile is not None:
+            mixins += (OpcodeProfileMode,)
+        if self._address_profile is not None:
+            mixins += (AddressProfileMode,)
+        if self._call_profile is not None:
+            mixins += (CallProfileMode,)
+        if functional:
+            mixins += (FunctionalMode,)
+        base = getattr(type(self), 'base_class', type(self))
+        self.__class__ = make_variant_class(base, mixins)
+
+    # Profiles
+
+    def enable_opcode_profile(self, profile=None):
+        """ Count the opcodes executed from now on in profile, a new
+        profiler.OpcodeProfile by default, and return it.  run() steps
+        one instruction at a time while the profile is enabled, bypassing
+        the decode cache and translator.
+        """
+        if profile is None:
+            profile = OpcodeProfile(self)
+        self._opcode_profile = profile
+        self._select_variant(self.FUNCTIONAL)
+        return profile
+
+    def disable_opcode_profile(self):
+        self._opcode_profile = None
+        self._select_variant(self.FUNCTIONAL)
+
+    def enable_address_profile(self, profile=None):
+        """ Count the instructions executed at each address, and the cycles
+        they take, in profile, a new profiler.AddressProfile by default,
+        and return it.
+        """
+        if profile is None:
+            profile = AddressProfile(self)
+        self._address_profile = profile
+        self._select_variant(self.FUNCTIONAL)
+        return profile
+
+    def disable_address_profile(self):
+        self._address_profile = None
+        self._select_variant(self.FUNCTIONAL)
+
+    def enable_call_profile(self, profile=None):
+        """ Charge the cycles executed to the subroutines running them in
+        profile, a new profiler.CallProfile by default, and return it.
+        """
+        if profile is None:
+            profile = CallProfile(self)
+        self._call_profile = profile
+        self._select_variant(self.FUNCTIONAL)
+        return profile
+
+    def disable_call_profile(self):
+        self._call_profile = None
+        self._select_variant(self.FUNCTIONAL)
+
+    # Snapshots
+
+    def snapshot(self):
+        """ Return a snapshot of the registers, cycle counter and memory,
+        see utils/snapshot.py.
+        """
+        return take_snapshot(self)
+
+    def restore(self, snapshot):
+        restore_snapshot(self, snapshot)
+        # memory was rewritten behind the decode cache and translator
+        if self._decoded is not None:
+            self._decoded.clear()
+        if self._translator is not None:
+            self._translator.flush()
+
+    def clone(self):
+        """ Return an independent MPU in the same state, with a copy of
+        memory that keeps its ObservableMemory subscribers.
+        """
+        twin = clone_mpu(self)
+        twin._decoded = None
+        twin._translator = None
+        # profiles belong to the original
+        twin._opcode_profile = None
+        twin._address_profile = None
+        twin._call_profile = None
+        twin._select_variant(self.FUNCTIONAL)
+        if self._decoded is not None:
+            twin.enable_decode_cache()
+        if self._translator is not None:
+            twin.enable_translation()
+        return twin
+
+    def save_state(self, path, compress=False):
+        """ Save the machine state to a file that load_state() maps back
+        in, optionally compressing memory.
+        """
+        write_state_file(self, path, compress)
+
+    def load_state(self, path):
+        self.restore(read_state_file(self, path))
+
     def reset(self):
         self.pc = self.start_pc
         self.sp = self.byteMask
@@ -175,12 +455,17 @@ class MPU:
         z += self.stPop() << self.BYTE_WIDTH
         return z
 
-    def FlagsNZ(self, value):
-        self.p &= ~(self.ZERO | self.NEGATIVE)
-        if value == 0:
-            self.p |= self.ZERO
+    def _init_flag_tables(self):
+        self.nzFlags = nz_table(self.BYTE_WIDTH, self.NEGATIVE, self.ZERO)
+        if self.BYTE_WIDTH == 8:
+            self.cmpFlags = compare_table(self.BYTE_WIDTH, self.NEGATIVE,
+                                          self.ZERO, self.CARRY)
         else:
-            self.p |= value & self.NEGATIVE
+            # a register x operand table is too big for wider bytes
+            self.cmpFlags = None
+
+    def FlagsNZ(self, value):
+        self.p = (self.p & ~(self.ZERO | self.NEGATIVE)) | self.nzFlags[value]
 
     # operations
 
@@ -200,11 +485,7 @@ class MPU:
         if tbyte & self.NEGATIVE:
             self.p |= self.CARRY
         tbyte = (tbyte << 1) & self.byteMask
-
-        if tbyte:
-            self.p |= tbyte & self.NEGATIVE
-        else:
-            self.p |= self.ZERO
+        self.p |= self.nzFlags[tbyte]
 
         if x is None:
             self.a = tbyte
@@ -222,10 +503,7 @@ class MPU:
         self.p |= tbyte & 1
 
         tbyte = tbyte >> 1
-        if tbyte:
-            pass
-        else:
-            self.p |= self.ZERO
+        self.p |= self.nzFlags[tbyte]
 
         if x is None:
             self.a = tbyte
@@ -292,57 +570,11 @@ class MPU:
 
     def opADC(self, x):
         data = self.ByteAt(x())
-
-        if self.p & self.DECIMAL:
-            halfcarry = 0
-            decimalcarry = 0
-            adjust0 = 0
-            adjust1 = 0
-            nibble0 = (data & 0xf) + (self.a & 0xf) + (self.p & self.CARRY)
-            if nibble0 > 9:
-                adjust0 = 6
-                halfcarry = 1
-            nibble1 = ((data >> 4) & 0xf) + ((self.a >> 4) & 0xf) + halfcarry
-            if nibble1 > 9:
-                adjust1 = 6
-                decimalcarry = 1
-
-            # the ALU outputs are not decimally adjusted
-            nibble0 = nibble0 & 0xf
-            nibble1 = nibble1 & 0xf
-            aluresult = (nibble1 << 4) + nibble0
-
-            # the final A contents will be decimally adjusted
-            nibble0 = (nibble0 + adjust0) & 0xf
-            nibble1 = (nibble1 + adjust1) & 0xf
-            self.p &= ~(self.CARRY | self.OVERFLOW | self.NEGATIVE | self.ZERO)
-            if aluresult == 0:
-                self.p |= self.ZERO
-            else:
-                self.p |= aluresult & self.NEGATIVE
-            if decimalcarry == 1:
-                self.p |= self.CARRY
-            if (~(self.a ^ data) & (self.a ^ aluresult)) & self.NEGATIVE:
-                self.p |= self.OVERFLOW
-            self.a = (nibble1 << 4) + nibble0
-        else:
-            if self.p & self.CARRY:
-                tmp = 1
-            else:
-                tmp = 0
-            result = data + self.a + tmp
-            self.p &= ~(self.CARRY | self.OVERFLOW | self.NEGATIVE | self.ZERO)
-            if (~(self.a ^ data) & (self.a ^ result)) & self.NEGATIVE:
-                self.p |= self.OVERFLOW
-            data = result
-            if data > self.byteMask:
-                self.p |= self.CARRY
-                data &= self.byteMask
-            if data == 0:
-                self.p |= self.ZERO
-            else:
-                self.p |= data & self.NEGATIVE
-            self.a = data
+        table = adc_table(self.p & self.CARRY, self.p & self.DECIMAL)
+        entry = table[(self.a << 8) | data]
+        self.p &= ~(self.CARRY | self.OVERFLOW | self.NEGATIVE | self.ZERO)
+        self.p |= entry >> 8
+        self.a = entry & 0xff
 
     def opROR(self, x):
         if x is None:
@@ -379,64 +611,21 @@ class MPU:
 
     def opCMPR(self, get_address, register_value):
         tbyte = self.ByteAt(get_address())
-        self.p &= ~(self.CARRY | self.ZERO | self.NEGATIVE)
-        if register_value == tbyte:
-            self.p |= self.CARRY | self.ZERO
-        elif register_value > tbyte:
-            self.p |= self.CARRY
-        self.p |= (register_value - tbyte) & self.NEGATIVE
+        if self.cmpFlags is None:
+            flags = self.nzFlags[(register_value - tbyte) & self.byteMask]
+            if register_value >= tbyte:
+                flags |= self.CARRY
+        else:
+            flags = self.cmpFlags[(register_value << self.BYTE_WIDTH) | tbyte]
+        self.p = (self.p & ~(self.CARRY | self.ZERO | self.NEGATIVE)) | flags
 
     def opSBC(self, x):
         data = self.ByteAt(x())
-
-        if self.p & self.DECIMAL:
-            halfcarry = 1
-            decimalcarry = 0
-            adjust0 = 0
-            adjust1 = 0
-
-            nibble0 = (self.a & 0xf) + (~data & 0xf) + (self.p & self.CARRY)
-            if nibble0 <= 0xf:
-                halfcarry = 0
-                adjust0 = 10
-            nibble1 = ((self.a >> 4) & 0xf) + ((~data >> 4) & 0xf) + halfcarry
-            if nibble1 <= 0xf:
-                adjust1 = 10 << 4
-
-            # the ALU outputs are not decimally adjusted
-            aluresult = self.a + (~data & self.byteMask) + \
-                (self.p & self.CARRY)
-
-            if aluresult > self.byteMask:
-                decimalcarry = 1
-            aluresult &= self.byteMask
-
-            # but the final result will be adjusted
-            nibble0 = (aluresult + adjust0) & 0xf
-            nibble1 = ((aluresult + adjust1) >> 4) & 0xf
-
-            self.p &= ~(self.CARRY | self.ZERO | self.NEGATIVE | self.OVERFLOW)
-            if aluresult == 0:
-                self.p |= self.ZERO
-            else:
-                self.p |= aluresult & self.NEGATIVE
-            if decimalcarry == 1:
-                self.p |= self.CARRY
-            if ((self.a ^ data) & (self.a ^ aluresult)) & self.NEGATIVE:
-                self.p |= self.OVERFLOW
-            self.a = (nibble1 << 4) + nibble0
-        else:
-            result = self.a + (~data & self.byteMask) + (self.p & self.CARRY)
-            self.p &= ~(self.CARRY | self.ZERO | self.OVERFLOW | self.NEGATIVE)
-            if ((self.a ^ data) & (self.a ^ result)) & self.NEGATIVE:
-                self.p |= self.OVERFLOW
-            data = result & self.byteMask
-            if data == 0:
-                self.p |= self.ZERO
-            if result > self.byteMask:
-                self.p |= self.CARRY
-            self.p |= data & self.NEGATIVE
-            self.a = data
+        table = sbc_table(self.p & self.CARRY, self.p & self.DECIMAL)
+        entry = table[(self.a << 8) | data]
+        self.p &= ~(self.CARRY | self.ZERO | self.OVERFLOW | self.NEGATIVE)
+        self.p |= entry >> 8
+        self.a = entry & 0xff
 
     def opDECR(self, x):
         if x is None:
@@ -445,12 +634,8 @@ class MPU:
             addr = x()
             tbyte = self.ByteAt(addr)
 
-        self.p &= ~(self.ZERO | self.NEGATIVE)
         tbyte = (tbyte - 1) & self.byteMask
-        if tbyte:
-            self.p |= tbyte & self.NEGATIVE
-        else:
-            self.p |= self.ZERO
+        self.FlagsNZ(tbyte)
 
         if x is None:
             self.a = tbyte
@@ -464,12 +649,8 @@ class MPU:
             addr = x()
             tbyte = self.ByteAt(addr)
 
-        self.p &= ~(self.ZERO | self.NEGATIVE)
         tbyte = (tbyte + 1) & self.byteMask
-        if tbyte:
-            self.p |= tbyte & self.NEGATIVE
-        else:
-            self.p |= self.ZERO
+        self.FlagsNZ(tbyte)
 
         if x is None:
             self.a = tbyte
@@ -1241,3 +1422,184 @@ class MPU:
     def inst_0xfe(self):
         self.opINCR(self.AbsoluteXAddr)
         self.pc += 2
+
+
+class FunctionalMode:
+    """ The methods that MPU.enable_functional_mode() puts in front of those
+    of the 6502 family.  The instruction table is shared with the accurate
+    class; the handlers reach the addressing modes through self, and so
+    pick up the versions here that skip the page-crossing tests.
+    """
+    __slots__ = ()
+
+    FUNCTIONAL = True
+
+    def step(self):
+        if not self.waiting:
+            instructCode = self.memory[self.pc]
+            self.pc = (self.pc + 1) & self.addrMask
+            self.instruct[instructCode](self)
+            self.pc &= self.addrMask
+        return self
+
+    def run(self, max_cycles=None, max_instructions=None,
+            stop_pcs=(), stop_opcodes=()):
+        """ As MPU.run(), but without cycle counting, so max_cycles must be
+        None and the cycle count returned is always 0.  The decode cache
+        and translator are left alone: they exist to speed up the counting
+        that this mode drops.
+        """
+        if max_cycles is not None:
+            raise ValueError("a cycle budget needs the accurate mode")
+
+        memory = self.memory
+        instruct = self.instruct
+        addrMask = self.addrMask
+        stop_pcs = frozenset(stop_pcs)
+        stop_opcodes = frozenset(stop_opcodes)
+        instructions = 0
+
+        while True:
+            if instructions == max_instructions:
+                reason = 'instructions'
+                break
+            if self.waiting:
+                reason = 'waiting'
+                break
+
+            instructCode = memory[self.pc]
+            self.pc = (self.pc + 1) & addrMask
+            instruct[instructCode](self)
+            self.pc &= addrMask
+            instructions += 1
+
+            if stop_opcodes and memory[self.pc] in stop_opcodes:
+                reason = 'opcode'
+                break
+            if self.pc in stop_pcs:
+                reason = 'pc'
+                break
+
+        return reason, 0, instructions
+
+    # Addressing modes
+
+    def IndirectYAddr(self):
+        return (self.WrapAt(self.ByteAt(self.pc)) + self.y) & self.addrMask
+
+    def AbsoluteXAddr(self):
+        return (self.WordAt(self.pc) + self.x) & self.addrMask
+
+    def AbsoluteYAddr(self):
+        return (self.WordAt(self.pc) + self.y) & self.addrMask
+
+    def BranchRelAddr(self):
+        addr = self.ImmediateByte()
+        self.pc += 1
+
+        if addr & self.NEGATIVE:
+            addr = self.pc - (addr ^ self.byteMask) - 1
+        else:
+            addr = self.pc + addr
+
+        self.pc = addr & self.addrMask
+
+
+class Instrumented:
+    """ The base of the variants that watch every instruction.  run()
+    goes through step(), so that the variant's step() sees each one.
+    """
+    __slots__ = ()
+
+    INSTRUMENTED = True
+
+    def run(self, max_cycles=None, max_instructions=None,
+            stop_pcs=(), stop_opcodes=()):
+        if max_cycles is not None and self.FUNCTIONAL:
+            raise ValueError("a cycle budget needs the accurate mode")
+
+        memory = self.memory
+        stop_pcs = frozenset(stop_pcs)
+        stop_opcodes = frozenset(stop_opcodes)
+
+        start_cycles = self.processorCycles
+        if max_cycles is None:
+            cycle_limit = None
+        else:
+            cycle_limit = start_cycles + max_cycles
+        instructions = 0
+
+        while True:
+            if cycle_limit is not None and self.processorCycles >= cycle_limit:
+                reason = 'cycles'
+                break
+            if instructions == max_instructions:
+                reason = 'instructions'
+                break
+
+            if self.waiting:
+                if cycle_limit is None:
+                    reason = 'waiting'
+                    break
+                self.step()
+                continue
+
+            self.step()
+            instructions += 1
+
+            if stop_opcodes and memory[self.pc] in stop_opcodes:
+                reason = 'opcode'
+                break
+            if self.pc in stop_pcs:
+                reason = 'pc'
+                break
+
+        return reason, self.processorCycles - start_cycles, instructions
+
+
+class OpcodeProfileMode(Instrumented):
+    """ Counts each opcode in the enabled profiler.OpcodeProfile before
+    deferring to the next class.
+    """
+    __slots__ = ()
+
+    def step(self):
+        if not self.waiting:
+            self._opcode_profile.counts[self.memory[self.pc]] += 1
+        return super().step()
+
+
+class AddressProfileMode(Instrumented):
+    """ Adds each instruction, and the cycles it took, to the enabled
+    profiler.AddressProfile at the address of its opcode.
+    """
+    __slots__ = ()
+
+    def step(self):
+        if self.waiting:
+            return super().step()
+        pc = self.pc
+        cycles = self.processorCycles
+        super().step()
+        profile = self._address_profile
+        profile.counts[pc] += 1
+        profile.cycles[pc] += self.processorCycles - cycles
+        return self
+
+
+class CallProfileMode(Instrumented):
+    """ Passes each instruction to the enabled profiler.CallProfile, which
+    follows the calls and returns.
+    """
+    __slots__ = ()
+
+    def step(self):
+        if self.waiting:
+            return super().step()
+        pc = self.pc
+        opcode = self.memory[pc]
+        cycles = self.processorCycles
+        super().step()
+        self._call_profile.executed(pc, opcode, cycles,
+                                    self.processorCycles, self.pc)
+        return self
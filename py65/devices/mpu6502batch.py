@@ -0,0 +1,491 @@
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from devices import mpu6502
+from utils.alu import adc_table, sbc_table
+from utils.flags import compare_table, nz_table
+
+# operand bytes that follow the opcode, by addressing mode
+_lengths = {'imp': 0, 'acc': 0, 'imm': 1, 'zpg': 1, 'zpx': 1, 'zpy': 1,
+            'inx': 1, 'iny': 1, 'rel': 1, 'abs': 2, 'abx': 2, 'aby': 2,
+            'ind': 2}
+
+_tables = {}
+
+
+def _numpy_tables():
+    """ Return the flag and ALU tables as NumPy arrays, built on first use.
+    The ALU tables are indexed by [carry | decimal << 1, (A << 8) | operand].
+    """
+    if not _tables:
+        N, Z, C = mpu6502.MPU.NEGATIVE, mpu6502.MPU.ZERO, mpu6502.MPU.CARRY
+        _tables['nz'] = numpy.array(nz_table(8, N, Z), dtype=numpy.int64)
+        _tables['cmp'] = numpy.array(compare_table(8, N, Z, C),
+                                     dtype=numpy.int64)
+        for name, function in (('adc', adc_table), ('sbc', sbc_table)):
+            _tables[name] = numpy.array(
+                [numpy.frombuffer(function(carry, decimal), numpy.uint16)
+                 for decimal in (0, 1) for carry in (0, 1)],
+                dtype=numpy.int64)
+    return _tables
+
+
+class BatchMPU:
+    """Run N independent 6502s in lockstep.  Each lane has its own
+    registers and its own 64K of RAM, held together in NumPy arrays:
+    memory is an (N, 65536) uint8 array and pc, a, x, y, sp, p and
+    processorCycles are length N arrays.  Every step executes one
+    instruction on each running lane; lanes that fetch the same opcode
+    are executed together, so a step costs a few array operations per
+    distinct opcode rather than one interpreter dispatch per lane.
+
+    The lanes behave exactly like mpu6502.MPU instances running the same
+    programs, cycle counts included.  Memory is plain RAM, there are no
+    ObservableMemory devices.  NumPy is required.
+    """
+
+    MPU = mpu6502.MPU
+
+    NEGATIVE = MPU.NEGATIVE
+    OVERFLOW = MPU.OVERFLOW
+    UNUSED = MPU.UNUSED
+    BREAK = MPU.BREAK
+    DECIMAL = MPU.DECIMAL
+    INTERRUPT = MPU.INTERRUPT
+    ZERO = MPU.ZERO
+    CARRY = MPU.CARRY
+
+    def __init__(self, lanes, memory=None, pc=0x0000):
+        """ memory may be a single 64K image, copied into every lane, or
+        one image per lane.
+        """
+        if numpy is None:
+            raise RuntimeError("BatchMPU requires NumPy")
+        self.lanes = lanes
+        self.memory = numpy.zeros((lanes, 0x10000), dtype=numpy.uint8)
+        if memory is not None:
+            self.memory[:] = numpy.asarray(memory, dtype=numpy.uint8)
+        self.start_pc = pc
+
+        tables = _numpy_tables()
+        self._nzFlags = tables['nz']
+        self._cmpFlags = tables['cmp']
+        self._adc = tables['adc']
+        self._sbc = tables['sbc']
+
+        self._dispatch = []
+        for name, mode in self.MPU.disassemble:
+            if name == '???':
+                name = 'not_implemented'
+            self._dispatch.append((getattr(self, '_op_' + name),
+                                   mode, _lengths[mode]))
+
+        self.reset()
+
+    def reset(self):
+        lanes = self.lanes
+        int64 = numpy.int64
+        self.pc = numpy.full(lanes, self.start_pc, dtype=int64)
+        self.sp = numpy.full(lanes, 0xff, dtype=int64)
+        self.a = numpy.zeros(lanes, dtype=int64)
+        self.x = numpy.zeros(lanes, dtype=int64)
+        self.y = numpy.zeros(lanes, dtype=int64)
+        self.p = numpy.full(lanes, self.BREAK | self.UNUSED, dtype=int64)
+        self.processorCycles = numpy.zeros(lanes, dtype=int64)
+
+    # Moving state to and from mpu6502.MPU
+
+    def load(self, mpu, index=None):
+        """ Copy the registers, cycle count and memory of an mpu6502.MPU
+        into the given lanes (all of them by default).
+        """
+        if index is None:
+            index = slice(None)
+        self.memory[index] = numpy.asarray(mpu.memory[:0x10000],
+                                           dtype=numpy.uint8)
+        self.pc[index] = mpu.pc
+        self.sp[index] = mpu.sp
+        self.a[index] = mpu.a
+        self.x[index] = mpu.x
+        self.y[index] = mpu.y
+        self.p[index] = mpu.p
+        self.processorCycles[index] = mpu.processorCycles
+
+    def lane(self, index):
+        """ Return an mpu6502.MPU holding a copy of one lane's state.
+        """
+        mpu = self.MPU(memory=self.memory[index].tolist(),
+                       pc=int(self.pc[index]))
+        mpu.sp = int(self.sp[index])
+        mpu.a = int(self.a[index])
+        mpu.x = int(self.x[index])
+        mpu.y = int(self.y[index])
+        mpu.p = int(self.p[index])
+        mpu.processorCycles = int(self.processorCycles[index])
+        return mpu
+
+    # Execution
+
+    def step(self, lanes=None):
+        """ Execute one instruction on the given lanes, an array of lane
+        numbers (all of them by default).
+        """
+        if lanes is None:
+            lanes = numpy.arange(self.lanes)
+        else:
+            lanes = numpy.asarray(lanes, dtype=numpy.int64)
+        opcodes = self.memory[lanes, self.pc[lanes]]
+        if len(opcodes) and (opcodes == opcodes[0]).all():
+            self._execute(int(opcodes[0]), lanes)
+        else:
+            for opcode in numpy.unique(opcodes):
+                self._execute(int(opcode), lanes[opcodes == opcode])
+        return self
+
+    def run(self, max_cycles=None, max_instructions=None,
+            stop_pcs=(), stop_opcodes=()):
+        """ Run every lane until it meets a stop condition, with the same
+        meaning as mpu6502.MPU.run().  A lane that stops is masked off
+        while the others carry on.  Returns a tuple of (reasons, cycles,
+        instructions): a list of reason strings and two arrays, one entry
+        per lane.
+        """
+        stop_pcs = numpy.array(sorted(set(stop_pcs)), dtype=numpy.int64)
+        stop_opcodes = numpy.array(sorted(set(stop_opcodes)),
+                                   dtype=numpy.int64)
+
+        reasons = [None] * self.lanes
+        running = numpy.arange(self.lanes)
+        start_cycles = self.processorCycles.copy()
+        instructions = numpy.zeros(self.lanes, dtype=numpy.int64)
+        executed = 0
+
+        while len(running):
+            if max_cycles is not None:
+                spent = self.processorCycles[running] - start_cycles[running]
+                done = spent >= max_cycles
+                running = self._halt(running, done, 'cycles', reasons)
+            if executed == max_instructions:
+                running = self._halt(running, True, 'instructions', reasons)
+            if not len(running):
+                break
+
+            self.step(running)
+            instructions[running] += 1
+            executed += 1
+
+            if len(stop_opcodes):
+                opcodes = self.memory[running, self.pc[running]]
+                done = numpy.isin(opcodes, stop_opcodes)
+                running = self._halt(running, done, 'opcode', reasons)
+            if len(stop_pcs):
+                done = numpy.isin(self.pc[running], stop_pcs)
+                running = self._halt(running, done, 'pc', reasons)
+
+        return reasons, self.processorCycles - start_cycles, instructions
+
+    def _halt(self, running, done, reason, reasons):
+        done = numpy.broadcast_to(done, running.shape)
+        for lane in running[done]:
+            reasons[lane] = reason
+        return running[~done]
+
+    def _execute(self, opcode, lanes):
+        function, mode, length = self._dispatch[opcode]
+        pc = (self.pc[lanes] + 1) & 0xffff
+        excycles = numpy.zeros(len(lanes), dtype=numpy.int64)
+        addcycles = self.MPU.extracycles[opcode]
+        new_pc = function(lanes, pc, mode, excycles, addcycles)
+        if new_pc is None:
+            new_pc = pc + length
+        self.pc[lanes] = new_pc & 0xffff
+        self.processorCycles[lanes] += self.MPU.cycletime[opcode] + excycles
+
+    # Helpers for addressing modes
+
+    def _byte(self, lanes, addr):
+        return self.memory[lanes, addr].astype(numpy.int64)
+
+    def _word(self, lanes, addr):
+        return (self._byte(lanes, addr) +
+                (self._byte(lanes, (addr + 1) & 0xffff) << 8))
+
+    def _wrap(self, lanes, addr):
+        high = (addr & 0xff00) + ((addr + 1) & 0xff)
+        return self._byte(lanes, addr) + (self._byte(lanes, high) << 8)
+
+    def _address(self, lanes, pc, mode, excycles, addcycles):
+        if mode == 'zpg':
+            return self._byte(lanes, pc)
+        if mode == 'zpx':
+            return (self._byte(lanes, pc) + self.x[lanes]) & 0xff
+        if mode == 'zpy':
+            return (self._byte(lanes, pc) + self.y[lanes]) & 0xff
+        if mode == 'abs':
+            return self._word(lanes, pc)
+        if mode == 'inx':
+            return self._wrap(lanes, (self._byte(lanes, pc) +
+                                      self.x[lanes]) & 0xff)
+        if mode == 'abx':
+            base, index = self._word(lanes, pc), self.x[lanes]
+        elif mode == 'aby':
+            base, index = self._word(lanes, pc), self.y[lanes]
+        elif mode == 'iny':
+            base, index = self._wrap(lanes, self._byte(lanes, pc)), \
+                          self.y[lanes]
+        else:
+            raise ValueError("no operand address for mode %s" % mode)
+        addr = (base + index) & 0xffff
+        if addcycles:
+            excycles += (base & 0xff00) != (addr & 0xff00)
+        return addr
+
+    def _operand(self, lanes, pc, mode, excycles, addcycles):
+        if mode == 'imm':
+            return self._byte(lanes, pc)
+        return self._byte(lanes, self._address(lanes, pc, mode,
+                                               excycles, addcycles))
+
+    def _push(self, lanes, value):
+        sp = self.sp[lanes]
+        self.memory[lanes, 0x100 + sp] = value & 0xff
+        self.sp[lanes] = (sp - 1) & 0xff
+
+    def _pop(self, lanes):
+        sp = (self.sp[lanes] + 1) & 0xff
+        self.sp[lanes] = sp
+        return self._byte(lanes, 0x100 + sp)
+
+    def _pushWord(self, lanes, value):
+        self._push(lanes, value >> 8)
+        self._push(lanes, value)
+
+    def _popWord(self, lanes):
+        low = self._pop(lanes)
+        return low + (self._pop(lanes) << 8)
+
+    def _flagsNZ(self, lanes, value):
+        self.p[lanes] = ((self.p[lanes] & ~(self.ZERO | self.NEGATIVE)) |
+                         self._nzFlags[value])
+
+    # operations
+    #
+    # Each takes (lanes, pc, mode, excycles, addcycles), where pc is the
+    # address after the opcode, and returns the new PC, or None to step
+    # over the operand bytes.
+
+    def _op_not_implemented(self, lanes, pc, mode, excycles, addcycles):
+        return pc + 1
+
+    def _op_NOP(self, lanes, pc, mode, excycles, addcycles):
+        pass
+
+    def _load(name):
+        def op(self, lanes, pc, mode, excycles, addcycles):
+            value = self._operand(lanes, pc, mode, excycles, addcycles)
+            getattr(self, name)[lanes] = value
+            self._flagsNZ(lanes, value)
+        return op
+
+    _op_LDA = _load('a')
+    _op_LDX = _load('x')
+    _op_LDY = _load('y')
+
+    def _store(name):
+        def op(self, lanes, pc, mode, excycles, addcycles):
+            addr = self._address(lanes, pc, mode, excycles, addcycles)
+            self.memory[lanes, addr] = getattr(self, name)[lanes]
+        return op
+
+    _op_STA = _store('a')
+    _op_STX = _store('x')
+    _op_STY = _store('y')
+
+    def _logical(function):
+        def op(self, lanes, pc, mode, excycles, addcycles):
+            value = self._operand(lanes, pc, mode, excycles, addcycles)
+            value = function(self.a[lanes], value)
+            self.a[lanes] = value
+            self._flagsNZ(lanes, value)
+        return op
+
+    _op_ORA = _logical(lambda a, value: a | value)
+    _op_AND = _logical(lambda a, value: a & value)
+    _op_EOR = _logical(lambda a, value: a ^ value)
+
+    def _arithmetic(name):
+        def op(self, lanes, pc, mode, excycles, addcycles):
+            value = self._operand(lanes, pc, mode, excycles, addcycles)
+            p = self.p[lanes]
+            table = (p & self.CARRY) | ((p & self.DECIMAL) >> 2)
+            entry = getattr(self, name)[table, (self.a[lanes] << 8) | value]
+            mask = self.CARRY | self.OVERFLOW | self.NEGATIVE | self.ZERO
+            self.p[lanes] = (p & ~mask) | (entry >> 8)
+            self.a[lanes] = entry & 0xff
+        return op
+
+    _op_ADC = _arithmetic('_adc')
+    _op_SBC = _arithmetic('_sbc')
+
+    def _compare(name):
+        def op(self, lanes, pc, mode, excycles, addcycles):
+            value = self._operand(lanes, pc, mode, excycles, addcycles)
+            flags = self._cmpFlags[(getattr(self, name)[lanes] << 8) | value]
+            mask = self.CARRY | self.ZERO | self.NEGATIVE
+            self.p[lanes] = (self.p[lanes] & ~mask) | flags
+        return op
+
+    _op_CMP = _compare('a')
+    _op_CPX = _compare('x')
+    _op_CPY = _compare('y')
+
+    def _op_BIT(self, lanes, pc, mode, excycles, addcycles):
+        value = self._operand(lanes, pc, mode, excycles, addcycles)
+        p = self.p[lanes] & ~(self.ZERO | self.NEGATIVE | self.OVERFLOW)
+        p |= numpy.where((self.a[lanes] & value) == 0, self.ZERO, 0)
+        self.p[lanes] = p | (value & (self.NEGATIVE | self.OVERFLOW))
+
+    def _modify(function):
+        # function(value, carry in) -> (result, carry out)
+        def op(self, lanes, pc, mode, excycles, addcycles):
+            if mode == 'acc':
+                value = self.a[lanes]
+            else:
+                addr = self._address(lanes, pc, mode, excycles, addcycles)
+                value = self._byte(lanes, addr)
+            p = self.p[lanes]
+            value, carry = function(value, p & self.CARRY)
+            mask = self.CARRY | self.ZERO | self.NEGATIVE
+            self.p[lanes] = (p & ~mask) | carry | self._nzFlags[value]
+            if mode == 'acc':
+                self.a[lanes] = value
+            else:
+                self.memory[lanes, addr] = value
+        return op
+
+    _op_ASL = _modify(lambda value, carry: ((value << 1) & 0xff, value >> 7))
+    _op_LSR = _modify(lambda value, carry: (value >> 1, value & 1))
+    _op_ROL = _modify(lambda value, carry: (((value << 1) | carry) & 0xff,
+                                            value >> 7))
+    _op_ROR = _modify(lambda value, carry: ((value >> 1) | (carry << 7),
+                                            value & 1))
+
+    def _increment(function):
+        def op(self, lanes, pc, mode, excycles, addcycles):
+            addr = self._address(lanes, pc, mode, excycles, addcycles)
+            value = function(self._byte(lanes, addr)) & 0xff
+            self.memory[lanes, addr] = value
+            self._flagsNZ(lanes, value)
+        return op
+
+    _op_INC = _increment(lambda value: value + 1)
+    _op_DEC = _increment(lambda value: value - 1)
+
+    def _register(name, function):
+        def op(self, lanes, pc, mode, excycles, addcycles):
+            value = function(getattr(self, name)[lanes]) & 0xff
+            getattr(self, name)[lanes] = value
+            self._flagsNZ(lanes, value)
+        return op
+
+    _op_INX = _register('x', lambda value: value + 1)
+    _op_INY = _register('y', lambda value: value + 1)
+    _op_DEX = _register('x', lambda value: value - 1)
+    _op_DEY = _register('y', lambda value: value - 1)
+
+    def _transfer(source, target, flags=True):
+        def op(self, lanes, pc, mode, excycles, addcycles):
+            value = getattr(self, source)[lanes]
+            getattr(self, target)[lanes] = value
+            if flags:
+                self._flagsNZ(lanes, value)
+        return op
+
+    _op_TAX = _transfer('a', 'x')
+    _op_TAY = _transfer('a', 'y')
+    _op_TXA = _transfer('x', 'a')
+    _op_TYA = _transfer('y', 'a')
+    _op_TSX = _transfer('sp', 'x')
+    _op_TXS = _transfer('x', 'sp', flags=False)
+
+    def _flag(flag, value):
+        def op(self, lanes, pc, mode, excycles, addcycles):
+            if value:
+                self.p[lanes] |= flag
+            else:
+                self.p[lanes] &= ~flag
+        return op
+
+    _op_CLC = _flag(MPU.CARRY, False)
+    _op_SEC = _flag(MPU.CARRY, True)
+    _op_CLI = _flag(MPU.INTERRUPT, False)
+    _op_SEI = _flag(MPU.INTERRUPT, True)
+    _op_CLD = _flag(MPU.DECIMAL, False)
+    _op_SED = _flag(MPU.DECIMAL, True)
+    _op_CLV = _flag(MPU.OVERFLOW, False)
+
+    def _branch(flag, value):
+        def op(self, lanes, pc, mode, excycles, addcycles):
+            taken = (self.p[lanes] & flag) != 0
+            if not value:
+                taken = ~taken
+            offset = self._byte(lanes, pc)
+            pc = pc + 1
+            target = pc + offset - ((offset & self.NEGATIVE) << 1)
+            excycles += taken
+            excycles += taken & ((pc & 0xff00) != (target & 0xff00))
+            return numpy.where(taken, target, pc)
+        return op
+
+    _op_BPL = _branch(MPU.NEGATIVE, False)
+    _op_BMI = _branch(MPU.NEGATIVE, True)
+    _op_BVC = _branch(MPU.OVERFLOW, False)
+    _op_BVS = _branch(MPU.OVERFLOW, True)
+    _op_BCC = _branch(MPU.CARRY, False)
+    _op_BCS = _branch(MPU.CARRY, True)
+    _op_BNE = _branch(MPU.ZERO, False)
+    _op_BEQ = _branch(MPU.ZERO, True)
+
+    del _load, _store, _logical, _arithmetic, _compare, _modify
+    del _increment, _register, _transfer, _flag, _branch
+
+    def _op_PHA(self, lanes, pc, mode, excycles, addcycles):
+        self._push(lanes, self.a[lanes])
+
+    def _op_PLA(self, lanes, pc, mode, excycles, addcycles):
+        value = self._pop(lanes)
+        self.a[lanes] = value
+        self._flagsNZ(lanes, value)
+
+    def _op_PHP(self, lanes, pc, mode, excycles, addcycles):
+        self._push(lanes, self.p[lanes] | self.BREAK | self.UNUSED)
+
+    def _op_PLP(self, lanes, pc, mode, excycles, addcycles):
+        self.p[lanes] = self._pop(lanes) | self.BREAK | self.UNUSED
+
+    def _op_JMP(self, lanes, pc, mode, excycles, addcycles):
+        addr = self._word(lanes, pc)
+        if mode == 'ind':
+            addr = self._wrap(lanes, addr)
+        return addr
+
+    def _op_JSR(self, lanes, pc, mode, excycles, addcycles):
+        self._pushWord(lanes, (pc + 1) & 0xffff)
+        return self._word(lanes, pc)
+
+    def _op_RTS(self, lanes, pc, mode, excycles, addcycles):
+        return self._popWord(lanes) + 1
+
+    def _op_BRK(self, lanes, pc, mode, excycles, addcycles):
+        # pc has already been increased one
+        self._pushWord(lanes, (pc + 1) & 0xffff)
+        self.p[lanes] |= self.BREAK
+        self._push(lanes, self.p[lanes] | self.BREAK | self.UNUSED)
+        self.p[lanes] |= self.INTERRUPT
+        return self._word(lanes, self.MPU.IRQ)
+
+    def _op_RTI(self, lanes, pc, mode, excycles, addcycles):
+        self.p[lanes] = self._pop(lanes) | self.BREAK | self.UNUSED
+        return self._popWord(lanes)
@@ -3,6 +3,8 @@ from utils.devices import make_instruction_decorator
 
 
 class MPU(mpu6502.MPU):
+    __slots__ = ()
+
     def __init__(self, *args, **kwargs):
         mpu6502.MPU.__init__(self, *args, **kwargs)
         self.name = '65C02'
@@ -14,11 +14,17 @@ class MPU(mpu6502.MPU):
     https://github.com/BigEd/verilog-6502/wiki
     """
 
+    # processor flags
+    NEGATIVE = 1 << 15
+    OVERFLOW = 1 << 14
+
     BYTE_WIDTH = 16
     BYTE_FORMAT = "%04x"
     ADDR_WIDTH = 32
     ADDR_FORMAT = "%08x"
 
+    __slots__ = ('IrqTo', 'ResetTo', 'NMITo')
+
     def __init__(self, *args, **kwargs):
         mpu6502.MPU.__init__(self, *args, **kwargs)
         self.name = '65Org16'
@@ -26,8 +32,6 @@ class MPU(mpu6502.MPU):
         self.IrqTo = (1 << self.ADDR_WIDTH) - 2
         self.ResetTo = (1 << self.ADDR_WIDTH) - 4
         self.NMITo = (1 << self.ADDR_WIDTH) - 6
-        self.NEGATIVE = 1 << 15
-        self.OVERFLOW = 1 << 14
 
     def step(self):
         if self.waiting:
@@ -45,3 +49,113 @@ class MPU(mpu6502.MPU):
     def reprformat(self):
         return ("%s   PC     AC   XR   YR   SP  NV---------BDIZC\n" +
                 "%s: %08x %04x %04x %04x %04x %s")
+
+    # operations
+    #
+    # the ADC/SBC tables in utils.alu only cover 8-bit bytes
+
+    def opADC(self, x):
+        data = self.ByteAt(x())
+
+        if self.p & self.DECIMAL:
+            halfcarry = 0
+            decimalcarry = 0
+            adjust0 = 0
+            adjust1 = 0
+            nibble0 = (data & 0xf) + (self.a & 0xf) + (self.p & self.CARRY)
+            if nibble0 > 9:
+                adjust0 = 6
+                halfcarry = 1
+            nibble1 = ((data >> 4) & 0xf) + ((self.a >> 4) & 0xf) + halfcarry
+            if nibble1 > 9:
+                adjust1 = 6
+                decimalcarry = 1
+
+            # the ALU outputs are not decimally adjusted
+            nibble0 = nibble0 & 0xf
+            nibble1 = nibble1 & 0xf
+            aluresult = (nibble1 << 4) + nibble0
+
+            # the final A contents will be decimally adjusted
+            nibble0 = (nibble0 + adjust0) & 0xf
+            nibble1 = (nibble1 + adjust1) & 0xf
+            self.p &= ~(self.CARRY | self.OVERFLOW | self.NEGATIVE | self.ZERO)
+            if aluresult == 0:
+                self.p |= self.ZERO
+            else:
+                self.p |= aluresult & self.NEGATIVE
+            if decimalcarry == 1:
+                self.p |= self.CARRY
+            if (~(self.a ^ data) & (self.a ^ aluresult)) & self.NEGATIVE:
+                self.p |= self.OVERFLOW
+            self.a = (nibble1 << 4) + nibble0
+        else:
+            if self.p & self.CARRY:
+                tmp = 1
+            else:
+                tmp = 0
+            result = data + self.a + tmp
+            self.p &= ~(self.CARRY | self.OVERFLOW | self.NEGATIVE | self.ZERO)
+            if (~(self.a ^ data) & (self.a ^ result)) & self.NEGATIVE:
+                self.p |= self.OVERFLOW
+            data = result
+            if data > self.byteMask:
+                self.p |= self.CARRY
+                data &= self.byteMask
+            if data == 0:
+                self.p |= self.ZERO
+            else:
+                self.p |= data & self.NEGATIVE
+            self.a = data
+
+    def opSBC(self, x):
+        data = self.ByteAt(x())
+
+        if self.p & self.DECIMAL:
+            halfcarry = 1
+            decimalcarry = 0
+            adjust0 = 0
+            adjust1 = 0
+
+            nibble0 = (self.a & 0xf) + (~data & 0xf) + (self.p & self.CARRY)
+            if nibble0 <= 0xf:
+                halfcarry = 0
+                adjust0 = 10
+            nibble1 = ((self.a >> 4) & 0xf) + ((~data >> 4) & 0xf) + halfcarry
+            if nibble1 <= 0xf:
+                adjust1 = 10 << 4
+
+            # the ALU outputs are not decimally adjusted
+            aluresult = self.a + (~data & self.byteMask) + \
+                (self.p & self.CARRY)
+
+            if aluresult > self.byteMask:
+                decimalcarry = 1
+            aluresult &= self.byteMask
+
+            # but the final result will be adjusted
+            nibble0 = (aluresult + adjust0) & 0xf
+            nibble1 = ((aluresult + adjust1) >> 4) & 0xf
+
+            self.p &= ~(self.CARRY | self.ZERO | self.NEGATIVE | self.OVERFLOW)
+            if aluresult == 0:
+                self.p |= self.ZERO
+            else:
+                self.p |= aluresult & self.NEGATIVE
+            if decimalcarry == 1:
+                self.p |= self.CARRY
+            if ((self.a ^ data) & (self.a ^ aluresult)) & self.NEGATIVE:
+                self.p |= self.OVERFLOW
+            self.a = (nibble1 << 4) + nibble0
+        else:
+            result = self.a + (~data & self.byteMask) + (self.p & self.CARRY)
+            self.p &= ~(self.CARRY | self.ZERO | self.OVERFLOW | self.NEGATIVE)
+            if ((self.a ^ data) & (self.a ^ result)) & self.NEGATIVE:
+                self.p |= self.OVERFLOW
+            data = result & self.byteMask
+            if data == 0:
+                self.p |= self.ZERO
+            if result > self.byteMask:
+                self.p |= self.CARRY
+            self.p |= data & self.NEGATIVE
+            self.a = data
@@ -1,5 +1,12 @@
+from bustrace import DUMMY, FETCH, PROGRAM, READ, WRITE
+
+from utils.alu import adc_table, sbc_table
 from utils.conversions import itoa
-from utils.devices import make_instruction_decorator
+from utils.devices import make_instruction_decorator, make_variant_class
+from utils.flags import compare_table, nz_table
+from profiler import AddressProfile, CallProfile, OpcodeProfile
+from utils.snapshot import (clone_mpu, read_state_file, restore_snapshot,
+                            take_snapshot, write_state_file)
 
 class MPU():
     # vectors
@@ -26,26 +33,27 @@ class MPU():
     ADDR_WIDTH  = 16
     ADDR_FORMAT = "%04X"
 
-    # declare registers
+    # set by the functional, tracing and bus trace variants, see
+    # _selectVariant(); run() goes through step() if INSTRUMENTED
 
-    a  = dict()
-    b  = dict()
-    c  = dict()
-    sp = dict()
-    ip = int()
-    wp = int()
-    p  = int() | BREAK
-    pc = int()
-    
-    histogram = dict()
+    FUNCTIONAL   = False
+    TRACING      = False
+    INSTRUMENTED = False
 
-    # declare Prefix Byte Boolean Flags Registers
+    # declare registers, prefix flags and debug flags: the register file is
+    # slotted, and __init__ gives every register its reset-time default
 
-    osx  = False
-    oax  = False
-    oay  = False
-    ind  = False
-    siz  = False
+    __slots__ = ('a', 'b', 'c', 'x', 'y', 'sp', 'sel', 'ip', 'wp', 'p', 'pc',
+                 'osx', 'oax', 'oay', 'ind', 'siz', 'lscx', 'bitMask',
+                 '_dbgD', '_dbgE', '_dbg', 'out', '_busTrace',
+                 '_opcodeProfile', '_addressProfile', '_callProfile',
+                 'name', 'byteMask', 'wordMask', 'addrMask', 'hiByteMask',
+                 'addrHighMask', 'signExtend', 'spBase',
+                 'nzFlags', 'nzFlags16', 'cmpFlags',
+                 'excycles', 'addcycles', 'processorCycles',
+                 'numInstructions', 'pgmMemRdCycles', 'datMemRdCycles',
+                 'datMemWrCycles', 'dummyCycles',
+                 'start_pc', 'memory')
 
     '''
         Override OSX for LDX/STX/CPX imm/zp/zp,Y/abs/abs,Y and PSH/PUL zp/abs
@@ -58,13 +66,9 @@ class MPU():
         instruction fetch / decode stage.
     '''
 
-    lscx = False
+    # Prefix Instruction Opcodes: OSX, IND, SIZ, ISZ, OSZ, OIS, OAX, OAY
 
-    dbgD = False
-    dbgE = False
-    dbg  = False
-    
-    out  = None
+    prefixes = frozenset((0x8B, 0x9B, 0xAB, 0xBB, 0xCB, 0xDB, 0xEB, 0xFB))
 
     def __init__(self, memory=None, pc=0x0200):
         # config
@@ -76,6 +80,46 @@ class MPU():
         self.addrHighMask = self.hiByteMask
         self.signExtend   = self.hiByteMask
         self.spBase = 1 << self.BYTE_WIDTH
+        self.nzFlags   = nz_table(self.BYTE_WIDTH, self.NEGATIVE, self.ZERO)
+        self.nzFlags16 = nz_table(self.WORD_WIDTH, self.NEGATIVE, self.ZERO)
+        self.cmpFlags  = compare_table(self.BYTE_WIDTH, self.NEGATIVE,
+                                       self.ZERO, self.CARRY)
+
+        # declare registers: the A/X/Y register stacks are [TOS, NOS, BOS]
+        # and sp is [user SP, kernel SP], indexed by the MODE flag
+
+        self.a  = [0, 0, 0]
+        self.b  = [0, 0, 0]
+        self.c  = [0, 0, 0]
+        self.x  = [0, 0, 0]
+        self.y  = [0, 0, 0]
+        self.sp = [0, 0]
+        self.ip = int()
+        self.wp = int()
+        self.p  = int() | self.BREAK
+        self.pc = int()
+
+        # declare Prefix Byte Boolean Flags Registers
+
+        self.osx  = False
+        self.oax  = False
+        self.oay  = False
+        self.ind  = False
+        self.siz  = False
+        self.lscx = False
+
+        self.bitMask = 0
+
+        self._dbgD = False
+        self._dbgE = False
+        self._dbg  = False
+
+        self.out  = None
+
+        self._busTrace = None
+        self._opcodeProfile = None
+        self._addressProfile = None
+        self._callProfile = None
 
         # vm status
         self.excycles = 0
@@ -87,8 +131,6 @@ class MPU():
         self.datMemWrCycles  = 0
         self.dummyCycles     = 0
         
-        for i in range(256):  self.histogram[i] = 0
-        
         self.start_pc = pc
 
         # Initialize Memory
@@ -149,74 +191,217 @@ class MPU():
     # Fetch and Execute instruction
 
     def step(self):
-        def getInstruction(self):
-            instructCode = self.byteMask & self.memory[self.addrMask & self.pc]
-            if self.dbg & self.dbgD:
-                #print('   IR:', '%02X <= mem[%04X] ' \
-                      #% (instructCode, self.pc)        )
-                print('   IR:', '%02X <= mem[%04X] ' \
-                      % (instructCode, self.pc), end='')
-                if not self.out.closed:
-                    print('   IR:', '%02X <= mem[%04X] ' \
-                          % (instructCode, self.pc), end='', file=self.out)
-                          
-            self.histogram[instructCode] += 1
-                          
-            pc = self.addrMask & (self.pc + 1)
-            if instructCode in (0x8B, 0x9B, 0xAB, 0xBB, 0xCB, 0xDB, 0xEB, 0xFB):
-                #pass
-                if self.dbg & self.dbgD:
-                    print()
-                    if not self.out.closed:
-                        print(file=self.out)
-                else: pass
-            elif self.dbg & self.dbgD:
-                psw  = 'P[%d%d%d%d%d%d%d%d]' % (int((self.p >> 7) & 1), \
-                                                int((self.p >> 6) & 1), \
-                                                int((self.p >> 5) & 1), \
-                                                int((self.p >> 4) & 1), \
-                                                int((self.p >> 3) & 1), \
-                                                int((self.p >> 2) & 1), \
-                                                int((self.p >> 1) & 1), \
-                                                int((self.p >> 0) & 1)   )
-                flgs = 'F[%d%d%d%d%d%d%d%d]' % (int(self.dbgD), \
-                                                int(self.dbgE), \
-                                                int(self.lscx), \
-                                                int(self.oay), \
-                                                int(self.oax), \
-                                                int(self.osx), \
-                                                int(self.ind), \
-                                                int(self.siz)    )                              
-                print('A[%04X,%04X,%04X]' % (self.a[0], self.a[1], self.a[2]),
-                      'X[%04X,%04X,%04X]' % (self.x[0], self.x[1], self.x[2]),
-                      'Y[%04X,%04X,%04X]' % (self.y[0], self.y[1], self.y[2]),
-                      'S[%04X,%04X]' % (self.sp[1], self.sp[0]), 
-                      'I[%04X]' % self.ip,
-                      'W[%04X]' % self.wp,
-                      psw,
-                      flgs )
-                if not self.out.closed:
-                    print('A[%04X,%04X,%04X]' % (self.a[0],self.a[1],self.a[2]),
-                          'X[%04X,%04X,%04X]' % (self.x[0],self.x[1],self.x[2]),
-                          'Y[%04X,%04X,%04X]' % (self.y[0],self.y[1],self.y[2]),
-                          'S[%04X,%04X]' % (self.sp[1], self.sp[0]), 
-                          'I[%04X]' % self.ip,
-                          'W[%04X]' % self.wp,
-                          psw,
-                          flgs, file=self.out)
-                self.numInstructions += 1
-            else:
-                self.numInstructions += 1
-            self.processorCycles += 1
-            self.pgmMemRdCycles += 1
-            return pc, instructCode
-
-        self.pc, instructCode = getInstruction(self)
+        instructCode = self.byteMask & self.memory[self.addrMask & self.pc]
+        self.pc = self.addrMask & (self.pc + 1)
+        if instructCode not in self.prefixes:
+            self.numInstructions += 1
+        self.processorCycles += 1
+        self.pgmMemRdCycles += 1
         self.excycles = 0
         self.addcycles = self.extracycles[instructCode]
         self.instruct[instructCode](self)   # execute instruction
         return self
 
+    # Execute instructions until a stop condition is met
+
+    def run(self, max_cycles=None, max_instructions=None,
+            stop_pcs=(), stop_opcodes=()):
+        """ Budgets are checked before each fetch; stop_pcs and stop_opcodes
+        are checked after each fetch/execute against the new PC, exactly as
+        the monitor does after each step(). Prefix bytes are not counted as
+        instructions, matching numInstructions. Returns a tuple of (reason,
+        cycles, instructions), where reason is one of 'cycles',
+        'instructions', 'opcode' or 'pc'.
+        """
+        memory = self.memory
+        instruct = self.instruct
+        extracycles = self.extracycles
+        addrMask = self.addrMask
+        byteMask = self.byteMask
+        prefixes = self.prefixes
+        stop_pcs = frozenset(stop_pcs)
+        stop_opcodes = frozenset(stop_opcodes)
+        instrumented = self.INSTRUMENTED
+
+        start_cycles = self.processorCycles
+        if max_cycles is None:
+            cycle_limit = None
+        else:
+            cycle_limit = start_cycles + max_cycles
+        instructions = 0
+
+        while True:
+            if cycle_limit is not None and self.processorCycles >= cycle_limit:
+                reason = 'cycles'
+                break
+            if instructions == max_instructions:
+                reason = 'instructions'
+                break
+
+            if instrumented:
+                instructCode = byteMask & memory[addrMask & self.pc]
+                self.step()
+            else:
+                instructCode = byteMask & memory[addrMask & self.pc]
+                self.pc = addrMask & (self.pc + 1)
+                if instructCode not in prefixes:
+                    self.numInstructions += 1
+                self.processorCycles += 1
+                self.pgmMemRdCycles += 1
+                self.excycles = 0
+                self.addcycles = extracycles[instructCode]
+                instruct[instructCode](self)
+            if instructCode not in prefixes:
+                instructions += 1
+
+            if stop_opcodes and memory[self.pc] in stop_opcodes:
+                reason = 'opcode'
+                break
+            if self.pc in stop_pcs:
+                reason = 'pc'
+                break
+
+        return reason, self.processorCycles - start_cycles, instructions
+
+    # Snapshots - the prefix flags, register stacks and all of the cycle
+    # counters are captured along with memory
+
+    def snapshot(self):
+        return take_snapshot(self)
+
+    def restore(self, snapshot):
+        restore_snapshot(self, snapshot)
+        self._setDebugFlags(self._dbg, self._dbgD, self._dbgE)
+
+    def clone(self):
+        twin = clone_mpu(self)
+        # bus traces and profiles belong to the original
+        twin._busTrace = None
+        twin._opcodeProfile = None
+        twin._addressProfile = None
+        twin._callProfile = None
+        twin._selectVariant(self.FUNCTIONAL)
+        return twin
+
+    def save_state(self, path, compress=False):
+        write_state_file(self, path, compress)
+
+    def load_state(self, path):
+        self.restore(read_state_file(self, path))
+
+    # Variants - the functional mode drops the cycle counters, see
+    # mpu6502.MPU.enable_functional_mode(), the tracing variant adds the
+    # debug output, the bus trace variant records every bus cycle and the
+    # profile variants count what is executed.  The class is swapped
+    # whenever one of them changes, so the handlers of the plain class
+    # make no per-access debug or profiling checks.
+
+    def enable_functional_mode(self):
+        self._selectVariant(True)
+
+    def disable_functional_mode(self):
+        self._selectVariant(False)
+
+    def enable_bus_trace(self, trace):
+        """ Record every bus cycle in trace, a bustrace.BusTrace.
+        """
+        self._busTrace = trace
+        self._selectVariant(self.FUNCTIONAL)
+
+    def disable_bus_trace(self):
+        self._busTrace = None
+        self._selectVariant(self.FUNCTIONAL)
+
+    def enable_opcode_profile(self, profile=None):
+        """ Count the opcodes executed, keyed on the prefixes in force, in
+        profile, a new profiler.OpcodeProfile by default, and return it.
+        """
+        if profile is None:
+            profile = OpcodeProfile(self)
+        self._opcodeProfile = profile
+        self._selectVariant(self.FUNCTIONAL)
+        return profile
+
+    def disable_opcode_profile(self):
+        self._opcodeProfile = None
+        self._selectVariant(self.FUNCTIONAL)
+
+    def enable_address_profile(self, profile=None):
+        """ Count the instructions, prefixes included, executed at each
+        address and the cycles they take in profile, a new
+        profiler.AddressProfile by default, and return it.
+        """
+        if profile is None:
+            profile = AddressProfile(self)
+        self._addressProfile = profile
+        self._selectVariant(self.FUNCTIONAL)
+        return profile
+
+    def disable_address_profile(self):
+        self._addressProfile = None
+        self._selectVariant(self.FUNCTIONAL)
+
+    def enable_call_profile(self, profile=None):
+        """ Charge the cycles executed to the subroutines running them in
+        profile, a new profiler.CallProfile by default, and return it.
+        Prefixes are charged like instructions.
+        """
+        if profile is None:
+            profile = CallProfile(self)
+        self._callProfile = profile
+        self._selectVariant(self.FUNCTIONAL)
+        return profile
+
+    def disable_call_profile(self):
+        self._callProfile = None
+        self._selectVariant(self.FUNCTIONAL)
+
+    def _selectVariant(self, functional):
+        mixins = ()
+        if self._busTrace is not None:
+            mixins += (BusTraceMode,)
+        # every trace is gated on dbg and one of dbgD or dbgE
+        if self._dbg and (self._dbgD or self._dbgE):
+            mixins += (TracingMode,)
+        if self._opcodeProfile is not None:
+            mixins += (OpcodeProfileMode,)
+        if self._addressProfile is not None:
+            mixins += (AddressProfileMode,)
+        if self._callProfile is not None:
+            mixins += (CallProfileMode,)
+        if functional:
+            mixins += (FunctionalMode,)
+        base = getattr(type(self), 'base_class', type(self))
+        self.__class__ = make_variant_class(base, mixins)
+
+    def _setDebugFlags(self, dbg, dbgD, dbgE):
+        self._dbg, self._dbgD, self._dbgE = dbg, dbgD, dbgE
+        self._selectVariant(self.FUNCTIONAL)
+
+    @property
+    def dbg(self):
+        return self._dbg
+
+    @dbg.setter
+    def dbg(self, value):
+        self._setDebugFlags(value, self._dbgD, self._dbgE)
+
+    @property
+    def dbgD(self):
+        return self._dbgD
+
+    @dbgD.setter
+    def dbgD(self, value):
+        self._setDebugFlags(self._dbg, value, self._dbgE)
+
+    @property
+    def dbgE(self):
+        return self._dbgE
+
+    @dbgE.setter
+    def dbgE(self, value):
+        self._setDebugFlags(self._dbg, self._dbgD, value)
+
     # Function to clear the Prefix Instruction Flags
     # - used after all non-prefix instructions
 
@@ -240,9 +425,9 @@ class MPU():
         
         self.sel = 1
         
-        self.a  = {0: 0, 1: 0, 2: 0}
-        self.x  = {0: 0, 1: 0, 2: 0}
-        self.y  = {0: 0, 1: 0, 2: 0}
+        self.a  = [0, 0, 0]
+        self.x  = [0, 0, 0]
+        self.y  = [0, 0, 0]
         self.ip = 0
         self.wp = 0
 
@@ -271,39 +456,20 @@ class MPU():
 
     def rdPM(self):
         tmp = self.byteMask & self.memory[self.addrMask & self.pc]
-        if self.dbg & self.dbgD:
-            print(' rdPM:', '%02X <= mem[%04X]' % (tmp, self.pc))
-            if not self.out.closed:
-                print(' rdPM:', '%02X <= mem[%04X]' % (tmp, self.pc),
-                      file=self.out)
         self.pc = self.addrMask & (self.pc + 1)
         self.processorCycles += 1; self.pgmMemRdCycles += 1
         return tmp
 
     def rdDM(self, addr):
         tmp = self.byteMask & self.memory[addr]
-        if self.dbg & self.dbgD:
-            print(' rdDM:', '%02X <= mem[%04X]' % (tmp, addr))
-            if not self.out.closed:
-                print(' rdDM:', '%02X <= mem[%04X]' % (tmp, addr),
-                      file=self.out)
         self.processorCycles += 1; self.datMemRdCycles += 1
         return tmp
 
     def wrDM(self, addr, data):
-        if self.dbg & self.dbgD:
-            print(' wrDM:', '%02X => mem[%04X]' % (self.byteMask & data, addr))
-            if not self.out.closed:
-                print(' wrDM:', '%02X => mem[%04X]' % \
-                      (self.byteMask & data, addr), file=self.out)
         self.memory[addr] = self.byteMask & data
         self.processorCycles += 1; self.datMemWrCycles += 1
 
     def rwDM(self, addr):
-        if self.dbg & self.dbgD:
-            print(' rwDM:', '-- <> mem[%04X]' % (addr))
-            if not self.out.closed:
-                print(' rwDM:', '-- <> mem[%04X]' % (addr), file=self.out)
         self.processorCycles += 1; self.dummyCycles += 1
 
     def ByteAt(self, addr):
@@ -1275,13 +1441,11 @@ class MPU():
     # ALU Flags Functions
 
     def FlagsNZ(self, value):
-        self.p &= ~(self.NEGATIVE | self.ZERO)
-        if value == 0:
-            self.p |= self.ZERO
         if self.siz:
-            self.p |= self.NEGATIVE & (value >> 8)
+            flags = self.nzFlags16[value]
         else:
-            self.p |= self.NEGATIVE &  value
+            flags = self.nzFlags[value]
+        self.p = (self.p & ~(self.NEGATIVE | self.ZERO)) | flags
 
 #
 #   Stack operations
@@ -1921,47 +2085,16 @@ class MPU():
 #
 
     def opADC(self, data):
+        reg = self._getAluReg()
+
         if self.siz:
             sign = self.NEGATIVE << 8
             mask = self.wordMask
-        else:
-            sign = self.NEGATIVE
-            mask = self.byteMask
-
-        reg = self._getAluReg()
-        
-        auL = mask & reg
-        auR = mask & data
-        cin = self.CARRY & self.p
 
-        if self.p & self.DECIMAL and not self.siz:
-            cy3 = 0; cy7 = 0; da0 = 0; da1 = 0
-            loSum = (auL & 0xF) + (auR & 0xF) + cin
-            if loSum > 9:
-                da0 = 6
-                cy3 = 1
-            hiSum = ((auL >> 4) & 0xF) + ((auR >> 4) & 0xF) + cy3
-            if hiSum > 9:
-                da1 = 6
-                cy7 = 1
-
-            # 6502 sets ALU flags using result before decimal adjust
-            # 65C02/M65C02A set ALU flags after decimal adjust
-            # ALU outputs are decimally adjusted
-            
-            loSum = (loSum + da0) & 0xF
-            hiSum = (hiSum + da1) & 0xF
-            sum   = (hiSum << 4) + loSum
+            auL = mask & reg
+            auR = mask & data
+            cin = self.CARRY & self.p
 
-            if (~(auL ^ auR) & (auL ^ sum)) & sign:
-                self.p |= self.OVERFLOW
-            if cy7 == 1:
-                self.p |= self.CARRY
-                sum &= mask
-            if sum == 0:
-                self.p |= self.ZERO
-            self.p |= sign & sum
-        else:
             sum = auL + auR + cin
 
             self.p &= ~(self.CARRY | self.ZERO | self.OVERFLOW | self.NEGATIVE)
@@ -1973,57 +2106,35 @@ class MPU():
                 sum &= mask
             if sum == 0:
                 self.p |= self.ZERO
-            if self.siz:
-                self.p |= (sign & sum) >> 8
-            else: self.p |= (sign & sum)
+            self.p |= (sign & sum) >> 8
+        else:
+            mask = self.byteMask
+
+            table = adc_table(self.p & self.CARRY, self.p & self.DECIMAL,
+                              'M65C02A')
+            entry = table[((mask & reg) << 8) | (mask & data)]
+
+            # decimal mode only sets flags, it never clears them
+            if not self.p & self.DECIMAL:
+                self.p &= ~(self.CARRY | self.ZERO | self.OVERFLOW
+                            | self.NEGATIVE)
+            self.p |= entry >> 8
+            sum = entry
 
         reg = mask & sum
         self._putAluReg(reg)
 
     def opSBC(self, data):
+        reg = self._getAluReg()
+
         if self.siz:
             sign = self.NEGATIVE << 8
             mask = self.wordMask
-        else:
-            sign = self.NEGATIVE
-            mask = self.byteMask
 
-        reg = self._getAluReg()
-        
-        auL = mask & reg
-        auR = mask & ~data
-        cin = self.CARRY & self.p
+            auL = mask & reg
+            auR = mask & ~data
+            cin = self.CARRY & self.p
 
-        if self.p & self.DECIMAL and not self.siz:
-            cy3 = 1; cy7 = 0; da0 = 0; da1 = 0
-            loSum = (auL & 0xF) + (auR & 0xF) + cin
-            if loSum <= 15:
-                cy3 = 0
-                da0 = 10
-            hiSum = ((auL >> 4) & 0xF) + ((auR >> 4) & 0xF) + cy3
-            if hiSum <= 15:
-                da1 = 10
-            else: cy7 = 1
-
-            # 6502 sets ALU flags using result before decimal adjust
-            # 65C02/M65C02A set ALU flags after decimal adjust
-            # ALU outputs are decimally adjusted
-            
-            loSum = (loSum + da0) & 0xF
-            hiSum = (hiSum + da1) & 0xF
-            sum   = (hiSum << 4) + loSum
-
-            self.p &= ~(self.CARRY | self.ZERO | self.NEGATIVE | self.OVERFLOW)
-            
-            if (~(auL ^ auR) & (auL ^ sum)) & sign:
-                self.p |= self.OVERFLOW
-            if cy7 == 1:
-                self.p |= self.CARRY
-                sum &= mask
-            if sum == 0:
-                self.p |= self.ZERO
-            self.p |= sign & sum
-        else:
             sum = auL + auR + cin
 
             self.p &= ~(self.CARRY | self.ZERO | self.OVERFLOW | self.NEGATIVE)
@@ -2035,9 +2146,17 @@ class MPU():
                 sum &= mask
             if sum == 0:
                 self.p |= self.ZERO
-            if self.siz:
-                self.p |= (sign & sum) >> 8
-            else: self.p |= (sign & sum)
+            self.p |= (sign & sum) >> 8
+        else:
+            mask = self.byteMask
+
+            table = sbc_table(self.p & self.CARRY, self.p & self.DECIMAL,
+                              'M65C02A')
+            entry = table[((mask & reg) << 8) | (mask & data)]
+
+            self.p &= ~(self.CARRY | self.ZERO | self.OVERFLOW | self.NEGATIVE)
+            self.p |= entry >> 8
+            sum = entry
 
         reg = mask & sum
 
@@ -2199,30 +2318,27 @@ class MPU():
         if self.siz:
             mask = self.wordMask
             sign = self.NEGATIVE << 8
-        else:
-            mask = self.byteMask
-            sign = self.NEGATIVE
 
-        auL = mask & regVal
-        auR = mask & (~memVal)
+            auL = mask & regVal
+            auR = mask & (~memVal)
 
-        sum = auL + auR + 1
+            sum = auL + auR + 1
 
-        self.p &= ~(self.CARRY | self.ZERO | self.NEGATIVE)
-
-        if sum > mask:
-            self.p |= self.CARRY
-        if (mask & sum) == 0:
-            self.p |= self.ZERO
-
-        if self.siz:
+            flags = self.nzFlags16[mask & sum]
+            if sum > mask:
+                flags |= self.CARRY
             if (~(auL ^ auR) & (auL ^ sum)) & sign:
-                self.p |= self.OVERFLOW
-            else:
-                self.p &= ~self.OVERFLOW
-            self.p |= (sign & sum) >> 8
+                flags |= self.OVERFLOW
+
+            self.p &= ~(self.CARRY | self.ZERO | self.NEGATIVE | self.OVERFLOW)
         else:
-            self.p |= (sign & sum)
+            mask = self.byteMask
+
+            flags = self.cmpFlags[((mask & regVal) << self.BYTE_WIDTH)
+                                  | (mask & memVal)]
+
+            self.p &= ~(self.CARRY | self.ZERO | self.NEGATIVE)
+        self.p |= flags
 
     def opCMP(self, memVal):
         if self.oax:
@@ -2398,11 +2514,11 @@ class MPU():
 
     def opDUP(self):
         if self.oax:                    # DUP X
-            self.x[2] = self.x[1]
-            self.x[1] = self.x[0]
+            x = self.x
+            x[1], x[2] = x[0], x[1]
         elif self.oay:                  # DUP Y
-            self.y[2] = self.y[1]
-            self.y[1] = self.y[0]
+            y = self.y
+            y[1], y[2] = y[0], y[1]
         elif self.siz or self.ind:
             if self.siz and self.ind:   # XIA
                 tmp = self.ip
@@ -2413,38 +2529,31 @@ class MPU():
             else:                       # TIA
                 self.a[0] = self.ip
         else:                           # DUP A
-            self.a[2] = self.a[1]
-            self.a[1] = self.a[0]
+            a = self.a
+            a[1], a[2] = a[0], a[1]
     
     def opSWP(self):
         if self.oax:                    # SWP X
-            tmp = self.x[0]
-            self.x[0] = self.x[1]
-            self.x[1] = tmp
+            x = self.x
+            x[0], x[1] = x[1], x[0]
         elif self.oay:                  # SWP Y
-            tmp = self.y[0]
-            self.y[0] = self.y[1]
-            self.y[1] = tmp
+            y = self.y
+            y[0], y[1] = y[1], y[0]
         elif self.ind:                  # SWB
             tmp1 = self.byteMask &  self.a[0]
             tmp2 = self.byteMask & (self.a[0] >> self.BYTE_WIDTH)
             self.a[0] = (tmp1 << self.BYTE_WIDTH) | tmp2
         else:                           # SWP A
-            tmp = self.a[0]
-            self.a[0] = self.a[1]
-            self.a[1] = tmp
+            a = self.a
+            a[0], a[1] = a[1], a[0]
    
     def opROT(self):
         if self.oax:                    # ROT X
-            tmp = self.x[0]
-            self.x[0] = self.x[1]
-            self.x[1] = self.x[2]
-            self.x[2] = tmp
+            x = self.x
+            x[0], x[1], x[2] = x[1], x[2], x[0]
         elif self.oay:                  # ROT Y
-            tmp = self.y[0]
-            self.y[0] = self.y[1]
-            self.y[1] = self.y[2]
-            self.y[2] = tmp
+            y = self.y
+            y[0], y[1], y[2] = y[1], y[2], y[0]
         elif self.ind:                  # REV
             tmp = '%s' % bin(self.a[0])[2:]
             if len(tmp) < 16:
@@ -2452,10 +2561,8 @@ class MPU():
             tmp = tmp[::-1]
             self.a[0] = self.wordMask & int(tmp, base=2)
         else:                           # ROT A
-            tmp = self.a[0]
-            self.a[0] = self.a[1]
-            self.a[1] = self.a[2]
-            self.a[2] = tmp
+            a = self.a
+            a[0], a[1], a[2] = a[1], a[2], a[0]
 
 #
 #   FORTH VM Operations
@@ -2473,84 +2580,7 @@ class MPU():
             tmp2 = self.rdDM(self.addrMask & (self.wp + 1))
             pfa = (tmp2 << 8) + tmp1
         self.pc = pfa
-    
-        if self.dbg & self.dbgE:
-            psw  = 'P[%d%d%d%d%d%d%d%d]' % (int((self.p >> 7) & 1), \
-                                            int((self.p >> 6) & 1), \
-                                            int((self.p >> 5) & 1), \
-                                            int((self.p >> 4) & 1), \
-                                            int((self.p >> 3) & 1), \
-                                            int((self.p >> 2) & 1), \
-                                            int((self.p >> 1) & 1), \
-                                            int((self.p >> 0) & 1)   )
-            flgs = 'F[%d%d%d%d%d%d%d%d]' % (int(self.dbgD), \
-                                            int(self.dbgE), \
-                                            int(self.lscx), \
-                                            int(self.oay),  \
-                                            int(self.oax),  \
-                                            int(self.osx),  \
-                                            int(self.ind),  \
-                                            int(self.siz)    )
-            
-            dtStk = []
-            dtPtr = self.sp[1] + 1
-            while dtPtr < 0x200:
-                dtStk.append('%04X' % self.WordAt(dtPtr))
-                dtPtr += 2
-            
-            rsStk = []
-            rsPtr = self.x[0] + 1
-            while rsPtr < 0xA0 and rsPtr >= 0x20:
-                rsStk.append('%04X' % self.WordAt(rsPtr))
-                rsPtr += 2
-                
-            i = self.wp - 4; ch = self.ByteAt(i)
-            while ch < 127:
-                i -= 1; ch = self.ByteAt(i)
-            fn = ''; i += 1; ch = self.ByteAt(i)
-            while ch < 127:
-                if ch == 0: fn += 'X'
-                else: fn += '%c' % ch
-                i += 1; ch = self.ByteAt(i)
-            ch &= 0x7F
-            if ch == 0: fn += 'X'
-            else: fn += '%c' % (ch & 0x7F)
-            
-            if len(fn) > 21:
-                fn = fn[:21]
-            else:
-                fn = fn + ' '*(21 - len(fn))
-            
-            print('='*132,'\n',
-                  fn,
-                  'A[%04X,%04X,%04X]' % (self.a[0], self.a[1], self.a[2]),
-                  'X[%04X,%04X,%04X]' % (self.x[0], self.x[1], self.x[2]),
-                  'Y[%04X,%04X,%04X]' % (self.y[0], self.y[1], self.y[2]),
-                  'S[%04X,%04X]' % (self.sp[1], self.sp[0]), 
-                  'I[%04X]' % (self.ip),
-                  'W[%04X]' % (self.wp),
-                  psw,
-                  flgs,
-                  '\n Dat Stk:', dtStk,
-                  '\n Rtn Stk:', rsStk,
-                  '\n'+'='*132)
-            if not self.out.closed:
-                print('='*132,'\n',
-                      fn,
-                      'A[%04X,%04X,%04X]' % (self.a[0], self.a[1], self.a[2]),
-                      'X[%04X,%04X,%04X]' % (self.x[0], self.x[1], self.x[2]),
-                      'Y[%04X,%04X,%04X]' % (self.y[0], self.y[1], self.y[2]),
-                      'S[%04X,%04X]' % (self.sp[1], self.sp[0]), 
-                      'I[%04X]' % (self.ip),
-                      'W[%04X]' % (self.wp),
-                      psw,
-                      flgs,
-                      '\n Dat Stk:', dtStk,
-                      '\n Rtn Stk:', rsStk,
-                      '\n'+'='*132,
-                      file=self.out)
 
-        
     def opPHI(self):
         if self.osx:                # Change default stack for PHI
             self.osx = False        # change default to S, Sk or Su
@@ -3763,87 +3793,6 @@ class MPU():
     @instruction(name="JMP", mode="absI", cycles=5)
     def inst_0x6C(self):
         _, self.pc = self._absI()
-        
-        if self.dbg and self.dbgE:
-            psw  = 'P[%d%d%d%d%d%d%d%d]' % (int((self.p >> 7) & 1), \
-                                            int((self.p >> 6) & 1), \
-                                            int((self.p >> 5) & 1), \
-                                            int((self.p >> 4) & 1), \
-                                            int((self.p >> 3) & 1), \
-                                            int((self.p >> 2) & 1), \
-                                            int((self.p >> 1) & 1), \
-                                            int((self.p >> 0) & 1)   )
-            flgs = 'F[%d%d%d%d%d%d%d%d]' % (int(self.dbgD), \
-                                            int(self.dbgE), \
-                                            int(self.lscx), \
-                                            int(self.oay), \
-                                            int(self.oax), \
-                                            int(self.osx), \
-                                            int(self.ind), \
-                                            int(self.siz)    )
-            
-            rsStk = []
-            rsPtr = self.sp[1] + 1
-            while rsPtr < 0x200:
-                rsStk.append('%04X' % self.WordAt(rsPtr))
-                rsPtr += 2
-            
-            dtStk = []
-            dtPtr = self.x[0]
-            while dtPtr < 0x9F and dtPtr >= 0x20:
-                dtStk.append('%04X' % self.WordAt(dtPtr))
-                dtPtr += 2
-                
-            ip = self.WordAt(0xB0) - 2
-            wp = self.WordAt(0xB3)
-            
-            i = wp - 4; ch = self.ByteAt(i)
-            while ch < 127:
-                i -= 1; ch = self.ByteAt(i)
-            fn = ''; i += 1; ch = self.ByteAt(i)
-            while ch < 127:
-                if ch == 0: fn += 'X'
-                else: fn += '%c' % ch
-                i += 1; ch = self.ByteAt(i)
-            ch &= 0x7F
-            if ch == 0: fn += 'X'
-            else: fn += '%c' % (ch & 0x7F)
-            
-            if len(fn) > 21:
-                fn = fn[:21]
-            else:
-                fn = fn + ' '*(21 - len(fn))
-            
-            print('='*132,'\n',
-                  fn,
-                  'A[%04X,%04X,%04X]' % (self.a[0], self.a[1], self.a[2]),
-                  'X[%04X,%04X,%04X]' % (self.x[0], self.x[1], self.x[2]),
-                  'Y[%04X,%04X,%04X]' % (self.y[0], self.y[1], self.y[2]),
-                  'S[%04X,%04X]' % (self.sp[1], self.sp[0]), 
-                  'I[%04X]' % ip,
-                  'W[%04X]' % wp,
-                  psw,
-                  flgs,
-                  '\n Dat Stk:', dtStk,
-                  '\n Rtn Stk:', rsStk,
-                  '\n'+'='*132)
-
-            if not self.out.closed:
-                print('='*132,'\n',
-                      fn,
-                      'A[%04X,%04X,%04X]' % (self.a[0], self.a[1], self.a[2]),
-                      'X[%04X,%04X,%04X]' % (self.x[0], self.x[1], self.x[2]),
-                      'Y[%04X,%04X,%04X]' % (self.y[0], self.y[1], self.y[2]),
-                      'S[%04X,%04X]' % (self.sp[1], self.sp[0]), 
-                      'I[%04X]' % ip,
-                      'W[%04X]' % wp,
-                      psw,
-                      flgs,
-                      '\n Dat Stk:', dtStk,
-                      '\n Rtn Stk:', rsStk,
-                      '\n'+'='*132,
-                      file=self.out)
-
         self.clrPrefixFlags()
 
     @instruction(name="JMP", mode="absXI", cycles=5)
@@ -4162,3 +4111,453 @@ class MPU():
         self.bitMask = 0x80
         self.zprel(self.opBBSx)
         self.clrPrefixFlags()
+
+
+class FunctionalMode:
+    """ The methods that MPU.enable_functional_mode() puts in front of those
+    of the M65C02A: the fetch and the memory accessors without the cycle,
+    program, data and dummy cycle counters.  numInstructions is still
+    kept.
+    """
+    __slots__ = ()
+
+    FUNCTIONAL = True
+
+    def step(self):
+        instructCode = self.byteMask & self.memory[self.addrMask & self.pc]
+        self.pc = self.addrMask & (self.pc + 1)
+        if instructCode not in self.prefixes:
+            self.numInstructions += 1
+        self.instruct[instructCode](self)   # execute instruction
+        return self
+
+    def run(self, max_cycles=None, max_instructions=None,
+            stop_pcs=(), stop_opcodes=()):
+        """ As MPU.run(), but max_cycles must be None and the cycle count
+        returned is always 0.
+        """
+        if max_cycles is not None:
+            raise ValueError("a cycle budget needs the accurate mode")
+
+        memory = self.memory
+        instruct = self.instruct
+        addrMask = self.addrMask
+        byteMask = self.byteMask
+        prefixes = self.prefixes
+        stop_pcs = frozenset(stop_pcs)
+        stop_opcodes = frozenset(stop_opcodes)
+        instrumented = self.INSTRUMENTED
+        instructions = 0
+
+        while True:
+            if instructions == max_instructions:
+                reason = 'instructions'
+                break
+
+            instructCode = byteMask & memory[addrMask & self.pc]
+            if instrumented:
+                self.step()
+            else:
+                self.pc = addrMask & (self.pc + 1)
+                if instructCode not in prefixes:
+                    self.numInstructions += 1
+                instruct[instructCode](self)
+            if instructCode not in prefixes:
+                instructions += 1
+
+            if stop_opcodes and memory[self.pc] in stop_opcodes:
+                reason = 'opcode'
+                break
+            if self.pc in stop_pcs:
+                reason = 'pc'
+                break
+
+        return reason, 0, instructions
+
+    # Helpers for accessing memory
+
+    def rdPM(self):
+        tmp = self.byteMask & self.memory[self.addrMask & self.pc]
+        self.pc = self.addrMask & (self.pc + 1)
+        return tmp
+
+    def rdDM(self, addr):
+        return self.byteMask & self.memory[addr]
+
+    def wrDM(self, addr, data):
+        self.memory[addr] = self.byteMask & data
+
+    def rwDM(self, addr):
+        pass
+
+
+class TracingMode:
+    """ The methods that MPU._selectVariant() puts in front of those of
+    the M65C02A, or of its functional variant, while dbg is set along with
+    dbgD or dbgE.  Each one prints its trace and defers to the next class
+    for the work.  dbgD traces the fetch and every bus cycle; dbgE traces
+    FORTH NEXT and JMP (abs,I).
+    """
+    __slots__ = ()
+
+    TRACING = True
+    INSTRUMENTED = True
+
+    def step(self):
+        if self.dbg & self.dbgD:
+            self.traceFetch(self.byteMask &
+                            self.memory[self.addrMask & self.pc])
+        return super().step()
+
+    # Print the opcode fetched from the PC and, unless it is a prefix, the
+    # register file it is about to operate on
+
+    def traceFetch(self, instructCode):
+        print('   IR:', '%02X <= mem[%04X] ' \
+              % (instructCode, self.pc), end='')
+        if not self.out.closed:
+            print('   IR:', '%02X <= mem[%04X] ' \
+                  % (instructCode, self.pc), end='', file=self.out)
+
+        if instructCode in self.prefixes:
+            print()
+            if not self.out.closed:
+                print(file=self.out)
+        else:
+            psw  = 'P[%d%d%d%d%d%d%d%d]' % (int((self.p >> 7) & 1), \
+                                            int((self.p >> 6) & 1), \
+                                            int((self.p >> 5) & 1), \
+                                            int((self.p >> 4) & 1), \
+                                            int((self.p >> 3) & 1), \
+                                            int((self.p >> 2) & 1), \
+                                            int((self.p >> 1) & 1), \
+                                            int((self.p >> 0) & 1)   )
+            flgs = 'F[%d%d%d%d%d%d%d%d]' % (int(self.dbgD), \
+                                            int(self.dbgE), \
+                                            int(self.lscx), \
+                                            int(self.oay), \
+                                            int(self.oax), \
+                                            int(self.osx), \
+                                            int(self.ind), \
+                                            int(self.siz)    )                              
+            print('A[%04X,%04X,%04X]' % (self.a[0], self.a[1], self.a[2]),
+                  'X[%04X,%04X,%04X]' % (self.x[0], self.x[1], self.x[2]),
+                  'Y[%04X,%04X,%04X]' % (self.y[0], self.y[1], self.y[2]),
+                  'S[%04X,%04X]' % (self.sp[1], self.sp[0]), 
+                  'I[%04X]' % self.ip,
+                  'W[%04X]' % self.wp,
+                  psw,
+                  flgs )
+            if not self.out.closed:
+                print('A[%04X,%04X,%04X]' % (self.a[0],self.a[1],self.a[2]),
+                      'X[%04X,%04X,%04X]' % (self.x[0],self.x[1],self.x[2]),
+                      'Y[%04X,%04X,%04X]' % (self.y[0],self.y[1],self.y[2]),
+                      'S[%04X,%04X]' % (self.sp[1], self.sp[0]), 
+                      'I[%04X]' % self.ip,
+                      'W[%04X]' % self.wp,
+                      psw,
+                      flgs, file=self.out)
+
+    # Helpers for accessing memory
+
+    def rdPM(self):
+        pc = self.pc
+        tmp = super().rdPM()
+        if self.dbg & self.dbgD:
+            print(' rdPM:', '%02X <= mem[%04X]' % (tmp, pc))
+            if not self.out.closed:
+                print(' rdPM:', '%02X <= mem[%04X]' % (tmp, pc),
+                      file=self.out)
+        return tmp
+
+    def rdDM(self, addr):
+        tmp = super().rdDM(addr)
+        if self.dbg & self.dbgD:
+            print(' rdDM:', '%02X <= mem[%04X]' % (tmp, addr))
+            if not self.out.closed:
+                print(' rdDM:', '%02X <= mem[%04X]' % (tmp, addr),
+                      file=self.out)
+        return tmp
+
+    def wrDM(self, addr, data):
+        if self.dbg & self.dbgD:
+            print(' wrDM:', '%02X => mem[%04X]' % (self.byteMask & data, addr))
+            if not self.out.closed:
+                print(' wrDM:', '%02X => mem[%04X]' % \
+                      (self.byteMask & data, addr), file=self.out)
+        super().wrDM(addr, data)
+
+    def rwDM(self, addr):
+        if self.dbg & self.dbgD:
+            print(' rwDM:', '-- <> mem[%04X]' % (addr))
+            if not self.out.closed:
+                print(' rwDM:', '-- <> mem[%04X]' % (addr), file=self.out)
+        super().rwDM(addr)
+
+    # FORTH VM
+
+    def opNXT(self):
+        super().opNXT()
+        if self.dbg & self.dbgE:
+            self.traceNXT()
+
+    def traceNXT(self):
+        psw  = 'P[%d%d%d%d%d%d%d%d]' % (int((self.p >> 7) & 1), \
+                                        int((self.p >> 6) & 1), \
+                                        int((self.p >> 5) & 1), \
+                                        int((self.p >> 4) & 1), \
+                                        int((self.p >> 3) & 1), \
+                                        int((self.p >> 2) & 1), \
+                                        int((self.p >> 1) & 1), \
+                                        int((self.p >> 0) & 1)   )
+        flgs = 'F[%d%d%d%d%d%d%d%d]' % (int(self.dbgD), \
+                                        int(self.dbgE), \
+                                        int(self.lscx), \
+                                        int(self.oay),  \
+                                        int(self.oax),  \
+                                        int(self.osx),  \
+                                        int(self.ind),  \
+                                        int(self.siz)    )
+        
+        dtStk = []
+        dtPtr = self.sp[1] + 1
+        while dtPtr < 0x200:
+            dtStk.append('%04X' % self.WordAt(dtPtr))
+            dtPtr += 2
+        
+        rsStk = []
+        rsPtr = self.x[0] + 1
+        while rsPtr < 0xA0 and rsPtr >= 0x20:
+            rsStk.append('%04X' % self.WordAt(rsPtr))
+            rsPtr += 2
+            
+        i = self.wp - 4; ch = self.ByteAt(i)
+        while ch < 127:
+            i -= 1; ch = self.ByteAt(i)
+        fn = ''; i += 1; ch = self.ByteAt(i)
+        while ch < 127:
+            if ch == 0: fn += 'X'
+            else: fn += '%c' % ch
+            i += 1; ch = self.ByteAt(i)
+        ch &= 0x7F
+        if ch == 0: fn += 'X'
+        else: fn += '%c' % (ch & 0x7F)
+        
+        if len(fn) > 21:
+            fn = fn[:21]
+        else:
+            fn = fn + ' '*(21 - len(fn))
+        
+        print('='*132,'\n',
+              fn,
+              'A[%04X,%04X,%04X]' % (self.a[0], self.a[1], self.a[2]),
+              'X[%04X,%04X,%04X]' % (self.x[0], self.x[1], self.x[2]),
+              'Y[%04X,%04X,%04X]' % (self.y[0], self.y[1], self.y[2]),
+              'S[%04X,%04X]' % (self.sp[1], self.sp[0]), 
+              'I[%04X]' % (self.ip),
+              'W[%04X]' % (self.wp),
+              psw,
+              flgs,
+              '\n Dat Stk:', dtStk,
+              '\n Rtn Stk:', rsStk,
+              '\n'+'='*132)
+        if not self.out.closed:
+            print('='*132,'\n',
+                  fn,
+                  'A[%04X,%04X,%04X]' % (self.a[0], self.a[1], self.a[2]),
+                  'X[%04X,%04X,%04X]' % (self.x[0], self.x[1], self.x[2]),
+                  'Y[%04X,%04X,%04X]' % (self.y[0], self.y[1], self.y[2]),
+                  'S[%04X,%04X]' % (self.sp[1], self.sp[0]), 
+                  'I[%04X]' % (self.ip),
+                  'W[%04X]' % (self.wp),
+                  psw,
+                  flgs,
+                  '\n Dat Stk:', dtStk,
+                  '\n Rtn Stk:', rsStk,
+                  '\n'+'='*132,
+                  file=self.out)
+
+    # JMP (abs,I) traces before the prefix flags are cleared, so it has
+    # its own entry in a copy of the instruction table
+
+    instruct = MPU.instruct[:]
+
+    def inst_0x6C(self):
+        _, self.pc = self._absI()
+        if self.dbg and self.dbgE:
+            self.traceJMPI()
+        self.clrPrefixFlags()
+
+    instruct[0x6C] = inst_0x6C
+
+    def traceJMPI(self):
+        psw  = 'P[%d%d%d%d%d%d%d%d]' % (int((self.p >> 7) & 1), \
+                                        int((self.p >> 6) & 1), \
+                                        int((self.p >> 5) & 1), \
+                                        int((self.p >> 4) & 1), \
+                                        int((self.p >> 3) & 1), \
+                                        int((self.p >> 2) & 1), \
+                                        int((self.p >> 1) & 1), \
+                                        int((self.p >> 0) & 1)   )
+        flgs = 'F[%d%d%d%d%d%d%d%d]' % (int(self.dbgD), \
+                                        int(self.dbgE), \
+                                        int(self.lscx), \
+                                        int(self.oay), \
+                                        int(self.oax), \
+                                        int(self.osx), \
+                                        int(self.ind), \
+                                        int(self.siz)    )
+        
+        rsStk = []
+        rsPtr = self.sp[1] + 1
+        while rsPtr < 0x200:
+            rsStk.append('%04X' % self.WordAt(rsPtr))
+            rsPtr += 2
+        
+        dtStk = []
+        dtPtr = self.x[0]
+        while dtPtr < 0x9F and dtPtr >= 0x20:
+            dtStk.append('%04X' % self.WordAt(dtPtr))
+            dtPtr += 2
+            
+        ip = self.WordAt(0xB0) - 2
+        wp = self.WordAt(0xB3)
+        
+        i = wp - 4; ch = self.ByteAt(i)
+        while ch < 127:
+            i -= 1; ch = self.ByteAt(i)
+        fn = ''; i += 1; ch = self.ByteAt(i)
+        while ch < 127:
+            if ch == 0: fn += 'X'
+            else: fn += '%c' % ch
+            i += 1; ch = self.ByteAt(i)
+        ch &= 0x7F
+        if ch == 0: fn += 'X'
+        else: fn += '%c' % (ch & 0x7F)
+        
+        if len(fn) > 21:
+            fn = fn[:21]
+        else:
+            fn = fn + ' '*(21 - len(fn))
+        
+        print('='*132,'\n',
+              fn,
+              'A[%04X,%04X,%04X]' % (self.a[0], self.a[1], self.a[2]),
+              'X[%04X,%04X,%04X]' % (self.x[0], self.x[1], self.x[2]),
+              'Y[%04X,%04X,%04X]' % (self.y[0], self.y[1], self.y[2]),
+              'S[%04X,%04X]' % (self.sp[1], self.sp[0]), 
+              'I[%04X]' % ip,
+              'W[%04X]' % wp,
+              psw,
+              flgs,
+              '\n Dat Stk:', dtStk,
+              '\n Rtn Stk:', rsStk,
+              '\n'+'='*132)
+
+        if not self.out.closed:
+            print('='*132,'\n',
+                  fn,
+                  'A[%04X,%04X,%04X]' % (self.a[0], self.a[1], self.a[2]),
+                  'X[%04X,%04X,%04X]' % (self.x[0], self.x[1], self.x[2]),
+                  'Y[%04X,%04X,%04X]' % (self.y[0], self.y[1], self.y[2]),
+                  'S[%04X,%04X]' % (self.sp[1], self.sp[0]), 
+                  'I[%04X]' % ip,
+                  'W[%04X]' % wp,
+                  psw,
+                  flgs,
+                  '\n Dat Stk:', dtStk,
+                  '\n Rtn Stk:', rsStk,
+                  '\n'+'='*132,
+                  file=self.out)
+
+
+class BusTraceMode:
+    """ The methods that MPU._selectVariant() puts in front of the others
+    while a bus trace is enabled.  Each bus cycle is recorded with the
+    cycle count at its start, before deferring to the next class.
+    """
+    __slots__ = ()
+
+    INSTRUMENTED = True
+
+    def step(self):
+        trace = self._busTrace
+        pc = self.pc
+        trace.pc = pc
+        trace.record(self.processorCycles, FETCH, pc,
+                     self.byteMask & self.memory[self.addrMask & pc])
+        return super().step()
+
+    def rdPM(self):
+        cycle = self.processorCycles
+        pc = self.pc
+        tmp = super().rdPM()
+        self._busTrace.record(cycle, PROGRAM, pc, tmp)
+        return tmp
+
+    def rdDM(self, addr):
+        cycle = self.processorCycles
+        tmp = super().rdDM(addr)
+        self._busTrace.record(cycle, READ, addr, tmp)
+        return tmp
+
+    def wrDM(self, addr, data):
+        self._busTrace.record(self.processorCycles, WRITE, addr,
+                              self.byteMask & data)
+        super().wrDM(addr, data)
+
+    def rwDM(self, addr):
+        self._busTrace.record(self.processorCycles, DUMMY, addr, 0)
+        super().rwDM(addr)
+
+
+class OpcodeProfileMode:
+    """ Counts each opcode in the enabled profiler.OpcodeProfile, keyed on
+    the prefix flags in force, before deferring to the next class.
+    """
+    __slots__ = ()
+
+    INSTRUMENTED = True
+
+    def step(self):
+        key = (self.siz | self.ind << 1 | self.osx << 2 | self.oax << 3 |
+               self.oay << 4) << 8
+        key |= self.byteMask & self.memory[self.addrMask & self.pc]
+        self._opcodeProfile.counts[key] += 1
+        return super().step()
+
+
+class AddressProfileMode:
+    """ Adds each instruction or prefix, and the cycles it took, to the
+    enabled profiler.AddressProfile at the address of its opcode.
+    """
+    __slots__ = ()
+
+    INSTRUMENTED = True
+
+    def step(self):
+        pc = self.pc
+        cycles = self.processorCycles
+        super().step()
+        profile = self._addressProfile
+        profile.counts[pc] += 1
+        profile.cycles[pc] += self.processorCycles - cycles
+        return self
+
+
+class CallProfileMode:
+    """ Passes each instruction or prefix to the enabled
+    profiler.CallProfile, which follows the calls and returns.
+    """
+    __slots__ = ()
+
+    INSTRUMENTED = True
+
+    def step(self):
+        pc = self.pc
+        opcode = self.byteMask & self.memory[self.addrMask & pc]
+        cycles = self.processorCycles
+        super().step()
+        self._callProfile.executed(pc, opcode, cycles, self.processorCycles,
+                                   self.pc)
+        return self
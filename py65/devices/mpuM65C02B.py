@@ -1,5 +1,9 @@
+from utils.alu import adc_table, sbc_table
 from utils.conversions import itoa
 from utils.devices import make_instruction_decorator
+from utils.flags import compare_table, nz_table
+from utils.snapshot import (clone_mpu, read_state_file, restore_snapshot,
+                            take_snapshot, write_state_file)
 
 class MPU():
     '''
@@ -81,6 +85,10 @@ class MPU():
         self.addrHighMask = self.hiByteMask
         self.signExtend   = self.hiByteMask
         self.spBase = 1 << self.BYTE_WIDTH
+        self.nzFlags   = nz_table(self.BYTE_WIDTH, self.NEGATIVE, self.ZERO)
+        self.nzFlags16 = nz_table(self.WORD_WIDTH, self.NEGATIVE, self.ZERO)
+        self.cmpFlags  = compare_table(self.BYTE_WIDTH, self.NEGATIVE,
+                                       self.ZERO, self.CARRY)
 
         # vm status
         self.excycles = 0
@@ -222,6 +230,24 @@ class MPU():
         self.instruct[instructCode](self)   # execute instruction
         return self
 
+    # Snapshots - the prefix flags, register stacks, histogram and all of
+    # the cycle counters are captured along with memory
+
+    def snapshot(self):
+        return take_snapshot(self)
+
+    def restore(self, snapshot):
+        restore_snapshot(self, snapshot)
+
+    def clone(self):
+        return clone_mpu(self)
+
+    def save_state(self, path, compress=False):
+        write_state_file(self, path, compress)
+
+    def load_state(self, path):
+        self.restore(read_state_file(self, path))
+
     # Function to clear the Prefix Instruction Flags
     # - used after all non-prefix instructions
 
@@ -1280,13 +1306,11 @@ class MPU():
     # ALU Flags Functions
 
     def FlagsNZ(self, value):
-        self.p &= ~(self.NEGATIVE | self.ZERO)
-        if value == 0:
-            self.p |= self.ZERO
         if self.siz:
-            self.p |= self.NEGATIVE & (value >> 8)
+            flags = self.nzFlags16[value]
         else:
-            self.p |= self.NEGATIVE &  value
+            flags = self.nzFlags[value]
+        self.p = (self.p & ~(self.NEGATIVE | self.ZERO)) | flags
 
 #
 #   Stack operations
@@ -1926,47 +1950,16 @@ class MPU():
 #
 
     def opADC(self, data):
+        reg = self._getAluReg()
+
         if self.siz:
             sign = self.NEGATIVE << 8
             mask = self.wordMask
-        else:
-            sign = self.NEGATIVE
-            mask = self.byteMask
 
-        reg = self._getAluReg()
-        
-        auL = mask & reg
-        auR = mask & data
-        cin = self.CARRY & self.p
+            auL = mask & reg
+            auR = mask & data
+            cin = self.CARRY & self.p
 
-        if self.p & self.DECIMAL and not self.siz:
-            cy3 = 0; cy7 = 0; da0 = 0; da1 = 0
-            loSum = (auL & 0xF) + (auR & 0xF) + cin
-            if loSum > 9:
-                da0 = 6
-                cy3 = 1
-            hiSum = ((auL >> 4) & 0xF) + ((auR >> 4) & 0xF) + cy3
-            if hiSum > 9:
-                da1 = 6
-                cy7 = 1
-
-            # 6502 sets ALU flags using result before decimal adjust
-            # 65C02/M65C02A set ALU flags after decimal adjust
-            # ALU outputs are decimally adjusted
-            
-            loSum = (loSum + da0) & 0xF
-            hiSum = (hiSum + da1) & 0xF
-            sum   = (hiSum << 4) + loSum
-
-            if (~(auL ^ auR) & (auL ^ sum)) & sign:
-                self.p |= self.OVERFLOW
-            if cy7 == 1:
-                self.p |= self.CARRY
-                sum &= mask
-            if sum == 0:
-                self.p |= self.ZERO
-            self.p |= sign & sum
-        else:
             sum = auL + auR + cin
 
             self.p &= ~(self.CARRY | self.ZERO | self.OVERFLOW | self.NEGATIVE)
@@ -1978,57 +1971,35 @@ class MPU():
                 sum &= mask
             if sum == 0:
                 self.p |= self.ZERO
-            if self.siz:
-                self.p |= (sign & sum) >> 8
-            else: self.p |= (sign & sum)
+            self.p |= (sign & sum) >> 8
+        else:
+            mask = self.byteMask
+
+            table = adc_table(self.p & self.CARRY, self.p & self.DECIMAL,
+                              'M65C02A')
+            entry = table[((mask & reg) << 8) | (mask & data)]
+
+            # decimal mode only sets flags, it never clears them
+            if not self.p & self.DECIMAL:
+                self.p &= ~(self.CARRY | self.ZERO | self.OVERFLOW
+                            | self.NEGATIVE)
+            self.p |= entry >> 8
+            sum = entry
 
         reg = mask & sum
         self._putAluReg(reg)
 
     def opSBC(self, data):
+        reg = self._getAluReg()
+
         if self.siz:
             sign = self.NEGATIVE << 8
             mask = self.wordMask
-        else:
-            sign = self.NEGATIVE
-            mask = self.byteMask
 
-        reg = self._getAluReg()
-        
-        auL = mask & reg
-        auR = mask & ~data
-        cin = self.CARRY & self.p
+            auL = mask & reg
+            auR = mask & ~data
+            cin = self.CARRY & self.p
 
-        if self.p & self.DECIMAL and not self.siz:
-            cy3 = 1; cy7 = 0; da0 = 0; da1 = 0
-            loSum = (auL & 0xF) + (auR & 0xF) + cin
-            if loSum <= 15:
-                cy3 = 0
-                da0 = 10
-            hiSum = ((auL >> 4) & 0xF) + ((auR >> 4) & 0xF) + cy3
-            if hiSum <= 15:
-                da1 = 10
-            else: cy7 = 1
-
-            # 6502 sets ALU flags using result before decimal adjust
-            # 65C02/M65C02A set ALU flags after decimal adjust
-            # ALU outputs are decimally adjusted
-            
-            loSum = (loSum + da0) & 0xF
-            hiSum = (hiSum + da1) & 0xF
-            sum   = (hiSum << 4) + loSum
-
-            self.p &= ~(self.CARRY | self.ZERO | self.NEGATIVE | self.OVERFLOW)
-            
-            if (~(auL ^ auR) & (auL ^ sum)) & sign:
-                self.p |= self.OVERFLOW
-            if cy7 == 1:
-                self.p |= self.CARRY
-                sum &= mask
-            if sum == 0:
-                self.p |= self.ZERO
-            self.p |= sign & sum
-        else:
             sum = auL + auR + cin
 
             self.p &= ~(self.CARRY | self.ZERO | self.OVERFLOW | self.NEGATIVE)
@@ -2040,9 +2011,17 @@ class MPU():
                 sum &= mask
             if sum == 0:
                 self.p |= self.ZERO
-            if self.siz:
-                self.p |= (sign & sum) >> 8
-            else: self.p |= (sign & sum)
+            self.p |= (sign & sum) >> 8
+        else:
+            mask = self.byteMask
+
+            table = sbc_table(self.p & self.CARRY, self.p & self.DECIMAL,
+                              'M65C02A')
+            entry = table[((mask & reg) << 8) | (mask & data)]
+
+            self.p &= ~(self.CARRY | self.ZERO | self.OVERFLOW | self.NEGATIVE)
+            self.p |= entry >> 8
+            sum = entry
 
         reg = mask & sum
 
@@ -2204,30 +2183,27 @@ class MPU():
         if self.siz:
             mask = self.wordMask
             sign = self.NEGATIVE << 8
-        else:
-            mask = self.byteMask
-            sign = self.NEGATIVE
-
-        auL = mask & regVal
-        auR = mask & (~memVal)
 
-        sum = auL + auR + 1
+            auL = mask & regVal
+            auR = mask & (~memVal)
 
-        self.p &= ~(self.CARRY | self.ZERO | self.NEGATIVE)
+            sum = auL + auR + 1
 
-        if sum > mask:
-            self.p |= self.CARRY
-        if (mask & sum) == 0:
-            self.p |= self.ZERO
-
-        if self.siz:
+            flags = self.nzFlags16[mask & sum]
+            if sum > mask:
+                flags |= self.CARRY
             if (~(auL ^ auR) & (auL ^ sum)) & sign:
-                self.p |= self.OVERFLOW
-            else:
-                self.p &= ~self.OVERFLOW
-            self.p |= (sign & sum) >> 8
+                flags |= self.OVERFLOW
+
+            self.p &= ~(self.CARRY | self.ZERO | self.NEGATIVE | self.OVERFLOW)
         else:
-            self.p |= (sign & sum)
+            mask = self.byteMask
+
+            flags = self.cmpFlags[((mask & regVal) << self.BYTE_WIDTH)
+                                  | (mask & memVal)]
+
+            self.p &= ~(self.CARRY | self.ZERO | self.NEGATIVE)
+        self.p |= flags
 
     def opCMP(self, memVal):
         if self.oax:
@@ -0,0 +1,196 @@
+"""Run many independent machine jobs over a pool of worker processes.
+
+A Job names an MPU type from Monitor.Microprocessors and gives a memory
+image, a start PC, the bytes that getc will return and the conditions
+under which the run stops.  run_jobs() fans the jobs out over a
+concurrent.futures.ProcessPoolExecutor and yields a Result for each one
+as it finishes:
+
+    jobs = [Job('6502', image, pc=0x0200, input=line,
+                stop_opcodes=[0x00], regions=[(0x0300, 0x03ff)])
+            for line in lines]
+    for result in run_jobs(jobs):
+        print(result.index, result.reason, result.output)
+
+Small jobs are sent to the workers in chunks, so that the cost of
+shipping a job to another process does not swamp the job itself.
+"""
+
+import os
+import sys
+
+sys.path.append(os.getcwd())
+
+import time
+import traceback
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from memory import ObservableMemory
+from monitor import Monitor
+
+# the cycles run between checks of a job's timeout
+TIMESLICE = 100000
+
+
+class Job:
+    """One machine run.  image is loaded at address before the run starts
+    at pc; getc reads successive bytes of input, then zeros.  The stop
+    conditions have the same meaning as for MPU.run(), and timeout is in
+    seconds of wall clock time.  regions is a list of (start, end)
+    address pairs, inclusive, whose contents are returned in the Result.
+    """
+
+    def __init__(self, mpu='6502', image=(), address=0x0000, pc=0x0000,
+                 input=b'', max_cycles=None, max_instructions=None,
+                 stop_pcs=(), stop_opcodes=(), regions=(), timeout=None,
+                 putc_addr=0xF001, getc_addr=0xF004):
+        self.mpu = mpu
+        self.image = image
+        self.address = address
+        self.pc = pc
+        self.input = input
+        self.max_cycles = max_cycles
+        self.max_instructions = max_instructions
+        self.stop_pcs = stop_pcs
+        self.stop_opcodes = stop_opcodes
+        self.regions = regions
+        self.timeout = timeout
+        self.putc_addr = putc_addr
+        self.getc_addr = getc_addr
+
+
+class Result:
+    """The outcome of a Job.  index is the job's position in the list
+    given to run_jobs().  reason is one of the MPU.run() reasons,
+    'timeout', or 'error', in which case error holds the traceback.
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self.reason = None
+        self.error = None
+        self.cycles = 0
+        self.instructions = 0
+        self.registers = {}
+        self.state = ''
+        self.output = ''
+        self.regions = {}
+        self.elapsed = 0.0
+
+    def __repr__(self):
+        return "<Result %d: %s, %d cycles, %d instructions>" % (
+            self.index, self.reason, self.cycles, self.instructions)
+
+
+def run_job(job, index=0):
+    """ Run one job in this process and return its Result.
+    """
+    result = Result(index)
+    start = time.perf_counter()
+    try:
+        _run(job, result, start)
+    except Exception:
+        result.reason = 'error'
+        result.error = traceback.format_exc()
+    result.elapsed = time.perf_counter() - start
+    return result
+
+
+def _run(job, result, start):
+    klass = Monitor.Microprocessors[job.mpu]
+    if klass.ADDR_WIDTH > 16:
+        memory = 0x40000 * [0x00]
+    else:
+        memory = 0x10000 * [0x00]
+    mpu = klass(memory=memory, pc=job.pc)
+    memory[job.address:job.address + len(job.image)] = list(job.image)
+    mpu.pc = job.pc
+
+    output = []
+    input = list(bytearray(job.input))
+    input.reverse()
+
+    def putc(address, value):
+        output.append(chr(value))
+
+    def getc(address):
+        if input:
+            return input.pop()
+        return 0
+
+    m = ObservableMemory(subject=memory, addrWidth=klass.ADDR_WIDTH)
+    m.subscribe_to_write([job.putc_addr], putc)
+    m.subscribe_to_read([job.getc_addr], getc)
+    mpu.memory = m
+
+    if job.timeout is None:
+        deadline = None
+    else:
+        deadline = start + job.timeout
+
+    # run in timeslices so that the deadline can be checked
+    while True:
+        budget = TIMESLICE
+        if job.max_cycles is not None:
+            budget = min(budget, job.max_cycles - result.cycles)
+        if job.max_instructions is None:
+            remaining = None
+        else:
+            remaining = job.max_instructions - result.instructions
+        reason, cycles, instructions = mpu.run(
+            max_cycles=budget, max_instructions=remaining,
+            stop_pcs=job.stop_pcs, stop_opcodes=job.stop_opcodes)
+        result.cycles += cycles
+        result.instructions += instructions
+        if reason != 'cycles':
+            break
+        if job.max_cycles is not None and result.cycles >= job.max_cycles:
+            break
+        if job.max_cycles is None and getattr(mpu, 'waiting', False):
+            reason = 'waiting'
+            break
+        if deadline is not None and time.perf_counter() >= deadline:
+            reason = 'timeout'
+            break
+
+    result.reason = reason
+    for name in ('pc', 'a', 'x', 'y', 'sp', 'p'):
+        value = getattr(mpu, name)
+        if isinstance(value, list):
+            value = value[:]
+        result.registers[name] = value
+    result.state = repr(mpu)
+    result.output = ''.join(output)
+    for start_address, end_address in job.regions:
+        result.regions[start_address, end_address] = \
+            memory[start_address:end_address + 1]
+
+
+def _run_chunk(jobs):
+    return [run_job(job, index) for index, job in jobs]
+
+
+def run_jobs(jobs, workers=None, chunksize=None):
+    """ Run the jobs on a pool of worker processes (os.cpu_count() of them
+    by default) and yield each Result as it finishes, which need not be
+    in job order.  Jobs are sent in chunks of chunksize; by default the
+    jobs are split into about four chunks per worker.  With workers=0
+    the jobs run one after another in this process.
+    """
+    jobs = list(enumerate(jobs))
+    if workers == 0:
+        for index, job in jobs:
+            yield run_job(job, index)
+        return
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if chunksize is None:
+        chunksize = max(1, len(jobs) // (workers * 4))
+    chunks = [jobs[n:n + chunksize] for n in range(0, len(jobs), chunksize)]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_run_chunk, chunk) for chunk in chunks]
+        for future in as_completed(futures):
+            for result in future.result():
+                yield result
@@ -0,0 +1,291 @@
+from array import array
+from collections import deque
+from operator import attrgetter
+
+from memory import ObservableMemory
+from utils.snapshot import register_names
+
+
+class Segment:
+    """A run of recorded instructions.  Entry n executed at pcs[n].  Its
+    undo records start at reg_starts[n], as (register slot, old value)
+    pairs in reg_slots and reg_values, and at write_starts[n], as
+    (address, old value) pairs in write_addresses and write_values.
+    """
+
+    def __init__(self, base):
+        self.base = base                # number of the first entry
+        self.pcs = array('L')
+        self.reg_starts = array('L')
+        self.reg_slots = array('H')
+        self.reg_values = array('q')
+        self.write_starts = array('L')
+        self.write_addresses = array('L')
+        self.write_values = array('q')
+
+    def __len__(self):
+        return len(self.pcs)
+
+
+class History:
+    """Record execution so that it can be run backwards.  Each step()
+    notes the PC, the old value of every register the instruction changed
+    and the old value of every memory cell it wrote.  The records live in
+    a bounded ring of compact array segments, so the oldest instructions
+    are forgotten once capacity is reached.  A full snapshot of the
+    machine is also taken every interval cycles.
+
+    step_back() and reverse_continue() undo recorded instructions.
+    seek() restores the nearest snapshot at or before a cycle and runs
+    forward from it, so devices are read again on the way.
+
+    Memory writes are seen through ObservableMemory, which the MPU's
+    memory is wrapped in if need be.
+    """
+
+    SEGMENT = 4096
+
+    def __init__(self, mpu, capacity=1000000, interval=100000,
+                 checkpoints=32):
+        if not isinstance(mpu.memory, ObservableMemory):
+            mpu.memory = ObservableMemory(subject=mpu.memory,
+                                          addrWidth=mpu.ADDR_WIDTH)
+        self.mpu = mpu
+        self.capacity = capacity
+        self.interval = interval
+        self.checkpoints = deque(maxlen=checkpoints)  # (cycles, entry, state)
+
+        self._memory = mpu.memory
+        self._segments = [Segment(0)]
+        self._count = 0               # entries recorded, including dropped
+        self._recording = False
+        self._current = None
+
+        # the register file, flattened into a vector of ints
+        self._scalars = []
+        self._lists = []
+        for name in register_names(mpu):
+            value = getattr(mpu, name, None)
+            if isinstance(value, (bool, int)):
+                self._scalars.append(name)
+            elif (isinstance(value, list) and
+                  all([isinstance(item, int) for item in value])):
+                self._lists.append(name)
+        self._kinds = [type(getattr(mpu, name)) for name in self._scalars]
+        self._get_scalars = attrgetter(*self._scalars)
+
+        address_range = range(self._memory.physMask + 1)
+        self._memory.subscribe_to_write(address_range, self._record_write)
+        self._checkpoint()
+
+    def __len__(self):
+        """ Return the number of instructions that can be undone.
+        """
+        return self._count - self._segments[0].base
+
+    # Recording
+
+    def _registers(self):
+        vector = list(self._get_scalars(self.mpu))
+        for name in self._lists:
+            vector.extend(getattr(self.mpu, name))
+        return vector
+
+    def _record_write(self, address, value):
+        if self._recording:
+            segment = self._current
+            segment.write_addresses.append(address)
+            segment.write_values.append(self._memory.subject[address])
+
+    def _checkpoint(self):
+        self.checkpoints.append((self.mpu.processorCycles, self._count,
+                                 self.mpu.snapshot()))
+
+    def step(self):
+        """ Execute and record one instruction.
+        """
+        mpu = self.mpu
+        if mpu.processorCycles - self.checkpoints[-1][0] >= self.interval:
+            self._checkpoint()
+
+        segment = self._segments[-1]
+        if len(segment) == self.SEGMENT:
+            segment = Segment(self._count)
+            self._segments.append(segment)
+            if len(self) > self.capacity:
+                del self._segments[0]
+
+        before = self._registers()
+        segment.pcs.append(mpu.pc)
+        segment.write_starts.append(len(segment.write_addresses))
+        self._current = segment
+        self._recording = True
+        try:
+            mpu.step()
+        finally:
+            self._recording = False
+
+        after = self._registers()
+        segment.reg_starts.append(len(segment.reg_slots))
+        for slot in range(len(before)):
+            if before[slot] != after[slot]:
+                segment.reg_slots.append(slot)
+                segment.reg_values.append(before[slot])
+        self._count += 1
+        return mpu
+
+    def run(self, max_cycles=None, max_instructions=None,
+            stop_pcs=(), stop_opcodes=()):
+        """ Record instructions until a stop condition is met, with the same
+        arguments and result as MPU.run().
+        """
+        mpu = self.mpu
+        memory = self._memory
+        stop_pcs = frozenset(stop_pcs)
+        stop_opcodes = frozenset(stop_opcodes)
+
+        start_cycles = mpu.processorCycles
+        if max_cycles is None:
+            cycle_limit = None
+        else:
+            cycle_limit = start_cycles + max_cycles
+        instructions = 0
+
+        while True:
+            if cycle_limit is not None and mpu.processorCycles >= cycle_limit:
+                reason = 'cycles'
+                break
+            if instructions == max_instructions:
+                reason = 'instructions'
+                break
+
+            self.step()
+            instructions += 1
+
+            if stop_opcodes and memory[mpu.pc] in stop_opcodes:
+                reason = 'opcode'
+                break
+            if mpu.pc in stop_pcs:
+                reason = 'pc'
+                break
+
+        return reason, mpu.processorCycles - start_cycles, instructions
+
+    # Going backwards
+
+    def step_back(self, count=1):
+        """ Undo up to count instructions and return how many were undone.
+        """
+        undone = 0
+        while undone < count and len(self):
+            self._undo()
+            undone += 1
+        if undone:
+            self._forget_code()
+        return undone
+
+    def reverse_continue(self, stop_pcs=()):
+        """ Undo instructions until the PC is in stop_pcs, after undoing at
+        least one, or history runs out.  Returns a tuple of (reason,
+        instructions) where reason is 'pc' or 'start'.
+        """
+        stop_pcs = frozenset(stop_pcs)
+        undone = 0
+        reason = 'start'
+        while len(self):
+            self._undo()
+            undone += 1
+            if self.mpu.pc in stop_pcs:
+                reason = 'pc'
+                break
+        if undone:
+            self._forget_code()
+        return reason, undone
+
+    def seek(self, cycle):
+        """ Restore the latest snapshot taken at or before cycle and run
+        forward until the cycle count reaches it.  Returns False, having
+        changed nothing, if no such snapshot is left.
+        """
+        mpu = self.mpu
+        if getattr(mpu, 'FUNCTIONAL', False):
+            raise ValueError("seek needs the cycle counts of the accurate mode")
+        if cycle < mpu.processorCycles:
+            earlier = [checkpoint for checkpoint in self.checkpoints
+                       if checkpoint[0] <= cycle]
+            if not earlier:
+                return False
+            while self.checkpoints[-1] is not earlier[-1]:
+                self.checkpoints.pop()
+            cycles, entry, state = earlier[-1]
+            self._truncate(entry)
+            mpu.restore(state)
+        while mpu.processorCycles < cycle:
+            self.step()
+        return True
+
+    def _undo(self):
+        self._pop(restore=True)
+        # checkpoints after the new present can no longer be reached
+        while self.checkpoints and self.checkpoints[-1][1] > self._count:
+            self.checkpoints.pop()
+        if not self.checkpoints:
+            self._checkpoint()
+
+    def _pop(self, restore):
+        # drop the newest entry, putting back what it changed if restore
+        segment = self._segments[-1]
+        if not len(segment):
+            self._segments.pop()
+            segment = self._segments[-1]
+        n = len(segment) - 1
+
+        start = segment.reg_starts[n]
+        if restore:
+            for index in range(len(segment.reg_slots) - 1, start - 1, -1):
+                self._set_register(segment.reg_slots[index],
+                                   segment.reg_values[index])
+        del segment.reg_slots[start:]
+        del segment.reg_values[start:]
+
+        start = segment.write_starts[n]
+        if restore:
+            for index in range(len(segment.write_addresses) - 1,
+                               start - 1, -1):
+                self._memory.write(segment.write_addresses[index],
+                                   [segment.write_values[index]])
+        del segment.write_addresses[start:]
+        del segment.write_values[start:]
+
+        del segment.pcs[n]
+        del segment.reg_starts[n]
+        del segment.write_starts[n]
+        self._count -= 1
+
+    def _set_register(self, slot, value):
+        if slot < len(self._scalars):
+            setattr(self.mpu, self._scalars[slot], self._kinds[slot](value))
+            return
+        slot -= len(self._scalars)
+        for name in self._lists:
+            registers = getattr(self.mpu, name)
+            if slot < len(registers):
+                registers[slot] = value
+                return
+            slot -= len(registers)
+
+    def _truncate(self, count):
+        while self._count > count and len(self):
+            self._pop(restore=False)
+        self._count = count
+        if not len(self):
+            self._segments = [Segment(count)]
+
+    def _forget_code(self):
+        # undone writes bypass the subscribers, so drop cached decodes
+        decoded = getattr(self.mpu, '_decoded', None)
+        if decoded:
+            decoded.clear()
+        translator = getattr(self.mpu, '_translator', None)
+        if translator is not None:
+            translator.flush()
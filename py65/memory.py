@@ -54,6 +54,28 @@ class ObservableMemory:
     def __getattr__(self, attribute):
         return getattr(self._subject, attribute)
 
+    @property
+    def subject(self):
+        return self._subject
+
+    def copy(self, owners=()):
+        """ Return an ObservableMemory over a copy of the subject, with the
+        same read and write subscribers except those that are methods of
+        any of the owners.
+        """
+        other = ObservableMemory(subject=self._subject[:])
+        other.physMask = self.physMask
+        for mine, theirs in ((self._read_subscribers,
+                              other._read_subscribers),
+                             (self._write_subscribers,
+                              other._write_subscribers)):
+            for address, callbacks in mine.items():
+                kept = [callback for callback in callbacks
+                        if getattr(callback, '__self__', None) not in owners]
+                if kept:
+                    theirs[address] = kept
+        return other
+
     def subscribe_to_write(self, address_range, callback):
         for address in address_range:
             address &= self.physMask
@@ -25,15 +25,19 @@ import re
 import shlex
 
 from asyncore import compact_traceback
+from bustrace import BusTrace
 from devices.mpu6502 import MPU as NMOS6502
 from devices.mpu65c02 import MPU as CMOS65C02
 from devices.mpu65org16 import MPU as V65Org16
 from devices.mpuM65C02A import MPU as M65C02A
 from disassembler import Disassembler
+from history import History
+from profiler import AddressProfile, CallProfile, address_report, call_report
 from assembler import Assembler
 from utils.addressing import AddressParser
 from utils import console
 from utils.conversions import itoa
+from utils.snapshot import read_state_header
 from memory import ObservableMemory
 
 try:
@@ -41,6 +45,10 @@ try:
 except ImportError: # Python 3
     from urllib.request import urlopen
 
+# records held between writes of a bus trace
+BUS_TRACE_CHUNK = 1 << 20
+
+
 class Monitor(cmd.Cmd):
 
     Microprocessors = {'6502': NMOS6502, '65C02': CMOS65C02,
@@ -162,6 +170,13 @@ class Monitor(cmd.Cmd):
 
     def _reset(self, mpu_type, getc_addr=0xF004, putc_addr=0xF001):
         self._mpu = mpu_type(memory=self.memory)
+        self._history = None
+        if getattr(self, '_bus_trace', None) is not None:
+            self._bus_trace.close()
+        self._bus_trace = None
+        self._opcode_profile = None
+        self._address_profile = None
+        self._call_profile = None
         self.addrWidth = self._mpu.ADDR_WIDTH
         self.byteWidth = self._mpu.BYTE_WIDTH
         self.addrFmt = self._mpu.ADDR_FORMAT
@@ -188,7 +203,7 @@ class Monitor(cmd.Cmd):
                            '>':    'fill',
                            'g':    'goto',
                            'h':    'help',
-#                           'hi':   'histogram',
+                           'hi':   'histogram',
                            '?':    'help',
                            'l':    'load',
                            'm':    'mem',
@@ -292,7 +307,8 @@ class Monitor(cmd.Cmd):
         self._output("reset\t\tReset the microprocessor")
 
     def do_reset(self, args):
-        klass = self._mpu.__class__
+        # the plain class, not a functional or tracing variant of it
+        klass = getattr(self._mpu, 'base_class', self._mpu.__class__)
         self._reset(mpu_type=klass)
 
     def do_mpu(self, args):
@@ -457,7 +473,152 @@ class Monitor(cmd.Cmd):
         self._output("Single-step through instructions.")
 
     def do_step(self, args):
-        self._mpu.step()
+        if self._history is None:
+            self._mpu.step()
+        else:
+            self._history.step()
+        self.do_disassemble(self.addrFmt % self._mpu.pc)
+
+    def help_mode(self):
+        self._output("mode [accurate|functional]")
+        self._output("Select the execution mode.  The functional mode keeps")
+        self._output("no cycle counts, for runs where only the results")
+        self._output("matter; switch back at a breakpoint to count cycles")
+        self._output("again.  With no argument, show the current mode.")
+
+    def do_mode(self, args):
+        if args == 'functional':
+            if self._history is not None:
+                self._output("History needs the accurate mode")
+                return
+            self._mpu.enable_functional_mode()
+        elif args == 'accurate':
+            self._mpu.disable_functional_mode()
+        elif args != '':
+            return self.help_mode()
+
+        if self._mpu.FUNCTIONAL:
+            self._output("Mode is functional")
+        else:
+            self._output("Mode is accurate")
+
+    def help_bus_trace(self):
+        self._output("bus_trace [<filename>|off]")
+        self._output("Record every bus cycle of the M65C02A to a file, for")
+        self._output("py65bustrace to render as text, until turned off.")
+        self._output("With no argument, show the number of cycles recorded.")
+
+    def do_bus_trace(self, args):
+        if not hasattr(self._mpu, 'enable_bus_trace'):
+            self._output("The %s has no bus trace" % self._mpu.name)
+            return
+        if args == 'off':
+            if self._bus_trace is not None:
+                self._mpu.disable_bus_trace()
+                self._bus_trace.close()
+                self._bus_trace = None
+        elif args != '':
+            if self._bus_trace is not None:
+                self._mpu.disable_bus_trace()
+                self._bus_trace.close()
+            try:
+                self._bus_trace = BusTrace(args, size=BUS_TRACE_CHUNK)
+            except IOError as exc:
+                self._bus_trace = None
+                self._output("Cannot open %s: %s" % (args, exc))
+                return
+            self._mpu.enable_bus_trace(self._bus_trace)
+
+        trace = self._bus_trace
+        if trace is None:
+            self._output("Bus trace is off")
+        else:
+            self._output("Bus trace to %s holds %d cycles" % (trace.path,
+                                                              trace.count))
+
+    def help_history(self):
+        self._output("history [on|off]")
+        self._output("Record execution so that it can be stepped backwards.")
+        self._output("While recording, the cycle counters are not reset by")
+        self._output("goto and return.  With no argument, show what is held.")
+
+    def do_history(self, args):
+        if args == 'on':
+            if self._mpu.FUNCTIONAL:
+                self._output("History needs the accurate mode")
+                return
+            if self._history is None:
+                self._history = History(self._mpu)
+        elif args == 'off':
+            self._history = None
+        elif args != '':
+            return self.help_history()
+
+        history = self._history
+        if history is None:
+            self._output("History is off")
+            return
+        cycles = [checkpoint[0] for checkpoint in history.checkpoints]
+        self._output("History holds %d instructions, checkpoints from "
+                     "cycle %d to %d" % (len(history), cycles[0], cycles[-1]))
+
+    def help_step_back(self):
+        self._output("step_back [count]")
+        self._output("Undo the last instruction, or a decimal count of")
+        self._output("instructions, while history is on.")
+
+    def do_step_back(self, args):
+        if self._history is None:
+            self._output("History is off")
+            return
+        try:
+            count = int(args or '1')
+        except ValueError:
+            self._output("Syntax error: %s" % args)
+            return
+        undone = self._history.step_back(count)
+        if undone < count:
+            self._output("Reached the start of history")
+        self.do_disassemble(self.addrFmt % self._mpu.pc)
+
+    def help_reverse_continue(self):
+        self._output("reverse_continue")
+        self._output("Run backwards to the previous breakpoint, or to the")
+        self._output("start of history.")
+
+    def do_reverse_continue(self, args):
+        if self._history is None:
+            self._output("History is off")
+            return
+        reason, undone = self._history.reverse_continue(self._breakpoints)
+        if reason == 'pc':
+            msg = "Breakpoint %d reached."
+            self._output(msg % self._breakpoints.index(self._mpu.pc))
+        else:
+            self._output("Reached the start of history")
+        self.do_disassemble(self.addrFmt % self._mpu.pc)
+
+    def help_seek(self):
+        self._output("seek <cycle>")
+        self._output("Go to the first instruction boundary at or after the")
+        self._output("decimal cycle count, replaying from the nearest")
+        self._output("earlier checkpoint.")
+
+    def do_seek(self, args):
+        if args == '':
+            return self.help_seek()
+        if self._history is None:
+            self._output("History is off")
+            return
+        try:
+            cycle = int(args)
+        except ValueError:
+            self._output("Syntax error: %s" % args)
+            return
+        if not self._history.seek(cycle):
+            self._output("Cycle %d is before the start of history" % cycle)
+            return
+        self._output("Cycle %d" % self._mpu.processorCycles)
         self.do_disassemble(self.addrFmt % self._mpu.pc)
 
     def help_return(self):
@@ -479,46 +640,50 @@ class Monitor(cmd.Cmd):
 
         self._mpu.pc = self._address_parser.number(args)
         brks = [0x00]  # BRK
-        self._mpu.dbg = True
-        self._mpu.out = open(os.getcwd()+'/trace.txt', 'at')
+        # only the M65C02A traces, and the slotted 6502s have no room for it
+        tracing = hasattr(self._mpu, 'dbg')
+        if tracing:
+            self._mpu.dbg = True
+            self._mpu.out = open(os.getcwd()+'/trace.txt', 'at')
+        if self._address_profile is not None:
+            self._mpu.enable_address_profile(self._address_profile)
+        if self._call_profile is not None:
+            self._mpu.enable_call_profile(self._call_profile)
         self._run(stopcodes=brks)
-        self._mpu.out.close()
-        self._mpu.dbg = False
+        if self._address_profile is not None:
+            self._mpu.disable_address_profile()
+        if self._call_profile is not None:
+            self._mpu.disable_call_profile()
+        if tracing:
+            self._mpu.out.close()
+            self._mpu.dbg = False
 
     def _run(self, stopcodes):
         stopcodes = set(stopcodes)
         breakpoints = set(self._breakpoints)
         mpu = self._mpu
-        mem = self._mpu.memory
         
         # vm status
         
-        self._mpu.excycles = 0
-        self._mpu.addcycles = False
-        self._mpu.processorCycles = 0
-        self._mpu.numInstructions = 0
-        self._mpu.pgmMemRdCycles  = 0
-        self._mpu.datMemRdCycles  = 0
-        self._mpu.datMemWrCycles  = 0
-        self._mpu.dummyCycles     = 0
-        
-        #for i in range(256): self._mpu.histogram[i] = 0
-
-        if not breakpoints:
-            while True:
-                mpu.step()
-                if mem[mpu.pc] in stopcodes:
-                    break
+        if self._history is None:
+            self._mpu.excycles = 0
+            self._mpu.addcycles = False
+            self._mpu.processorCycles = 0
+            # the bus cycle counters are kept by the M65C02A alone
+            for name in ('numInstructions', 'pgmMemRdCycles',
+                         'datMemRdCycles', 'datMemWrCycles', 'dummyCycles'):
+                if hasattr(self._mpu, name):
+                    setattr(self._mpu, name, 0)
+            runner = mpu
         else:
-            while True:
-                mpu.step()
-                pc = mpu.pc
-                if mem[pc] in stopcodes:
-                    break
-                if pc in breakpoints:
-                    msg = "Breakpoint %d reached."
-                    self._output(msg % self._breakpoints.index(pc))
-                    break
+            # seek needs cycle counts that only go up
+            runner = self._history
+
+        reason, cycles, instructions = runner.run(stop_pcs=breakpoints,
+                                                  stop_opcodes=stopcodes)
+        if reason == 'pc':
+            msg = "Breakpoint %d reached."
+            self._output(msg % self._breakpoints.index(mpu.pc))
 
     def help_radix(self):
         self._output("radix [H|D|O|B]")
@@ -817,6 +982,60 @@ class Monitor(cmd.Cmd):
 
         self._output("Saved +%d bytes to %s" % (len(mem), filename))
 
+    def help_save_state(self):
+        self._output("save_state \"filename\" [compress]")
+        self._output("Save the registers, cycle counters and all of memory,")
+        self._output("optionally compressed, for load_state to resume later.")
+
+    def do_save_state(self, args):
+        split = shlex.split(args)
+        if len(split) not in (1, 2) or split[1:] not in ([], ['compress']):
+            self._output("Syntax error: %s" % args)
+            return
+
+        filename = split[0]
+        try:
+            self._mpu.save_state(filename, compress=len(split) == 2)
+        except (OSError, IOError) as exc:
+            msg = "Cannot save state: [%d] %s" % (exc.errno, exc.strerror)
+            self._output(msg)
+            return
+
+        self._output("Saved %s state to %s" % (self._mpu.name, filename))
+
+    def help_load_state(self):
+        self._output("load_state \"filename\"")
+        self._output("Resume from a file written by save_state, switching")
+        self._output("to the saved microprocessor if necessary.")
+
+    def do_load_state(self, args):
+        split = shlex.split(args)
+        if len(split) != 1:
+            self._output("Syntax error: %s" % args)
+            return
+
+        filename = split[0]
+        try:
+            name = read_state_header(filename)['name']
+            klass = self._get_mpu(name)
+            if klass is None:
+                self._output("Unknown MPU: %s" % name)
+                return
+            if klass is not self._mpu.__class__:
+                self._reset(klass, self.getc_addr, self.putc_addr)
+            self._mpu.load_state(filename)
+            self._history = None
+        except (OSError, IOError) as exc:
+            msg = "Cannot load state: [%d] %s" % (exc.errno, exc.strerror)
+            self._output(msg)
+            return
+        except ValueError as exc:
+            self._output("Cannot load state: %s" % exc)
+            return
+
+        self._output("Loaded %s state from %s" % (self._mpu.name, filename))
+        self._output_mpu_status()
+
     def help_fill(self):
         self._output("fill <address_range> <data_list>")
         self._output("Fill memory in the address range with the data in")
@@ -1003,28 +1222,198 @@ class Monitor(cmd.Cmd):
         self._output("show_breakpoints")
         self._output("Lists the currently assigned breakpoints")
         
-##    def help_histogram(self):
-##        self._output("histogram")
-##        self._output("Displays the histogram of the instructions executed"+
-##                     " in previous run")
-##        
-##    def do_histogram(self, args):
-##        self._output("Instruction Histogram:")
-##        for i in range(16):
-##            outString = str()
-##            instructCount = int()
-##            for j in range(15):
-##                instructCount = self._mpu.histogram[(i << 4) + j]
-##                if instructCount > 99999:
-##                    outString += "*****, "
-##                else: outString += "%5d, " % instructCount
-##            instructCount = self._mpu.histogram[(i << 4) + 15]
-##            if instructCount > 99999:
-##                outString += "*****, "
-##            else: outString += "%5d, " % instructCount
-##            
-##            self._output(outString)
-        
+    def help_histogram(self):
+        self._output("histogram [on|off|show|reset]")
+        self._output("histogram export <filename> [csv|json]")
+        self._output("Count the opcodes executed while on; the M65C02A")
+        self._output("counts are also kept by prefix.  show prints the")
+        self._output("counts by opcode and by addressing mode, and export")
+        self._output("writes every count, as JSON if the filename ends")
+        self._output("in .json.  With no argument, show.")
+
+    def do_histogram(self, args):
+        split = shlex.split(args)
+        if not split:
+            split = ['show']
+        command = split[0]
+
+        if command == 'on':
+            if self._opcode_profile is None:
+                self._opcode_profile = self._mpu.enable_opcode_profile()
+            return self._output("Histogram is on")
+        if command == 'off':
+            if self._opcode_profile is not None:
+                self._mpu.disable_opcode_profile()
+            return self._output("Histogram is off")
+
+        profile = self._opcode_profile
+        if command not in ('show', 'reset', 'export') or \
+           (command == 'export') != (len(split) in (2, 3)):
+            return self.help_histogram()
+        if profile is None:
+            return self._output("Histogram is off")
+
+        if command == 'reset':
+            profile.reset()
+        elif command == 'export':
+            filename = split[1]
+            if len(split) == 3:
+                kind = split[2].lower()
+            elif filename.lower().endswith('.json'):
+                kind = 'json'
+            else:
+                kind = 'csv'
+            if kind not in ('csv', 'json'):
+                return self.help_histogram()
+            try:
+                f = open(filename, 'w')
+                try:
+                    if kind == 'json':
+                        profile.write_json(f)
+                    else:
+                        profile.write_csv(f)
+                finally:
+                    f.close()
+            except (IOError, OSError) as exc:
+                return self._output("Cannot write %s: %s" % (filename, exc))
+            self._output("Wrote %d opcodes to %s" % (len(profile.rows()),
+                                                     filename))
+        else:
+            self._show_histogram(profile)
+
+    def _show_histogram(self, profile):
+        self._output("Instruction Histogram: %d executed" % profile.total())
+        counts = profile.opcodes()
+        self._output("    " + "".join(["%7X" % j for j in range(16)]))
+        for i in range(16):
+            row = counts[i << 4:(i << 4) + 16]
+            cells = []
+            for count in row:
+                if count > 999999:
+                    cells.append(" ******")
+                else:
+                    cells.append("%7d" % count)
+            self._output("%X_: " % i + "".join(cells))
+        modes = profile.modes()
+        if modes:
+            self._output("Addressing modes:")
+        for mode, prefixes, count in modes:
+            if prefixes:
+                mode = "%s (%s)" % (mode, prefixes)
+            self._output("  %-20s %d" % (mode, count))
+
+
+    def help_profile(self):
+        self._output("profile [on|off|reset|show [<count>]]")
+        self._output("Count the instructions executed at each address, and")
+        self._output("the cycles they take, during every goto while on.")
+        self._output("show prints the <count> hottest addresses and address")
+        self._output("ranges, 10 by default.  With no argument, show.")
+
+    def do_profile(self, args):
+        split = shlex.split(args)
+        if not split:
+            split = ['show']
+        command = split[0]
+
+        if command == 'on':
+            if self._address_profile is None:
+                self._address_profile = AddressProfile(self._mpu)
+            return self._output("Profile is on")
+        if command == 'off':
+            self._address_profile = None
+            return self._output("Profile is off")
+
+        if command not in ('show', 'reset') or len(split) > 2 or \
+           (command == 'reset' and len(split) > 1):
+            return self.help_profile()
+        profile = self._address_profile
+        if profile is None:
+            return self._output("Profile is off")
+
+        if command == 'reset':
+            return profile.reset()
+        top = 10
+        if len(split) == 2:
+            try:
+                top = int(split[1])
+            except ValueError:
+                return self._output("Invalid count: %s" % split[1])
+        for line in address_report(profile, self._disassembler,
+                                   self._address_parser, top):
+            self._output(line)
+
+
+    def help_callgraph(self):
+        self._output("callgraph [on|off|reset|show [<count>]]")
+        self._output("callgraph export <filename> [callgrind|folded]")
+        self._output("Charge the cycles of every goto while on to the")
+        self._output("subroutines that ran them, following JSR/RTS and")
+        self._output("BRK/RTI.  show prints the <count> costliest routines,")
+        self._output("all by default.  export writes a callgrind file, or")
+        self._output("folded stacks for flame graphs if the filename ends in")
+        self._output(".folded.  Routines are named by their labels.")
+
+    def do_callgraph(self, args):
+        split = shlex.split(args)
+        if not split:
+            split = ['show']
+        command = split[0]
+
+        if command == 'on':
+            if self._call_profile is None:
+                self._call_profile = CallProfile(self._mpu)
+            return self._output("Call graph is on")
+        if command == 'off':
+            self._call_profile = None
+            return self._output("Call graph is off")
+
+        if (command == 'export' and len(split) not in (2, 3)) or \
+           (command == 'show' and len(split) > 2) or \
+           (command == 'reset' and len(split) > 1) or \
+           command not in ('show', 'reset', 'export'):
+            return self.help_callgraph()
+        profile = self._call_profile
+        if profile is None:
+            return self._output("Call graph is off")
+
+        if command == 'reset':
+            return profile.reset()
+        if command == 'show':
+            top = None
+            if len(split) == 2:
+                try:
+                    top = int(split[1])
+                except ValueError:
+                    return self._output("Invalid count: %s" % split[1])
+            for line in call_report(profile, self._address_parser, top):
+                self._output(line)
+            return
+
+        filename = split[1]
+        if len(split) == 3:
+            kind = split[2].lower()
+        elif filename.lower().endswith('.folded'):
+            kind = 'folded'
+        else:
+            kind = 'callgrind'
+        if kind not in ('callgrind', 'folded'):
+            return self.help_callgraph()
+        try:
+            f = open(filename, 'w')
+            try:
+                if kind == 'folded':
+                    profile.write_folded(f, self._address_parser)
+                else:
+                    profile.write_callgrind(f, self._address_parser)
+            finally:
+                f.close()
+        except (IOError, OSError) as exc:
+            return self._output("Cannot write %s: %s" % (filename, exc))
+        self._output("Wrote %d routines to %s" % (len(profile.exclusive),
+                                                  filename))
+
+
 def main(args=None):
     c = Monitor()
 
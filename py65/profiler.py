@@ -0,0 +1,445 @@
+"""Profiles of what an MPU executes.
+
+An OpcodeProfile counts the opcodes an MPU executes while it is
+enabled on the MPU:
+
+    profile = mpu.enable_opcode_profile()
+    mpu.run(stop_opcodes=[0x00])
+    for row in profile.rows():
+        print(row)
+
+On the M65C02A each count is also keyed on the prefixes in force when
+the opcode was fetched, so that the cost of a prefix can be weighed
+against how often it is used.  Counts by addressing mode are summed
+from the opcode counts when asked for, since the mode is fixed by the
+opcode.
+
+An AddressProfile counts the instructions executed at each address and
+the cycles they took, so that the hot loops of a program can be found:
+
+    profile = mpu.enable_address_profile()
+    mpu.run(stop_opcodes=[0x00])
+    for line in address_report(profile, Disassembler(mpu)):
+        print(line)
+
+The counts are arrays covering the address space, other than on the
+65Org16, whose 32-bit address space is counted in dictionaries.
+
+A CallProfile follows JSR/RTS and BRK/RTI pairs on a shadow call stack
+and charges the cycles of every instruction to the subroutine running
+it, giving the exclusive and inclusive cost of each subroutine, the
+cost of each call from one to another and the cost of each stack, which
+can be written for callgrind tools or as folded stacks for flame graphs:
+
+    profile = mpu.enable_call_profile()
+    mpu.run(stop_opcodes=[0x00])
+    with open('callgrind.out', 'w') as f:
+        profile.write_callgrind(f)
+"""
+
+import csv
+import json
+
+from array import array
+from collections import defaultdict
+
+# address spaces wider than this are counted sparsely
+DENSE_WIDTH = 20
+
+# the M65C02A prefix flags, in the bit order of the profile keys
+PREFIX_FLAGS = ('siz', 'ind', 'osx', 'oax', 'oay')
+
+
+def prefix_names(bits):
+    """ Return the prefix flags set in bits as a string like 'SIZ+IND'.
+    """
+    return '+'.join([flag.upper() for n, flag in enumerate(PREFIX_FLAGS)
+                     if bits & (1 << n)])
+
+
+class OpcodeProfile:
+    """Counts of executed opcodes in an array.  Without prefixes the
+    array is indexed by opcode; with them, by the prefix bits shifted
+    left by eight plus the opcode.
+    """
+
+    def __init__(self, mpu):
+        self.name = mpu.name
+        self.disassemble = mpu.disassemble
+        self.prefixed = hasattr(mpu, 'prefixes')
+        if self.prefixed:
+            size = 256 << len(PREFIX_FLAGS)
+        else:
+            size = 256
+        self.counts = array('Q', bytes(8 * size))
+
+    def reset(self):
+        for n in range(len(self.counts)):
+            self.counts[n] = 0
+
+    def total(self):
+        return sum(self.counts)
+
+    def opcodes(self):
+        """ Return a list of the 256 opcode counts, whatever the prefixes.
+        """
+        totals = [0] * 256
+        for key, count in enumerate(self.counts):
+            if count:
+                totals[key & 0xFF] += count
+        return totals
+
+    def rows(self):
+        """ Return (opcode, mnemonic, mode, prefixes, count) for each
+        count that is not zero, most frequent first.
+        """
+        rows = []
+        for key, count in enumerate(self.counts):
+            if count:
+                opcode = key & 0xFF
+                mnemonic, mode = self.disassemble[opcode]
+                rows.append((opcode, mnemonic, mode, prefix_names(key >> 8),
+                             count))
+        rows.sort(key=lambda row: (-row[4], row[3], row[0]))
+        return rows
+
+    def modes(self):
+        """ Return (mode, prefixes, count) for each addressing mode and
+        prefix combination executed, most frequent first.
+        """
+        totals = {}
+        for opcode, mnemonic, mode, prefixes, count in self.rows():
+            totals[mode, prefixes] = totals.get((mode, prefixes), 0) + count
+        modes = [(mode, prefixes, count)
+                 for (mode, prefixes), count in totals.items()]
+        modes.sort(key=lambda row: (-row[2], row[1], row[0]))
+        return modes
+
+    # Export
+
+    def write_csv(self, f):
+        writer = csv.writer(f)
+        writer.writerow(['opcode', 'mnemonic', 'mode', 'prefixes', 'count'])
+        for opcode, mnemonic, mode, prefixes, count in self.rows():
+            writer.writerow(['%02X' % opcode, mnemonic, mode, prefixes, count])
+
+    def write_json(self, f):
+        opcodes = [{'opcode': opcode, 'mnemonic': mnemonic, 'mode': mode,
+                    'prefixes': prefixes, 'count': count}
+                   for opcode, mnemonic, mode, prefixes, count in self.rows()]
+        modes = [{'mode': mode, 'prefixes': prefixes, 'count': count}
+                 for mode, prefixes, count in self.modes()]
+        json.dump({'mpu': self.name, 'total': self.total(),
+                   'opcodes': opcodes, 'modes': modes}, f, indent=1)
+
+
+class AddressProfile:
+    """Counts of the instructions executed at each address and of the
+    cycles they took, indexed by the address of the opcode.  An M65C02A
+    prefix counts as an instruction at its own address.
+    """
+
+    def __init__(self, mpu):
+        self.name = mpu.name
+        self.addr_format = mpu.ADDR_FORMAT
+        self.dense = mpu.ADDR_WIDTH <= DENSE_WIDTH
+        self.size = 1 << mpu.ADDR_WIDTH
+        self.reset()
+
+    def reset(self):
+        if self.dense:
+            empty = bytes(8 * self.size)
+            self.counts = array('Q', empty)
+            self.cycles = array('Q', empty)
+        else:
+            self.counts = defaultdict(int)
+            self.cycles = defaultdict(int)
+
+    def addresses(self):
+        """ Return (address, count, cycles) for each address executed, in
+        address order.
+        """
+        counts, cycles = self.counts, self.cycles
+        if self.dense:
+            return [(address, count, cycles[address])
+                    for address, count in enumerate(counts) if count]
+        return [(address, counts[address], cycles[address])
+                for address in sorted(counts) if counts[address]]
+
+    def total(self):
+        if self.dense:
+            return sum(self.counts)
+        return sum(self.counts.values())
+
+    def total_cycles(self):
+        if self.dense:
+            return sum(self.cycles)
+        return sum(self.cycles.values())
+
+    def hottest(self, n=None):
+        """ Return the n addresses that took the most cycles, or were
+        executed most often when no cycles were counted, as (address,
+        count, cycles) tuples.
+        """
+        rows = self.addresses()
+        rows.sort(key=lambda row: (-row[2], -row[1], row[0]))
+        return rows[:n]
+
+    def ranges(self, n=None, gap=3):
+        """ Return the n hottest address ranges as (start, end, count,
+        cycles) tuples, where end is the last address executed.  A range
+        runs on while the next address executed is no more than gap bytes
+        on, the length of the longest 6502 instruction.
+        """
+        ranges = []
+        for address, count, cycles in self.addresses():
+            if ranges and address - ranges[-1][1] <= gap:
+                start, end, total, total_cycles = ranges[-1]
+                ranges[-1] = (start, address, total + count,
+                              total_cycles + cycles)
+            else:
+                ranges.append((address, address, count, cycles))
+        ranges.sort(key=lambda row: (-row[3], -row[2], row[0]))
+        return ranges[:n]
+
+
+def address_report(profile, disassembler, address_parser=None, top=10):
+    """ Return the lines of a report on the top hottest addresses and
+    address ranges of an AddressProfile, naming addresses with the labels
+    of address_parser and disassembling each hot instruction.
+    """
+    def name(address):
+        if address_parser is None:
+            return ''
+        return address_parser.label_for(address, '')
+
+    fmt = profile.addr_format
+    width = len(fmt % 0)
+    total = profile.total()
+    total_cycles = profile.total_cycles()
+
+    def share(count, cycles):
+        if total_cycles:
+            return 100.0 * cycles / total_cycles
+        if total:
+            return 100.0 * count / total
+        return 0.0
+
+    lines = ['Address profile: %d instructions, %d cycles' %
+             (total, total_cycles)]
+    lines.append('Hottest addresses:')
+    lines.append('  %-*s %10s %10s %6s  %-12s %s' %
+                 (width + 1, 'addr', 'count', 'cycles', '%', 'label',
+                  'instruction'))
+    for address, count, cycles in profile.hottest(top):
+        length, text = disassembler.instruction_at(address)
+        lines.append('  $%s %10d %10d %6.2f  %-12s %s' %
+                     (fmt % address, count, cycles, share(count, cycles),
+                      name(address), text))
+    lines.append('Hottest ranges:')
+    lines.append('  %-*s %10s %10s %6s  %s' %
+                 (2 * width + 3, 'range', 'count', 'cycles', '%', 'label'))
+    for start, end, count, cycles in profile.ranges(top):
+        lines.append('  $%s-$%s %10d %10d %6.2f  %s' %
+                     (fmt % start, fmt % end, count, cycles,
+                      share(count, cycles), name(start)))
+    return [line.rstrip() for line in lines]
+
+
+# the instructions that call and return, with the length of the calls
+CALLS = {'JSR': 3, 'BRK': 2}
+RETURNS = ('RTS', 'RTI')
+
+
+class CallProfile:
+    """Cycles charged to subroutines by following calls and returns on a
+    shadow call stack.  A routine is named by its entry address; the code
+    running before the first call belongs to the root, the address the
+    profile started at.  A return goes back to the frame whose return
+    address it reaches, so that a routine which drops its return address
+    or returns on behalf of its caller unwinds the stack as far as it
+    went.  A routine that recurses has its inclusive cost counted once,
+    from its outermost call.
+    """
+
+    def __init__(self, mpu):
+        self.name = mpu.name
+        self.addr_format = mpu.ADDR_FORMAT
+        # per opcode, the length of a call, -1 for a return or None
+        self._kinds = []
+        for mnemonic, mode in mpu.disassemble:
+            if mnemonic in CALLS:
+                self._kinds.append(CALLS[mnemonic])
+            elif mnemonic in RETURNS:
+                self._kinds.append(-1)
+            else:
+                self._kinds.append(None)
+        self.reset()
+
+    def reset(self):
+        self.root = None
+        self.now = 0                    # cycle count after the last step
+        self.exclusive = defaultdict(int)
+        self.calls = defaultdict(int)
+        self.stacks = defaultdict(int)  # routine path -> exclusive cycles
+        self._inclusive = defaultdict(int)
+        self._edges = defaultdict(int)  # (caller, callee) -> inclusive
+        self._edge_calls = defaultdict(int)
+        self._active = defaultdict(int)
+        # (routine, return address, entry cycles, path)
+        self._frames = []
+
+    def executed(self, pc, opcode, start, end, next_pc):
+        """ Charge the instruction at pc, which ran from cycle start to
+        cycle end and went on to next_pc, to the running routine, and
+        follow it if it called or returned.
+        """
+        frames = self._frames
+        if frames:
+            path = frames[-1][3]
+        else:
+            if self.root is None:
+                self.root = pc
+            path = (self.root,)
+        cycles = end - start
+        self.exclusive[path[-1]] += cycles
+        self.stacks[path] += cycles
+        self.now = end
+
+        kind = self._kinds[opcode]
+        if kind is None:
+            return
+        if kind > 0:
+            self._enter(path, next_pc, pc + kind, end)
+        elif frames:
+            returns = [frame[1] for frame in frames]
+            if next_pc in returns:
+                depth = len(frames) - returns[::-1].index(next_pc) - 1
+            else:
+                depth = len(frames) - 1
+            while len(frames) > depth:
+                self._leave(end)
+
+    def _enter(self, path, routine, return_address, cycles):
+        caller = path[-1]
+        self.calls[routine] += 1
+        self._edge_calls[caller, routine] += 1
+        self._active[routine] += 1
+        self._active[caller, routine] += 1
+        self._frames.append((routine, return_address, cycles,
+                             path + (routine,)))
+
+    def _leave(self, cycles):
+        routine, return_address, entry, path = self._frames.pop()
+        caller = path[-2]
+        for key, costs in ((routine, self._inclusive),
+                           ((caller, routine), self._edges)):
+            self._active[key] -= 1
+            if not self._active[key]:
+                costs[key] += cycles - entry
+
+    def _open_costs(self):
+        # the cycles of the calls still in progress, outermost first
+        inclusive = defaultdict(int, self._inclusive)
+        edges = defaultdict(int, self._edges)
+        seen = set()
+        for routine, return_address, entry, path in self._frames:
+            for key, costs in ((routine, inclusive),
+                               ((path[-2], routine), edges)):
+                if key not in seen:
+                    seen.add(key)
+                    costs[key] += self.now - entry
+        return inclusive, edges
+
+    def inclusive(self):
+        """ Return a dictionary of the inclusive cycles of each routine,
+        counting the calls still in progress up to now.
+        """
+        inclusive = self._open_costs()[0]
+        if self.root is not None:
+            inclusive[self.root] = sum(self.exclusive.values())
+        return inclusive
+
+    def rows(self):
+        """ Return (routine, calls, exclusive, inclusive) for each routine,
+        the most exclusive cycles first.
+        """
+        inclusive = self.inclusive()
+        rows = [(routine, self.calls[routine], cycles, inclusive[routine])
+                for routine, cycles in self.exclusive.items()]
+        rows.sort(key=lambda row: (-row[2], -row[3], row[0]))
+        return rows
+
+    def edges(self):
+        """ Return (caller, callee, calls, inclusive) for each caller and
+        routine it called.
+        """
+        edges = self._open_costs()[1]
+        return sorted([(caller, callee, calls, edges[caller, callee])
+                       for (caller, callee), calls in
+                       self._edge_calls.items()])
+
+    # Export
+
+    def routine_name(self, routine, address_parser=None):
+        """ Return the label of a routine, or its address.
+        """
+        name = None
+        if address_parser is not None:
+            name = address_parser.label_for(routine)
+        if name is None:
+            name = '$' + self.addr_format % routine
+        return name
+
+    def write_callgrind(self, f, address_parser=None):
+        """ Write the profile in the callgrind format, with each routine
+        as a function whose position is its entry address.
+        """
+        f.write('# callgrind format\n')
+        f.write('version: 1\n')
+        f.write('creator: py65\n')
+        f.write('cmd: %s\n' % self.name)
+        f.write('positions: instr\n')
+        f.write('events: Cycles\n')
+        f.write('summary: %d\n' % sum(self.exclusive.values()))
+        calls = defaultdict(list)
+        for caller, callee, count, cycles in self.edges():
+            calls[caller].append((callee, count, cycles))
+        for routine in sorted(self.exclusive):
+            f.write('\nfn=%s\n' % self.routine_name(routine, address_parser))
+            f.write('0x%X %d\n' % (routine, self.exclusive[routine]))
+            for callee, count, cycles in calls[routine]:
+                f.write('cfn=%s\n' %
+                        self.routine_name(callee, address_parser))
+                f.write('calls=%d 0x%X\n' % (count, callee))
+                f.write('0x%X %d\n' % (routine, cycles))
+
+    def write_folded(self, f, address_parser=None):
+        """ Write the exclusive cycles of each call stack as folded stacks,
+        the input of flamegraph.pl and its kin.
+        """
+        for path in sorted(self.stacks):
+            cycles = self.stacks[path]
+            if cycles:
+                names = [self.routine_name(routine, address_parser)
+                         for routine in path]
+                f.write('%s %d\n' % (';'.join(names), cycles))
+
+
+def call_report(profile, address_parser=None, top=None):
+    """ Return the lines of a table of the routines of a CallProfile that
+    cost the most cycles, by exclusive cost.
+    """
+    total = sum(profile.exclusive.values())
+    lines = ['Call profile: %d cycles' % total]
+    lines.append('  %-16s %10s %12s %7s %12s %7s' %
+                 ('routine', 'calls', 'exclusive', '%', 'inclusive', '%'))
+    for routine, calls, exclusive, inclusive in profile.rows()[:top]:
+        if total:
+            shares = (100.0 * exclusive / total, 100.0 * inclusive / total)
+        else:
+            shares = (0.0, 0.0)
+        lines.append('  %-16s %10d %12d %7.2f %12d %7.2f' %
+                     (profile.routine_name(routine, address_parser), calls,
+                      exclusive, shares[0], inclusive, shares[1]))
+    return lines
@@ -0,0 +1,349 @@
+import random
+import unittest
+import os
+import sys
+
+sys.path.append(os.getcwd())
+
+from devices import mpu6502, mpuM65C02A
+from utils.alu import adc_table, sbc_table
+
+
+# Reference implementations: the nibble-by-nibble arithmetic the tables
+# replace, as it was in mpu6502.MPU and mpuM65C02A.MPU
+
+def reference_6502_ADC(mpu, data):
+    if mpu.p & mpu.DECIMAL:
+        halfcarry = 0
+        decimalcarry = 0
+        adjust0 = 0
+        adjust1 = 0
+        nibble0 = (data & 0xf) + (mpu.a & 0xf) + (mpu.p & mpu.CARRY)
+        if nibble0 > 9:
+            adjust0 = 6
+            halfcarry = 1
+        nibble1 = ((data >> 4) & 0xf) + ((mpu.a >> 4) & 0xf) + halfcarry
+        if nibble1 > 9:
+            adjust1 = 6
+            decimalcarry = 1
+
+        # the ALU outputs are not decimally adjusted
+        nibble0 = nibble0 & 0xf
+        nibble1 = nibble1 & 0xf
+        aluresult = (nibble1 << 4) + nibble0
+
+        # the final A contents will be decimally adjusted
+        nibble0 = (nibble0 + adjust0) & 0xf
+        nibble1 = (nibble1 + adjust1) & 0xf
+        mpu.p &= ~(mpu.CARRY | mpu.OVERFLOW | mpu.NEGATIVE | mpu.ZERO)
+        if aluresult == 0:
+            mpu.p |= mpu.ZERO
+        else:
+            mpu.p |= aluresult & mpu.NEGATIVE
+        if decimalcarry == 1:
+            mpu.p |= mpu.CARRY
+        if (~(mpu.a ^ data) & (mpu.a ^ aluresult)) & mpu.NEGATIVE:
+            mpu.p |= mpu.OVERFLOW
+        mpu.a = (nibble1 << 4) + nibble0
+    else:
+        if mpu.p & mpu.CARRY:
+            tmp = 1
+        else:
+            tmp = 0
+        result = data + mpu.a + tmp
+        mpu.p &= ~(mpu.CARRY | mpu.OVERFLOW | mpu.NEGATIVE | mpu.ZERO)
+        if (~(mpu.a ^ data) & (mpu.a ^ result)) & mpu.NEGATIVE:
+            mpu.p |= mpu.OVERFLOW
+        data = result
+        if data > mpu.byteMask:
+            mpu.p |= mpu.CARRY
+            data &= mpu.byteMask
+        if data == 0:
+            mpu.p |= mpu.ZERO
+        else:
+            mpu.p |= data & mpu.NEGATIVE
+        mpu.a = data
+
+def reference_6502_SBC(mpu, data):
+    if mpu.p & mpu.DECIMAL:
+        halfcarry = 1
+        decimalcarry = 0
+        adjust0 = 0
+        adjust1 = 0
+
+        nibble0 = (mpu.a & 0xf) + (~data & 0xf) + (mpu.p & mpu.CARRY)
+        if nibble0 <= 0xf:
+            halfcarry = 0
+            adjust0 = 10
+        nibble1 = ((mpu.a >> 4) & 0xf) + ((~data >> 4) & 0xf) + halfcarry
+        if nibble1 <= 0xf:
+            adjust1 = 10 << 4
+
+        # the ALU outputs are not decimally adjusted
+        aluresult = mpu.a + (~data & mpu.byteMask) + \
+            (mpu.p & mpu.CARRY)
+
+        if aluresult > mpu.byteMask:
+            decimalcarry = 1
+        aluresult &= mpu.byteMask
+
+        # but the final result will be adjusted
+        nibble0 = (aluresult + adjust0) & 0xf
+        nibble1 = ((aluresult + adjust1) >> 4) & 0xf
+
+        mpu.p &= ~(mpu.CARRY | mpu.ZERO | mpu.NEGATIVE | mpu.OVERFLOW)
+        if aluresult == 0:
+            mpu.p |= mpu.ZERO
+        else:
+            mpu.p |= aluresult & mpu.NEGATIVE
+        if decimalcarry == 1:
+            mpu.p |= mpu.CARRY
+        if ((mpu.a ^ data) & (mpu.a ^ aluresult)) & mpu.NEGATIVE:
+            mpu.p |= mpu.OVERFLOW
+        mpu.a = (nibble1 << 4) + nibble0
+    else:
+        result = mpu.a + (~data & mpu.byteMask) + (mpu.p & mpu.CARRY)
+        mpu.p &= ~(mpu.CARRY | mpu.ZERO | mpu.OVERFLOW | mpu.NEGATIVE)
+        if ((mpu.a ^ data) & (mpu.a ^ result)) & mpu.NEGATIVE:
+            mpu.p |= mpu.OVERFLOW
+        data = result & mpu.byteMask
+        if data == 0:
+            mpu.p |= mpu.ZERO
+        if result > mpu.byteMask:
+            mpu.p |= mpu.CARRY
+        mpu.p |= data & mpu.NEGATIVE
+        mpu.a = data
+
+
+def reference_M65C02A_ADC(mpu, data):
+    if mpu.siz:
+        sign = mpu.NEGATIVE << 8
+        mask = mpu.wordMask
+    else:
+        sign = mpu.NEGATIVE
+        mask = mpu.byteMask
+
+    reg = mpu._getAluReg()
+
+    auL = mask & reg
+    auR = mask & data
+    cin = mpu.CARRY & mpu.p
+
+    if mpu.p & mpu.DECIMAL and not mpu.siz:
+        cy3 = 0; cy7 = 0; da0 = 0; da1 = 0
+        loSum = (auL & 0xF) + (auR & 0xF) + cin
+        if loSum > 9:
+            da0 = 6
+            cy3 = 1
+        hiSum = ((auL >> 4) & 0xF) + ((auR >> 4) & 0xF) + cy3
+        if hiSum > 9:
+            da1 = 6
+            cy7 = 1
+
+        # 6502 sets ALU flags using result before decimal adjust
+        # 65C02/M65C02A set ALU flags after decimal adjust
+        # ALU outputs are decimally adjusted
+
+        loSum = (loSum + da0) & 0xF
+        hiSum = (hiSum + da1) & 0xF
+        sum   = (hiSum << 4) + loSum
+
+        if (~(auL ^ auR) & (auL ^ sum)) & sign:
+            mpu.p |= mpu.OVERFLOW
+        if cy7 == 1:
+            mpu.p |= mpu.CARRY
+            sum &= mask
+        if sum == 0:
+            mpu.p |= mpu.ZERO
+        mpu.p |= sign & sum
+    else:
+        sum = auL + auR + cin
+
+        mpu.p &= ~(mpu.CARRY | mpu.ZERO | mpu.OVERFLOW | mpu.NEGATIVE)
+
+        if (~(auL ^ auR) & (auL ^ sum)) & sign:
+            mpu.p |= mpu.OVERFLOW
+        if sum > mask:
+            mpu.p |= mpu.CARRY
+            sum &= mask
+        if sum == 0:
+            mpu.p |= mpu.ZERO
+        if mpu.siz:
+            mpu.p |= (sign & sum) >> 8
+        else: mpu.p |= (sign & sum)
+
+    reg = mask & sum
+    mpu._putAluReg(reg)
+
+def reference_M65C02A_SBC(mpu, data):
+    if mpu.siz:
+        sign = mpu.NEGATIVE << 8
+        mask = mpu.wordMask
+    else:
+        sign = mpu.NEGATIVE
+        mask = mpu.byteMask
+
+    reg = mpu._getAluReg()
+
+    auL = mask & reg
+    auR = mask & ~data
+    cin = mpu.CARRY & mpu.p
+
+    if mpu.p & mpu.DECIMAL and not mpu.siz:
+        cy3 = 1; cy7 = 0; da0 = 0; da1 = 0
+        loSum = (auL & 0xF) + (auR & 0xF) + cin
+        if loSum <= 15:
+            cy3 = 0
+            da0 = 10
+        hiSum = ((auL >> 4) & 0xF) + ((auR >> 4) & 0xF) + cy3
+        if hiSum <= 15:
+            da1 = 10
+        else: cy7 = 1
+
+        # 6502 sets ALU flags using result before decimal adjust
+        # 65C02/M65C02A set ALU flags after decimal adjust
+        # ALU outputs are decimally adjusted
+
+        loSum = (loSum + da0) & 0xF
+        hiSum = (hiSum + da1) & 0xF
+        sum   = (hiSum << 4) + loSum
+
+        mpu.p &= ~(mpu.CARRY | mpu.ZERO | mpu.NEGATIVE | mpu.OVERFLOW)
+
+        if (~(auL ^ auR) & (auL ^ sum)) & sign:
+            mpu.p |= mpu.OVERFLOW
+        if cy7 == 1:
+            mpu.p |= mpu.CARRY
+            sum &= mask
+        if sum == 0:
+            mpu.p |= mpu.ZERO
+        mpu.p |= sign & sum
+    else:
+        sum = auL + auR + cin
+
+        mpu.p &= ~(mpu.CARRY | mpu.ZERO | mpu.OVERFLOW | mpu.NEGATIVE)
+
+        if (~(auL ^ auR) & (auL ^ sum)) & sign:
+            mpu.p |= mpu.OVERFLOW
+        if sum > mask:
+            mpu.p |= mpu.CARRY
+            sum &= mask
+        if sum == 0:
+            mpu.p |= mpu.ZERO
+        if mpu.siz:
+            mpu.p |= (sign & sum) >> 8
+        else: mpu.p |= (sign & sum)
+
+    reg = mask & sum
+
+    mpu._putAluReg(reg)
+
+
+class AluTableTests(unittest.TestCase):
+
+    # tables
+
+    def test_tables_are_built_once_and_shared(self):
+        self.assertTrue(adc_table(1, 8) is adc_table(True, True))
+        self.assertTrue(sbc_table(0, 0) is sbc_table(0, 0, 'M65C02A'))
+        self.assertFalse(adc_table(0, 8) is adc_table(0, 8, 'M65C02A'))
+        self.assertEqual(0x10000, len(adc_table(0, 0)))
+
+    def test_decimal_adc_entry(self):
+        # 0x19 + 0x01 = 0x20 in BCD
+        entry = adc_table(0, 8)[(0x19 << 8) | 0x01]
+        self.assertEqual(0x20, entry & 0xff)
+        self.assertEqual(0, entry >> 8)
+
+    # 6502
+
+    def test_6502_ADC_matches_reference(self):
+        self._assertMatches(mpu6502.MPU(), 'opADC', reference_6502_ADC)
+
+    def test_6502_SBC_matches_reference(self):
+        self._assertMatches(mpu6502.MPU(), 'opSBC', reference_6502_SBC)
+
+    # M65C02A
+
+    def test_M65C02A_ADC_matches_reference(self):
+        self._assertMatches(mpuM65C02A.MPU(), 'opADC',
+                            reference_M65C02A_ADC)
+
+    def test_M65C02A_SBC_matches_reference(self):
+        self._assertMatches(mpuM65C02A.MPU(), 'opSBC',
+                            reference_M65C02A_SBC)
+
+    def test_M65C02A_ADC_siz_matches_reference(self):
+        mpu = mpuM65C02A.MPU()
+        mpu.siz = True
+        self._assertMatches(mpu, 'opADC', reference_M65C02A_ADC, 0xFFFF)
+
+    def test_M65C02A_SBC_siz_matches_reference(self):
+        mpu = mpuM65C02A.MPU()
+        mpu.siz = True
+        self._assertMatches(mpu, 'opSBC', reference_M65C02A_SBC, 0xFFFF)
+
+    def test_M65C02A_decimal_ADC_does_not_clear_flags(self):
+        mpu = mpuM65C02A.MPU()
+        mpu.p = mpu.DECIMAL | mpu.ZERO | mpu.NEGATIVE | mpu.OVERFLOW
+        mpu.a[0] = 0x01
+        mpu.opADC(0x01)
+        self.assertEqual(0x02, mpu.a[0])
+        self.assertEqual(mpu.DECIMAL | mpu.ZERO | mpu.NEGATIVE |
+                         mpu.OVERFLOW, mpu.p)
+
+    # Test Helpers
+
+    def _assertMatches(self, mpu, method, reference, mask=0xFF):
+        """ Run the MPU's operation and the reference on every pair of
+        8-bit operands (a random sample for 16-bit ones) and each carry,
+        decimal and prior flag setting.
+        """
+        if mask == 0xFF:
+            pairs = [(a, b) for a in range(256) for b in range(256)]
+        else:
+            rng = random.Random(mask)
+            pairs = [(rng.randrange(mask + 1), rng.randrange(mask + 1))
+                     for _ in range(2048)]
+        states = [0, mpu.CARRY, mpu.DECIMAL, mpu.CARRY | mpu.DECIMAL,
+                  mpu.CARRY | mpu.DECIMAL | mpu.ZERO | mpu.NEGATIVE |
+                  mpu.OVERFLOW]
+        operation = getattr(mpu, method)
+        if isinstance(mpu, mpu6502.MPU):
+            # the 6502 operations take an addressing mode
+            operation = self._fromZeroPage(mpu, operation)
+        for p in states:
+            for a, b in pairs:
+                self._setA(mpu, a)
+                mpu.p = p
+                operation(b)
+                actual = (self._getA(mpu), mpu.p)
+                self._setA(mpu, a)
+                mpu.p = p
+                reference(mpu, b)
+                expected = (self._getA(mpu), mpu.p)
+                self.assertEqual(expected, actual, '%x %x %x' % (a, b, p))
+
+    def _fromZeroPage(self, mpu, operation):
+        def fromZeroPage(data):
+            mpu.memory[0x0010] = data
+            operation(lambda: 0x0010)
+        return fromZeroPage
+
+    def _getA(self, mpu):
+        if isinstance(mpu, mpuM65C02A.MPU):
+            return mpu.a[0]
+        return mpu.a
+
+    def _setA(self, mpu, value):
+        if isinstance(mpu, mpuM65C02A.MPU):
+            mpu.a[0] = value
+        else:
+            mpu.a = value
+
+
+def test_suite():
+    return unittest.findTestCases(sys.modules[__name__])
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
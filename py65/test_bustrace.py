@@ -0,0 +1,109 @@
+import tempfile
+import unittest
+import os
+import sys
+
+sys.path.append(os.getcwd())
+
+from contextlib import redirect_stdout
+from io import StringIO
+from bustrace import (BusTrace, FETCH, PROGRAM, READ, WRITE, decode, main,
+                      read_records)
+from devices.mpuM65C02A import MPU
+
+# $0200 LDA $10
+# $0202 STA $11
+# $0204 BRK
+PROGRAM_BYTES = (0xA5, 0x10, 0x85, 0x11, 0x00)
+
+
+class BusTraceTests(unittest.TestCase):
+
+    def test_ring_keeps_latest_records(self):
+        trace = BusTrace(size=4)
+        for n in range(6):
+            trace.record(n, READ, 0x1000 + n, n)
+        self.assertEqual(6, trace.count)
+        self.assertEqual([2, 3, 4, 5], [r[0] for r in trace.records()])
+
+    def test_mpu_records_bus_cycles(self):
+        mpu = self._make_mpu()
+        mpu.memory[0x10] = 0x42
+        trace = BusTrace()
+        mpu.enable_bus_trace(trace)
+        mpu.run(max_instructions=2)
+        self.assertEqual([(0, FETCH, 0x200, 0xA5, 0x200),
+                          (1, PROGRAM, 0x201, 0x10, 0x200),
+                          (2, READ, 0x10, 0x42, 0x200),
+                          (3, FETCH, 0x202, 0x85, 0x202),
+                          (4, PROGRAM, 0x203, 0x11, 0x202),
+                          (5, WRITE, 0x11, 0x42, 0x202)],
+                         trace.records())
+        mpu.disable_bus_trace()
+        self.assertTrue(type(mpu) is MPU)
+        mpu.step()
+        self.assertEqual(6, trace.count)
+
+    def test_file_decodes_to_the_dbgD_trace(self):
+        traced = self._make_mpu()
+        traced.out = StringIO()
+        traced.dbg = traced.dbgD = True
+        with redirect_stdout(StringIO()):
+            traced.run(max_instructions=2)
+        expected = []
+        for line in traced.out.getvalue().splitlines():
+            if line.startswith('   IR:'):
+                # the registers that follow the fetch are not recorded
+                line = line[:len('   IR: A5 <= mem[0200] ')]
+            expected.append(line)
+
+        mpu = self._make_mpu()
+        filename = tempfile.mktemp()
+        try:
+            trace = BusTrace(filename, size=4)
+            mpu.enable_bus_trace(trace)
+            mpu.run(max_instructions=2)
+            trace.close()
+            self.assertEqual(6, len(list(read_records(filename))))
+            out = StringIO()
+            decode(filename, out)
+        finally:
+            os.unlink(filename)
+        self.assertEqual(expected, out.getvalue().splitlines())
+
+    def test_main_rejects_other_files(self):
+        filename = tempfile.mktemp()
+        try:
+            with open(filename, 'wb') as f:
+                f.write(b'not a trace')
+            stderr = StringIO()
+            saved, sys.stderr = sys.stderr, stderr
+            try:
+                self.assertEqual(1, main([filename]))
+                self.assertEqual(1, main([]))
+            finally:
+                sys.stderr = saved
+        finally:
+            os.unlink(filename)
+        self.assertTrue('is not a bus trace' in stderr.getvalue())
+
+    def test_snapshot_and_clone_leave_the_trace_behind(self):
+        mpu = self._make_mpu()
+        mpu.enable_bus_trace(BusTrace())
+        twin = mpu.clone()
+        self.assertFalse(twin.INSTRUMENTED)
+        self.assertFalse('_busTrace' in mpu.snapshot().registers)
+
+    # Test Helpers
+
+    def _make_mpu(self):
+        mpu = MPU()
+        mpu.memory[0x200:0x200 + len(PROGRAM_BYTES)] = list(PROGRAM_BYTES)
+        return mpu
+
+
+def test_suite():
+    return unittest.findTestCases(sys.modules[__name__])
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
@@ -0,0 +1,75 @@
+import unittest
+import os
+import sys
+
+sys.path.append(os.getcwd())
+
+from farm import Job, run_job, run_jobs
+
+# $0200 LDA $F004
+# $0203 BEQ $020B
+# $0205 STA $F001
+# $0208 JMP $0200
+# $020B STA $0300
+# $020E BRK
+ECHO = (0xAD, 0x04, 0xF0, 0xF0, 0x06, 0x8D, 0x01, 0xF0, 0x4C, 0x00, 0x02,
+        0x8D, 0x00, 0x03, 0x00)
+
+
+class FarmTests(unittest.TestCase):
+
+    def test_run_job_captures_output_registers_and_regions(self):
+        job = Job('6502', ECHO, address=0x0200, pc=0x0200, input=b'hi',
+                  stop_opcodes=[0x00], regions=[(0x02FF, 0x0300)])
+        result = run_job(job, 7)
+        self.assertEqual(7, result.index)
+        self.assertEqual('opcode', result.reason)
+        self.assertEqual('hi', result.output)
+        self.assertEqual(0x020E, result.registers['pc'])
+        self.assertEqual(0, result.registers['a'])
+        self.assertEqual({(0x02FF, 0x0300): [0x00, 0x00]}, result.regions)
+        self.assertEqual(11, result.instructions)
+
+    def test_run_job_stops_on_budget(self):
+        job = Job('65C02', ECHO, address=0x0200, pc=0x0200, input=b'x' * 100,
+                  max_instructions=10)
+        result = run_job(job)
+        self.assertEqual('instructions', result.reason)
+        self.assertEqual(10, result.instructions)
+        self.assertEqual('xx', result.output)
+
+    def test_run_job_times_out(self):
+        # $0200 JMP $0200
+        job = Job('6502', (0x4C, 0x00, 0x02), address=0x0200, pc=0x0200,
+                  timeout=0)
+        result = run_job(job)
+        self.assertEqual('timeout', result.reason)
+        self.assertTrue(result.cycles > 0)
+
+    def test_run_job_reports_errors(self):
+        result = run_job(Job('Z80'))
+        self.assertEqual('error', result.reason)
+        self.assertTrue('KeyError' in result.error)
+
+    def test_run_jobs_in_process_and_in_pool(self):
+        jobs = [Job(name, ECHO, address=0x0200, pc=0x0200,
+                    input=name.encode('ascii'), stop_opcodes=[0x00])
+                for name in ('6502', '65C02', 'M65C02A')] * 3
+        serial = sorted(run_jobs(jobs, workers=0), key=lambda r: r.index)
+        pooled = sorted(run_jobs(jobs, workers=2, chunksize=2),
+                        key=lambda r: r.index)
+        self.assertEqual(list(range(len(jobs))), [r.index for r in pooled])
+        for expected, actual in zip(serial, pooled):
+            self.assertEqual(expected.reason, actual.reason)
+            self.assertEqual(expected.output, actual.output)
+            self.assertEqual(expected.cycles, actual.cycles)
+            self.assertEqual(expected.state, actual.state)
+        self.assertEqual(['6502', '65C02', 'M65C02A'] * 3,
+                         [r.output for r in pooled])
+
+
+def test_suite():
+    return unittest.findTestCases(sys.modules[__name__])
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
@@ -0,0 +1,176 @@
+import random
+import unittest
+import os
+import sys
+
+sys.path.append(os.getcwd())
+
+from devices import mpu6502, mpu65org16, mpuM65C02A
+from utils.flags import compare_table, nz_table
+
+
+# Reference implementations: the branching flag code the tables replace
+
+def reference_FlagsNZ(mpu, value):
+    mpu.p &= ~(mpu.ZERO | mpu.NEGATIVE)
+    if value == 0:
+        mpu.p |= mpu.ZERO
+    else:
+        mpu.p |= value & mpu.NEGATIVE
+
+
+def reference_opCMPR(mpu, tbyte, register_value):
+    mpu.p &= ~(mpu.CARRY | mpu.ZERO | mpu.NEGATIVE)
+    if register_value == tbyte:
+        mpu.p |= mpu.CARRY | mpu.ZERO
+    elif register_value > tbyte:
+        mpu.p |= mpu.CARRY
+    mpu.p |= (register_value - tbyte) & mpu.NEGATIVE
+
+
+def reference_M65C02A_FlagsNZ(mpu, value):
+    mpu.p &= ~(mpu.NEGATIVE | mpu.ZERO)
+    if value == 0:
+        mpu.p |= mpu.ZERO
+    if mpu.siz:
+        mpu.p |= mpu.NEGATIVE & (value >> 8)
+    else:
+        mpu.p |= mpu.NEGATIVE & value
+
+
+def reference_M65C02A_CMP(mpu, regVal, memVal):
+    if mpu.siz:
+        mask = mpu.wordMask
+        sign = mpu.NEGATIVE << 8
+    else:
+        mask = mpu.byteMask
+        sign = mpu.NEGATIVE
+
+    auL = mask & regVal
+    auR = mask & (~memVal)
+
+    sum = auL + auR + 1
+
+    mpu.p &= ~(mpu.CARRY | mpu.ZERO | mpu.NEGATIVE)
+
+    if sum > mask:
+        mpu.p |= mpu.CARRY
+    if (mask & sum) == 0:
+        mpu.p |= mpu.ZERO
+
+    if mpu.siz:
+        if (~(auL ^ auR) & (auL ^ sum)) & sign:
+            mpu.p |= mpu.OVERFLOW
+        else:
+            mpu.p &= ~mpu.OVERFLOW
+        mpu.p |= (sign & sum) >> 8
+    else:
+        mpu.p |= (sign & sum)
+
+
+class FlagTableTests(unittest.TestCase):
+
+    # tables
+
+    def test_tables_are_shared(self):
+        self.assertTrue(nz_table(8, 128, 2) is nz_table(8, 128, 2))
+        self.assertTrue(compare_table(8, 128, 2, 1) is
+                        compare_table(8, 128, 2, 1))
+        self.assertTrue(mpu6502.MPU().nzFlags is mpuM65C02A.MPU().nzFlags)
+
+    def test_nz_table_sets_zero_only_for_zero(self):
+        table = nz_table(8, 128, 2)
+        self.assertEqual(2, table[0x00])
+        self.assertEqual(0, table[0x7F])
+        self.assertEqual(128, table[0x80])
+        self.assertEqual(256, len(table))
+
+    # 6502
+
+    def test_6502_FlagsNZ_matches_reference(self):
+        self._assertFlagsNZMatch(mpu6502.MPU(), reference_FlagsNZ, 0xFF)
+
+    def test_65Org16_FlagsNZ_matches_reference(self):
+        self._assertFlagsNZMatch(mpu65org16.MPU(memory=[0] * 0x40000),
+                                 reference_FlagsNZ, 0xFFFF)
+
+    def test_6502_opCMPR_matches_reference(self):
+        mpu = mpu6502.MPU()
+        pairs = [(r, m) for r in range(256) for m in range(256)]
+        self._assertCompareMatch(mpu, pairs)
+
+    def test_65Org16_opCMPR_matches_reference(self):
+        mpu = mpu65org16.MPU(memory=[0] * 0x40000)
+        rng = random.Random(16)
+        pairs = [(rng.randrange(0x10000), rng.randrange(0x10000))
+                 for _ in range(4096)]
+        pairs += [(0, 0), (0xFFFF, 0xFFFF), (0, 0xFFFF), (0xFFFF, 0),
+                  (0x8000, 0x7FFF), (0x7FFF, 0x8000)]
+        self._assertCompareMatch(mpu, pairs)
+
+    # M65C02A
+
+    def test_M65C02A_FlagsNZ_matches_reference(self):
+        mpu = mpuM65C02A.MPU()
+        self._assertFlagsNZMatch(mpu, reference_M65C02A_FlagsNZ, 0xFF)
+
+    def test_M65C02A_FlagsNZ_siz_matches_reference(self):
+        mpu = mpuM65C02A.MPU()
+        mpu.siz = True
+        self._assertFlagsNZMatch(mpu, reference_M65C02A_FlagsNZ, 0xFFFF)
+
+    def test_M65C02A_CMP_matches_reference(self):
+        pairs = [(r, m) for r in range(256) for m in range(256)]
+        self._assertM65C02ACompareMatch(False, pairs)
+
+    def test_M65C02A_CMP_siz_matches_reference(self):
+        rng = random.Random(65)
+        pairs = [(rng.randrange(0x10000), rng.randrange(0x10000))
+                 for _ in range(4096)]
+        pairs += [(0, 0), (0xFFFF, 0xFFFF), (0, 0xFFFF), (0xFFFF, 0),
+                  (0x8000, 0x7FFF), (0x7FFF, 0x8000), (0x0080, 0x0081)]
+        self._assertM65C02ACompareMatch(True, pairs)
+
+    # Test Helpers
+
+    def _assertFlagsNZMatch(self, mpu, reference, mask):
+        for p in (0x00, mpu.byteMask):
+            for value in range(mask + 1):
+                mpu.p = p
+                mpu.FlagsNZ(value)
+                expected = mpu.p
+                mpu.p = p
+                reference(mpu, value)
+                self.assertEqual(mpu.p, expected, hex(value))
+
+    def _assertCompareMatch(self, mpu, pairs):
+        for p in (0x00, mpu.byteMask):
+            for register, operand in pairs:
+                mpu.memory[0x0010] = operand
+                mpu.p = p
+                mpu.opCMPR(lambda: 0x0010, register)
+                expected = mpu.p
+                mpu.p = p
+                reference_opCMPR(mpu, operand, register)
+                self.assertEqual(mpu.p, expected,
+                                 '%x %x' % (register, operand))
+
+    def _assertM65C02ACompareMatch(self, siz, pairs):
+        mpu = mpuM65C02A.MPU()
+        mpu.siz = siz
+        for p in (0x00, 0xFF):
+            for register, operand in pairs:
+                mpu.p = p
+                mpu._CMP(register, operand)
+                expected = mpu.p
+                mpu.p = p
+                reference_M65C02A_CMP(mpu, register, operand)
+                self.assertEqual(mpu.p, expected,
+                                 '%x %x' % (register, operand))
+
+
+def test_suite():
+    return unittest.findTestCases(sys.modules[__name__])
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
@@ -0,0 +1,154 @@
+import random
+import unittest
+import os
+import sys
+
+sys.path.append(os.getcwd())
+
+from devices import mpu6502, mpu65c02, mpuM65C02A
+from history import History
+
+
+class HistoryTests(unittest.TestCase):
+
+    def test_step_back_undoes_registers_and_memory(self):
+        mpu = self._make_mpu()
+        # $0200 LDA #$42
+        # $0202 STA $10
+        # $0204 INC $10
+        self._write(mpu.memory, 0x200, (0xA9, 0x42, 0x85, 0x10, 0xE6, 0x10))
+        mpu.memory[0x10] = 0x99
+        history = History(mpu)
+        states = []
+        for _ in range(3):
+            states.append(self._state(mpu))
+            history.step()
+        for state in reversed(states):
+            self.assertEqual(1, history.step_back())
+            self.assertEqual(state, self._state(mpu))
+        self.assertEqual(0, history.step_back())
+
+    def test_reverse_continue_stops_at_breakpoint(self):
+        mpu = self._make_mpu()
+        # $0200 LDX #$00
+        # $0202 INX
+        # $0203 JMP $0202
+        self._write(mpu.memory, 0x200, (0xA2, 0x00, 0xE8, 0x4C, 0x02, 0x02))
+        history = History(mpu)
+        history.run(max_instructions=9)
+        self.assertEqual(4, self._getX(mpu))
+        self.assertEqual(('pc', 2), history.reverse_continue([0x202]))
+        self.assertEqual(0x202, mpu.pc)
+        self.assertEqual(3, self._getX(mpu))
+        self.assertEqual(('start', 7), history.reverse_continue([0x300]))
+        self.assertEqual((0x200, 0), (mpu.pc, mpu.processorCycles))
+
+    def test_seek_replays_from_checkpoint(self):
+        mpu = self._make_mpu()
+        # $0200 INX
+        # $0201 STX $10
+        # $0203 JMP $0200
+        self._write(mpu.memory, 0x200, (0xE8, 0x86, 0x10, 0x4C, 0x00, 0x02))
+        history = History(mpu, interval=20)
+        states = {}
+        while mpu.processorCycles < 200:
+            states[mpu.processorCycles] = self._state(mpu)
+            history.step()
+        self.assertTrue(len(history.checkpoints) > 1)
+        self.assertTrue(history.seek(107))
+        self.assertEqual(states[mpu.processorCycles], self._state(mpu))
+        self.assertTrue(mpu.processorCycles in range(107, 112))
+        self.assertTrue(history.seek(150))
+        self.assertEqual(states[mpu.processorCycles], self._state(mpu))
+        self.assertTrue(mpu.processorCycles in range(150, 155))
+
+    def test_seek_before_history_changes_nothing(self):
+        mpu = self._make_mpu()
+        mpu.processorCycles = 100
+        history = History(mpu)
+        history.step()
+        self.assertFalse(history.seek(50))
+        self.assertEqual(1, len(history))
+
+    def test_capacity_bounds_history(self):
+        mpu = self._make_mpu()
+        # $0200 JMP $0200
+        self._write(mpu.memory, 0x200, (0x4C, 0x00, 0x02))
+        history = History(mpu, capacity=10)
+        history.SEGMENT = 8
+        history.run(max_instructions=100)
+        self.assertTrue(len(history) <= 10 + history.SEGMENT)
+        self.assertEqual(len(history), history.step_back(1000))
+
+    def test_random_programs_rewind(self):
+        rng = random.Random(6502)
+        for _ in range(2):
+            memory = [rng.randrange(256) for _ in range(0x10000)]
+            mpu = self._make_mpu(memory=memory)
+            mpu.pc = rng.randrange(0x10000)
+            history = History(mpu, interval=500)
+            states = []
+            for _ in range(500):
+                states.append(self._state(mpu))
+                history.step()
+            history.step_back(200)
+            self.assertEqual(states[300], self._state(mpu))
+            history.step_back(300)
+            self.assertEqual(states[0], self._state(mpu))
+
+    # Test Helpers
+
+    MPU = mpu6502.MPU
+
+    def _getX(self, mpu):
+        if isinstance(mpu, mpuM65C02A.MPU):
+            return mpu.x[0]
+        return mpu.x
+
+    def _state(self, mpu):
+        # History wraps memory in an ObservableMemory
+        return repr(mpu), mpu.processorCycles, mpu.memory.subject[:]
+
+    def _write(self, memory, start_address, bytes):
+        memory[start_address:start_address + len(bytes)] = bytes
+
+    def _make_mpu(self, *args, **kargs):
+        kargs.setdefault('pc', 0x200)
+        return self.MPU(*args, **kargs)
+
+
+class History65C02Tests(HistoryTests):
+
+    MPU = mpu65c02.MPU
+
+
+class HistoryM65C02ATests(HistoryTests):
+
+    MPU = mpuM65C02A.MPU
+
+    def test_random_programs_rewind(self):
+        pass
+
+    def test_step_back_restores_prefix_flags(self):
+        mpu = self._make_mpu()
+        # $0200 OAX
+        # $0201 DUP
+        self._write(mpu.memory, 0x200, (0xEB, 0x0B))
+        mpu.x[0:3] = [1, 2, 3]
+        history = History(mpu)
+        history.step()
+        self.assertTrue(mpu.oax)
+        history.step()
+        self.assertEqual([1, 1, 2], list(mpu.x))
+        history.step_back()
+        self.assertEqual([1, 2, 3], list(mpu.x))
+        self.assertTrue(mpu.oax)
+        history.step_back()
+        self.assertFalse(mpu.oax)
+
+
+def test_suite():
+    return unittest.findTestCases(sys.modules[__name__])
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
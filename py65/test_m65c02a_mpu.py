@@ -0,0 +1,308 @@
+import tempfile
+import unittest
+import os
+import sys
+
+sys.path.append(os.getcwd())
+
+from contextlib import redirect_stdout
+from io import StringIO
+from devices.mpuM65C02A import MPU
+
+
+class M65C02A_MPU_Tests(unittest.TestCase):
+
+    # run
+
+    def test_run_stops_before_stop_opcode(self):
+        mpu = self._make_mpu()
+        # $0200 LDA #$01
+        # $0202 SIZ LDX #$1234
+        # $0206 BRK
+        self._write(mpu.memory, 0x200, (0xA9, 0x01,
+                                        0xAB, 0xA2, 0x34, 0x12,
+                                        0x00))
+        reason, cycles, instructions = mpu.run(stop_opcodes=[0x00])
+        self.assertEqual('opcode', reason)
+        self.assertEqual(2, instructions)
+        self.assertEqual(2 + 4, cycles)
+        self.assertEqual(0x206, mpu.pc)
+        self.assertEqual(0x01, mpu.a[0])
+        self.assertEqual(0x1234, mpu.x[0])
+        self.assertEqual(2, mpu.numInstructions)
+
+    def test_run_stops_at_stop_pc(self):
+        mpu = self._make_mpu()
+        # $0200 INX
+        # $0201 BRA $0200
+        self._write(mpu.memory, 0x200, (0xE8, 0x80, 0xFD))
+        reason, cycles, instructions = mpu.run(stop_pcs=[0x201])
+        self.assertEqual(('pc', 1, 1), (reason, cycles, instructions))
+        self.assertEqual(0x201, mpu.pc)
+
+    def test_run_stops_after_max_instructions(self):
+        mpu = self._make_mpu()
+        # $0200 INX
+        # $0201 BRA $0200
+        self._write(mpu.memory, 0x200, (0xE8, 0x80, 0xFD))
+        reason, cycles, instructions = mpu.run(max_instructions=9)
+        self.assertEqual('instructions', reason)
+        self.assertEqual(9, instructions)
+        self.assertEqual(5, mpu.x[0])
+        self.assertEqual(cycles, mpu.processorCycles)
+
+    def test_run_stops_when_cycle_budget_is_spent(self):
+        mpu = self._make_mpu()
+        # $0200 INX
+        # $0201 BRA $0200
+        self._write(mpu.memory, 0x200, (0xE8, 0x80, 0xFD))
+        reason, cycles, instructions = mpu.run(max_cycles=10)
+        self.assertEqual('cycles', reason)
+        self.assertTrue(cycles >= 10)
+
+    def test_run_matches_step(self):
+        stepped = self._make_mpu()
+        run = self._make_mpu()
+        # $0200 LDX #$05
+        # $0202 DEX
+        # $0203 BNE $0202
+        # $0205 OAX DEX
+        # $0207 BRK
+        program = (0xA2, 0x05, 0xCA, 0xD0, 0xFD, 0xEB, 0xCA, 0x00)
+        self._write(stepped.memory, 0x200, program)
+        self._write(run.memory, 0x200, program)
+        while stepped.memory[stepped.pc] != 0x00:
+            stepped.step()
+        run.run(stop_opcodes=[0x00])
+        self.assertEqual(repr(stepped), repr(run))
+        self.assertEqual(stepped.processorCycles, run.processorCycles)
+        self.assertEqual(stepped.numInstructions, run.numInstructions)
+
+    # Functional Mode
+
+    def test_functional_run_matches_accurate_run(self):
+        accurate = self._make_mpu()
+        functional = self._make_mpu()
+        functional.enable_functional_mode()
+        # $0200 LDX #$05
+        # $0202 DEX
+        # $0203 BNE $0202
+        # $0205 OAX DEX
+        # $0207 BRK
+        program = (0xA2, 0x05, 0xCA, 0xD0, 0xFD, 0xEB, 0xCA, 0x00)
+        self._write(accurate.memory, 0x200, program)
+        self._write(functional.memory, 0x200, program)
+        reason, cycles, instructions = accurate.run(stop_opcodes=[0x00])
+        self.assertEqual((reason, 0, instructions),
+                         functional.run(stop_opcodes=[0x00]))
+        self.assertEqual(repr(accurate), repr(functional))
+        self.assertEqual(accurate.numInstructions,
+                         functional.numInstructions)
+        self.assertEqual((0, 0, 0), (functional.processorCycles,
+                                     functional.pgmMemRdCycles,
+                                     functional.datMemRdCycles))
+        self.assertRaises(ValueError, functional.run, max_cycles=10)
+
+    def test_functional_mode_switches_back_at_breakpoint(self):
+        mpu = self._make_mpu()
+        mpu.enable_functional_mode()
+        # $0200 INX
+        # $0201 BRA $0200
+        self._write(mpu.memory, 0x200, (0xE8, 0x80, 0xFD))
+        self.assertEqual(('pc', 0, 1), mpu.run(stop_pcs=[0x201]))
+        mpu.disable_functional_mode()
+        self.assertTrue(type(mpu) is MPU)
+        mpu.step()
+        self.assertEqual(0x200, mpu.pc)
+        self.assertTrue(mpu.processorCycles > 0)
+
+    # Tracing
+
+    def test_tracing_variant_only_while_traces_are_enabled(self):
+        mpu = self._make_mpu()
+        mpu.dbg = True
+        self.assertFalse(mpu.TRACING)
+        mpu.dbgE = True
+        self.assertTrue(mpu.TRACING)
+        mpu.enable_functional_mode()
+        self.assertTrue(mpu.TRACING and mpu.FUNCTIONAL)
+        mpu.dbg = False
+        self.assertFalse(mpu.TRACING)
+        mpu.disable_functional_mode()
+        self.assertTrue(type(mpu) is MPU)
+
+    def test_tracing_prints_bus_cycles(self):
+        mpu = self._make_mpu()
+        out = StringIO()
+        mpu.out = out
+        mpu.dbg = mpu.dbgD = True
+        # $0200 LDA #$01
+        self._write(mpu.memory, 0x200, (0xA9, 0x01))
+        with redirect_stdout(StringIO()) as stdout:
+            mpu.run(max_instructions=1)
+        self.assertEqual(stdout.getvalue(), out.getvalue())
+        self.assertTrue(out.getvalue().startswith('   IR: A9 <= mem[0200]'))
+        self.assertTrue(' rdPM: 01 <= mem[0201]' in out.getvalue())
+        self.assertEqual(2, mpu.processorCycles)
+
+    def test_restore_selects_tracing_variant(self):
+        mpu = self._make_mpu()
+        mpu.dbg = mpu.dbgD = True
+        snapshot = mpu.snapshot()
+        mpu.dbg = False
+        mpu.restore(snapshot)
+        self.assertTrue(mpu.TRACING)
+
+    # Opcode Profile
+
+    def test_opcode_profile_keys_on_prefixes(self):
+        mpu = self._make_mpu()
+        # $0200 LDX #$05
+        # $0202 DEX
+        # $0203 BNE $0202
+        # $0205 SIZ OAX DEX
+        # $0208 BRK
+        self._write(mpu.memory, 0x200, (0xA2, 0x05, 0xCA, 0xD0, 0xFD,
+                                        0xAB, 0xEB, 0xCA, 0x00))
+        profile = mpu.enable_opcode_profile()
+        reason, cycles, instructions = mpu.run(stop_opcodes=[0x00])
+        self.assertEqual(12, instructions)
+        self.assertEqual(14, profile.total())
+        self.assertEqual(6, profile.opcodes()[0xCA])
+        rows = profile.rows()
+        self.assertEqual((0xCA, 'DEX', 'imp', '', 5), rows[0])
+        self.assertTrue((0xCA, 'DEX', 'imp', 'SIZ+OAX', 1) in rows)
+        self.assertTrue((0xEB, 'OAX', 'imp', 'SIZ', 1) in rows)
+        self.assertTrue(('imp', 'SIZ+OAX', 1) in profile.modes())
+        mpu.disable_opcode_profile()
+        self.assertTrue(type(mpu) is MPU)
+
+    def test_address_profile_counts_prefixes_at_their_address(self):
+        mpu = self._make_mpu()
+        # $0200 SIZ OAX DEX
+        # $0203 BRK
+        self._write(mpu.memory, 0x200, (0xAB, 0xEB, 0xCA, 0x00))
+        profile = mpu.enable_address_profile()
+        reason, cycles, instructions = mpu.run(stop_opcodes=[0x00])
+        self.assertEqual(1, instructions)
+        self.assertEqual([0x200, 0x201, 0x202],
+                         [row[0] for row in profile.addresses()])
+        self.assertEqual(cycles, profile.total_cycles())
+        mpu.disable_address_profile()
+        self.assertTrue(type(mpu) is MPU)
+
+    def test_call_profile_follows_jsr_and_rts(self):
+        mpu = self._make_mpu()
+        # $0200 JSR $0300
+        # $0203 BRK
+        # $0300 INX
+        # $0301 RTS
+        self._write(mpu.memory, 0x200, (0x20, 0x00, 0x03, 0x00))
+        self._write(mpu.memory, 0x300, (0xE8, 0x60))
+        profile = mpu.enable_call_profile()
+        reason, cycles, instructions = mpu.run(stop_opcodes=[0x00])
+        rows = dict([(row[0], row[1:]) for row in profile.rows()])
+        self.assertEqual(cycles, rows[0x200][2])
+        self.assertEqual(1, rows[0x300][0])
+        self.assertEqual(cycles, sum([row[1] for row in rows.values()]))
+        mpu.disable_call_profile()
+        self.assertTrue(type(mpu) is MPU)
+
+    # Register File
+
+    def test_registers_are_slotted(self):
+        mpu = self._make_mpu()
+        self.assertFalse(hasattr(mpu, '__dict__'))
+        self.assertRaises(AttributeError, setattr, mpu, 'acc', 0)
+
+    def test_instances_do_not_share_registers(self):
+        mpu = self._make_mpu()
+        other = self._make_mpu()
+        mpu.sp[0] = 0x0123
+        mpu.y[1] = 5
+        self.assertNotEqual(0x0123, other.sp[0])
+        self.assertEqual(0, other.y[1])
+
+    def test_restore_returns_prefix_flags_and_counters(self):
+        mpu = self._make_mpu()
+        mpu.x[0:3] = [1, 2, 3]
+        mpu.siz = mpu.lscx = True
+        mpu.numInstructions = 7
+        mpu.dummyCycles = 5
+        snapshot = mpu.snapshot()
+        mpu.x[0] = 9
+        mpu.siz = mpu.lscx = False
+        mpu.numInstructions = 0
+        mpu.dummyCycles = 0
+        mpu.memory[0x0200] = 0xEA
+        mpu.restore(snapshot)
+        self.assertEqual([1, 2, 3], list(mpu.x))
+        self.assertEqual((True, True, 7), (mpu.siz, mpu.lscx,
+                                          mpu.numInstructions))
+        self.assertEqual(5, mpu.dummyCycles)
+        self.assertEqual(0x00, mpu.memory[0x0200])
+        # the snapshot keeps its own copies
+        mpu.x[0] = 9
+        mpu.restore(snapshot)
+        self.assertEqual(1, mpu.x[0])
+
+    def test_clone_does_not_share_registers(self):
+        mpu = self._make_mpu()
+        mpu.oax = True
+        twin = mpu.clone()
+        twin.x[0] = 0x0123
+        twin.y[1] = 5
+        twin.memory[0x0200] = 0xEA
+        self.assertTrue(twin.oax)
+        self.assertNotEqual(0x0123, mpu.x[0])
+        self.assertEqual(0, mpu.y[1])
+        self.assertNotEqual(0xEA, mpu.memory[0x0200])
+
+    def test_load_state_returns_prefix_flags_and_counters(self):
+        mpu = self._make_mpu()
+        mpu.x[0:3] = [1, 2, 3]
+        mpu.osx = mpu.ind = True
+        mpu.numInstructions = 7
+        mpu.dummyCycles = 5
+        filename = tempfile.mktemp()
+        try:
+            mpu.save_state(filename)
+            other = self._make_mpu()
+            other.load_state(filename)
+        finally:
+            os.unlink(filename)
+        self.assertEqual(repr(mpu), repr(other))
+        self.assertEqual((True, True, 7), (other.osx, other.ind,
+                                          other.numInstructions))
+        self.assertEqual(5, other.dummyCycles)
+
+    def test_register_stack_rotations(self):
+        mpu = self._make_mpu()
+        mpu.x[0:3] = [1, 2, 3]
+        # $0200 OAX ROT
+        # $0202 OAX SWP
+        # $0204 OAX DUP
+        # $0206 BRK
+        self._write(mpu.memory, 0x200, (0xEB, 0x2B, 0xEB, 0x1B,
+                                        0xEB, 0x0B, 0x00))
+        mpu.run(max_instructions=1)
+        self.assertEqual([2, 3, 1], list(mpu.x))
+        mpu.run(max_instructions=1)
+        self.assertEqual([3, 2, 1], list(mpu.x))
+        mpu.run(max_instructions=1)
+        self.assertEqual([3, 3, 2], list(mpu.x))
+
+    # Test Helpers
+
+    def _write(self, memory, start_address, bytes):
+        memory[start_address:start_address + len(bytes)] = bytes
+
+    def _make_mpu(self, *args, **kargs):
+        return MPU(*args, **kargs)
+
+
+def test_suite():
+    return unittest.findTestCases(sys.modules[__name__])
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
@@ -1,7 +1,11 @@
+import os
+import tempfile
 import unittest
 import sys
 import assembler
 import devices.mpu6502
+from memory import ObservableMemory
+from utils.snapshot import STATE_PAGE, read_state_header
 
 
 class Common6502Tests:
@@ -5584,6 +5588,351 @@ class Common6502Tests:
         self.assertEqual(0x03, mpu.a)
         self.assertEqual(0x0008, mpu.pc)
 
+    # Run
+
+    def test_run_stops_before_stop_opcode(self):
+        mpu = self._make_mpu()
+        # $0000 LDA #$01
+        # $0002 LDX #$02
+        # $0004 BRK
+        self._write(mpu.memory, 0x0000, (0xA9, 0x01, 0xA2, 0x02, 0x00))
+        reason, cycles, instructions = mpu.run(stop_opcodes=[0x00])
+        self.assertEqual('opcode', reason)
+        self.assertEqual(4, cycles)
+        self.assertEqual(2, instructions)
+        self.assertEqual(0x0004, mpu.pc)
+        self.assertEqual(0x01, mpu.a)
+        self.assertEqual(0x02, mpu.x)
+
+    def test_run_stops_at_stop_pc(self):
+        mpu = self._make_mpu()
+        # $0000 INX
+        # $0001 JMP $0000
+        self._write(mpu.memory, 0x0000, (0xE8, 0x4C, 0x00, 0x00))
+        reason, cycles, instructions = mpu.run(stop_pcs=[0x0001])
+        self.assertEqual('pc', reason)
+        self.assertEqual((2, 1), (cycles, instructions))
+        self.assertEqual(0x0001, mpu.pc)
+
+    def test_run_always_executes_at_least_one_instruction(self):
+        mpu = self._make_mpu()
+        # $0000 INX
+        # $0001 JMP $0000
+        self._write(mpu.memory, 0x0000, (0xE8, 0x4C, 0x00, 0x00))
+        mpu.run(stop_pcs=[0x0000])
+        self.assertEqual(0x01, mpu.x)
+
+    def test_run_stops_after_max_instructions(self):
+        mpu = self._make_mpu()
+        # $0000 INX
+        # $0001 JMP $0000
+        self._write(mpu.memory, 0x0000, (0xE8, 0x4C, 0x00, 0x00))
+        reason, cycles, instructions = mpu.run(max_instructions=10)
+        self.assertEqual('instructions', reason)
+        self.assertEqual(10, instructions)
+        self.assertEqual(5 * (2 + 3), cycles)
+        self.assertEqual(5, mpu.x)
+        self.assertEqual(cycles, mpu.processorCycles)
+
+    def test_run_stops_when_cycle_budget_is_spent(self):
+        mpu = self._make_mpu()
+        # $0000 INX
+        # $0001 JMP $0000
+        self._write(mpu.memory, 0x0000, (0xE8, 0x4C, 0x00, 0x00))
+        reason, cycles, instructions = mpu.run(max_cycles=11)
+        self.assertEqual('cycles', reason)
+        self.assertEqual(12, cycles)
+        self.assertEqual(5, instructions)
+
+    def test_run_matches_step(self):
+        stepped = self._make_mpu()
+        run = self._make_mpu()
+        # $0000 LDX #$05
+        # $0002 DEX
+        # $0003 BNE $0002
+        # $0005 BRK
+        program = (0xA2, 0x05, 0xCA, 0xD0, 0xFD, 0x00)
+        self._write(stepped.memory, 0x0000, program)
+        self._write(run.memory, 0x0000, program)
+        while stepped.memory[stepped.pc] != 0x00:
+            stepped.step()
+        run.run(stop_opcodes=[0x00])
+        self.assertEqual(repr(stepped), repr(run))
+        self.assertEqual(stepped.processorCycles, run.processorCycles)
+
+    # Decode Cache
+
+    def test_decode_cache_run_matches_uncached_run(self):
+        uncached = self._make_mpu()
+        cached = self._make_mpu()
+        cached.enable_decode_cache()
+        # $0000 LDX #$05
+        # $0002 DEX
+        # $0003 BNE $0002
+        # $0005 BRK
+        program = (0xA2, 0x05, 0xCA, 0xD0, 0xFD, 0x00)
+        self._write(uncached.memory, 0x0000, program)
+        self._write(cached.memory, 0x0000, program)
+        self.assertEqual(uncached.run(stop_opcodes=[0x00]),
+                         cached.run(stop_opcodes=[0x00]))
+        self.assertEqual(repr(uncached), repr(cached))
+
+    def test_decode_cache_wraps_list_memory(self):
+        mpu = self._make_mpu()
+        mpu.memory[0x1234] = 0x42
+        mpu.enable_decode_cache()
+        self.assertEqual(0x42, mpu.memory[0x1234])
+        self.assertTrue(hasattr(mpu.memory, 'subscribe_to_write'))
+
+    def test_decode_cache_is_invalidated_by_self_modifying_code(self):
+        mpu = self._make_mpu()
+        mpu.enable_decode_cache()
+        # $0000 INX
+        # $0001 LDA #$C8   ; INY
+        # $0003 STA $0000
+        # $0006 JMP $0000
+        self._write(mpu.memory, 0x0000, (0xE8, 0xA9, 0xC8, 0x8D, 0x00,
+                                         0x00, 0x4C, 0x00, 0x00))
+        mpu.run(max_instructions=4)
+        self.assertEqual((1, 0), (mpu.x, mpu.y))
+        self.assertEqual(0x0000, mpu.pc)
+        mpu.run(max_instructions=1)
+        self.assertEqual((1, 1), (mpu.x, mpu.y))
+
+    def test_decode_cache_disabled_fetches_from_memory(self):
+        mpu = self._make_mpu()
+        mpu.enable_decode_cache()
+        mpu.disable_decode_cache()
+        # $0000 INX
+        self._write(mpu.memory, 0x0000, (0xE8, ))
+        mpu.run(max_instructions=1)
+        self.assertEqual(1, mpu.x)
+
+    # Functional Mode
+
+    def test_functional_run_matches_accurate_run(self):
+        accurate = self._make_mpu()
+        functional = self._make_mpu()
+        functional.enable_functional_mode()
+        # $0000 LDX #$05
+        # $0002 LDA $01FF,X
+        # $0005 DEX
+        # $0006 BNE $0002
+        # $0008 BRK
+        program = (0xA2, 0x05, 0xBD, 0xFF, 0x01, 0xCA, 0xD0, 0xFA, 0x00)
+        self._write(accurate.memory, 0x0000, program)
+        self._write(functional.memory, 0x0000, program)
+        reason, cycles, instructions = accurate.run(stop_opcodes=[0x00])
+        self.assertEqual((reason, 0, instructions),
+                         functional.run(stop_opcodes=[0x00]))
+        self.assertEqual(repr(accurate), repr(functional))
+        self.assertEqual(0, functional.processorCycles)
+        self.assertTrue(functional.FUNCTIONAL)
+
+    def test_functional_mode_refuses_cycle_budget(self):
+        mpu = self._make_mpu()
+        mpu.enable_functional_mode()
+        self.assertRaises(ValueError, mpu.run, max_cycles=10)
+
+    def test_functional_mode_switches_back_at_breakpoint(self):
+        mpu = self._make_mpu()
+        klass = type(mpu)
+        mpu.enable_functional_mode()
+        # $0000 INX
+        # $0001 JMP $0000
+        self._write(mpu.memory, 0x0000, (0xE8, 0x4C, 0x00, 0x00))
+        self.assertEqual(('pc', 0, 1), mpu.run(stop_pcs=[0x0001]))
+        mpu.disable_functional_mode()
+        self.assertTrue(type(mpu) is klass)
+        mpu.step()
+        self.assertEqual((0x0000, 3), (mpu.pc, mpu.processorCycles))
+        mpu.step()
+        self.assertEqual((2, 5), (mpu.x, mpu.processorCycles))
+
+    # Opcode Profile
+
+    def test_opcode_profile_counts_executed_opcodes(self):
+        mpu = self._make_mpu()
+        # $0000 LDX #$05
+        # $0002 DEX
+        # $0003 BNE $0002
+        # $0005 BRK
+        self._write(mpu.memory, 0x0000, (0xA2, 0x05, 0xCA, 0xD0, 0xFD, 0x00))
+        profile = mpu.enable_opcode_profile()
+        plain = self._make_mpu()
+        self._write(plain.memory, 0x0000, (0xA2, 0x05, 0xCA, 0xD0, 0xFD, 0x00))
+        self.assertEqual(plain.run(stop_opcodes=[0x00]),
+                         mpu.run(stop_opcodes=[0x00]))
+        self.assertEqual(11, profile.total())
+        self.assertEqual([5, 5, 1], [profile.opcodes()[opcode]
+                                     for opcode in (0xCA, 0xD0, 0xA2)])
+        self.assertEqual((0xCA, 'DEX', 'imp', '', 5), profile.rows()[0])
+        mpu.disable_opcode_profile()
+        mpu.pc = 0x0002
+        mpu.step()
+        self.assertEqual(5, profile.opcodes()[0xCA])
+
+    def test_opcode_profile_in_functional_mode(self):
+        mpu = self._make_mpu()
+        klass = type(mpu)
+        mpu.enable_functional_mode()
+        profile = mpu.enable_opcode_profile()
+        # $0000 INX
+        # $0001 JMP $0000
+        self._write(mpu.memory, 0x0000, (0xE8, 0x4C, 0x00, 0x00))
+        self.assertEqual(('instructions', 0, 4), mpu.run(max_instructions=4))
+        self.assertEqual(4, profile.total())
+        self.assertRaises(ValueError, mpu.run, max_cycles=10)
+        mpu.disable_functional_mode()
+        mpu.disable_opcode_profile()
+        self.assertTrue(type(mpu) is klass)
+
+    def test_address_profile_counts_cycles_at_each_pc(self):
+        mpu = self._make_mpu()
+        # $0000 LDX #$05
+        # $0002 DEX
+        # $0003 BNE $0002
+        # $0005 BRK
+        self._write(mpu.memory, 0x0000, (0xA2, 0x05, 0xCA, 0xD0, 0xFD, 0x00))
+        profile = mpu.enable_address_profile()
+        reason, cycles, instructions = mpu.run(stop_opcodes=[0x00])
+        self.assertEqual(instructions, profile.total())
+        self.assertEqual(cycles, profile.total_cycles())
+        self.assertEqual([(0x0000, 1, 2), (0x0002, 5, 10), (0x0003, 5, 14)],
+                         profile.addresses())
+        self.assertEqual((0x0003, 5, 14), profile.hottest(1)[0])
+        self.assertEqual([(0x0000, 0x0003, 11, 26)], profile.ranges())
+        mpu.disable_address_profile()
+        self.assertFalse(mpu.INSTRUMENTED)
+        self.assertTrue(mpu.clone()._address_profile is None)
+
+    def test_call_profile_charges_cycles_to_subroutines(self):
+        mpu = self._make_mpu()
+        # $0000 JSR $0010
+        # $0003 JSR $0020
+        # $0006 BRK
+        # $0010 JSR $0020
+        # $0013 RTS
+        # $0020 LDX #$03
+        # $0022 DEX
+        # $0023 BNE $0022
+        # $0025 RTS
+        self._write(mpu.memory, 0x0000, (0x20, 0x10, 0x00, 0x20, 0x20, 0x00))
+        self._write(mpu.memory, 0x0010, (0x20, 0x20, 0x00, 0x60))
+        self._write(mpu.memory, 0x0020, (0xA2, 0x03, 0xCA, 0xD0, 0xFD, 0x60))
+        profile = mpu.enable_call_profile()
+        reason, cycles, instructions = mpu.run(stop_opcodes=[0x00])
+        self.assertEqual([(0x0020, 2, 44, 44), (0x0000, 0, 12, cycles),
+                          (0x0010, 1, 12, 34)], profile.rows())
+        self.assertEqual([(0x0000, 0x0010, 1, 34), (0x0000, 0x0020, 1, 22),
+                          (0x0010, 0x0020, 1, 22)], profile.edges())
+        self.assertEqual(22, profile.stacks[0x0000, 0x0010, 0x0020])
+        mpu.disable_call_profile()
+        self.assertFalse(mpu.INSTRUMENTED)
+
+    def test_call_profile_unwinds_to_the_frame_returned_to(self):
+        mpu = self._make_mpu()
+        # $0000 JSR $0010
+        # $0003 BRK
+        # $0010 JSR $0020
+        # $0013 RTS
+        # $0020 PLA
+        # $0021 PLA
+        # $0022 RTS     returns from $0010 to $0003
+        self._write(mpu.memory, 0x0000, (0x20, 0x10, 0x00, 0x00))
+        self._write(mpu.memory, 0x0010, (0x20, 0x20, 0x00, 0x60))
+        self._write(mpu.memory, 0x0020, (0x68, 0x68, 0x60))
+        profile = mpu.enable_call_profile()
+        reason, cycles, instructions = mpu.run(stop_opcodes=[0x00])
+        self.assertEqual(0x0003, mpu.pc)
+        self.assertEqual([], profile._frames)
+        self.assertEqual(cycles - 6, profile.inclusive()[0x0010])
+
+    # Register File
+
+    def test_registers_are_slotted(self):
+        mpu = self._make_mpu()
+        self.assertFalse(hasattr(mpu, '__dict__'))
+        self.assertRaises(AttributeError, setattr, mpu, 'acc', 0)
+
+    # Snapshots
+
+    def test_restore_returns_to_snapshot(self):
+        mpu = self._make_mpu()
+        mpu.a, mpu.x, mpu.pc, mpu.processorCycles = 0x12, 0x34, 0x0300, 42
+        mpu.memory[0x0300] = 0xEA
+        snapshot = mpu.snapshot()
+        mpu.step()
+        mpu.a = 0x56
+        mpu.memory[0x0300] = 0x00
+        mpu.restore(snapshot)
+        self.assertEqual((0x12, 0x34, 0x0300, 42),
+                         (mpu.a, mpu.x, mpu.pc, mpu.processorCycles))
+        self.assertEqual(0xEA, mpu.memory[0x0300])
+
+    def test_restore_drops_decode_cache(self):
+        mpu = self._make_mpu()
+        # $0000 INX
+        self._write(mpu.memory, 0x0000, (0xE8,))
+        snapshot = mpu.snapshot()
+        mpu.enable_decode_cache()
+        mpu.run(max_instructions=1)
+        # $0000 INY
+        snapshot.memory = bytes(bytearray([0xC8])) + snapshot.memory[1:]
+        mpu.restore(snapshot)
+        mpu.run(max_instructions=1)
+        self.assertEqual((0, 1), (mpu.x, mpu.y))
+
+    def test_clone_is_independent(self):
+        mpu = self._make_mpu()
+        mpu.a = 0x12
+        twin = mpu.clone()
+        self.assertEqual(repr(mpu), repr(twin))
+        twin.a = 0x34
+        twin.memory[0x0000] = 0x01
+        self.assertEqual(0x12, mpu.a)
+        self.assertEqual(0xAA, mpu.memory[0x0000])
+
+    def test_clone_keeps_memory_subscribers(self):
+        mpu = self._make_mpu()
+        calls = []
+        mpu.memory = ObservableMemory(subject=mpu.memory)
+        mpu.memory.subscribe_to_write([0xF001], lambda a, v: calls.append(v))
+        mpu.enable_decode_cache()
+        twin = mpu.clone()
+        twin.memory[0xF001] = 0x41
+        self.assertEqual([0x41], calls)
+        self.assertFalse(twin.memory is mpu.memory)
+        self.assertEqual(0xAA, mpu.memory[0xF001])
+
+    def test_load_state_returns_to_saved_state(self):
+        for compress in (False, True):
+            mpu = self._make_mpu()
+            mpu.a, mpu.sp, mpu.processorCycles = 0x12, 0xF0, 99
+            mpu.memory[0x1234] = 0x56
+            filename = tempfile.mktemp()
+            try:
+                mpu.save_state(filename, compress)
+                other = self._make_mpu()
+                other.load_state(filename)
+            finally:
+                os.unlink(filename)
+            self.assertEqual(repr(mpu), repr(other))
+            self.assertEqual(99, other.processorCycles)
+            self.assertEqual(mpu.memory, other.memory)
+
+    def test_state_file_memory_is_page_aligned(self):
+        mpu = self._make_mpu()
+        filename = tempfile.mktemp()
+        try:
+            mpu.save_state(filename)
+            header = read_state_header(filename)
+            size = os.path.getsize(filename)
+        finally:
+            os.unlink(filename)
+        self.assertEqual(0, header['offset'] % STATE_PAGE)
+        self.assertEqual(header['offset'] + 0x10000, size)
+
     # Test Helpers
 
     def _write(self, memory, start_address, bytes):
@@ -0,0 +1,118 @@
+import random
+import unittest
+import os
+import sys
+
+sys.path.append(os.getcwd())
+
+from devices import mpu6502
+from devices.mpu6502batch import BatchMPU, numpy
+
+
+@unittest.skipIf(numpy is None, "NumPy is not installed")
+class BatchMPUTests(unittest.TestCase):
+
+    def test_lanes_start_like_mpu(self):
+        batch = BatchMPU(3, pc=0x200)
+        mpu = mpu6502.MPU(pc=0x200)
+        for lane in range(3):
+            self._assertSameState(mpu, batch.lane(lane))
+
+    def test_load_and_lane_round_trip(self):
+        mpu = self._make_mpu()
+        mpu.a, mpu.x, mpu.y, mpu.sp, mpu.p = 0x12, 0x34, 0x56, 0xF0, 0xC3
+        mpu.processorCycles = 99
+        mpu.memory[0x1234] = 0xAB
+        batch = BatchMPU(2)
+        batch.load(mpu, 1)
+        self._assertSameState(mpu, batch.lane(1))
+        self.assertEqual(0, batch.memory[0, 0x1234])
+
+    def test_divergent_lanes_match_mpu(self):
+        # $0200 LDX $10
+        # $0202 DEX
+        # $0203 BNE $0202
+        # $0205 TXA
+        # $0206 SED
+        # $0207 ADC $11
+        # $0209 STA $12
+        # $020B BRK
+        program = (0xA6, 0x10, 0xCA, 0xD0, 0xFD, 0x8A, 0xF8, 0x65, 0x11,
+                   0x85, 0x12, 0x00)
+        mpus = []
+        for count in (1, 2, 5, 0x80):
+            mpu = self._make_mpu()
+            self._write(mpu.memory, 0x200, program)
+            mpu.memory[0x10] = count
+            mpu.memory[0x11] = 0x99
+            mpus.append(mpu)
+        batch = BatchMPU(len(mpus))
+        for lane, mpu in enumerate(mpus):
+            batch.load(mpu, lane)
+
+        reasons, cycles, instructions = batch.run(stop_opcodes=[0x00])
+        for lane, mpu in enumerate(mpus):
+            self.assertEqual((reasons[lane], cycles[lane], instructions[lane]),
+                             mpu.run(stop_opcodes=[0x00]))
+            self._assertSameState(mpu, batch.lane(lane))
+
+    def test_lanes_stop_independently(self):
+        # $0200 INX
+        # $0201 JMP $0200
+        batch = BatchMPU(3, pc=0x200)
+        batch.memory[:, 0x200:0x204] = (0xE8, 0x4C, 0x00, 0x02)
+        batch.x[:] = (0x00, 0x10, 0xFD)
+        reasons, cycles, instructions = batch.run(max_cycles=100,
+                                                  stop_pcs=[0x201],
+                                                  stop_opcodes=[0x00])
+        self.assertEqual(['pc', 'pc', 'pc'], reasons)
+        self.assertEqual([2, 2, 2], list(cycles))
+
+        batch.memory[2, 0x200] = 0x00
+        batch.pc[:] = 0x201
+        reasons, cycles, instructions = batch.run(max_instructions=5,
+                                                  stop_opcodes=[0x00])
+        self.assertEqual(['instructions', 'instructions', 'opcode'], reasons)
+        self.assertEqual([5, 5, 1], list(instructions))
+
+    def test_random_programs_match_mpu(self):
+        rng = random.Random(6502)
+        lanes = 8
+        batch = BatchMPU(lanes)
+        mpus = []
+        for lane in range(lanes):
+            memory = [rng.randrange(256) for _ in range(0x10000)]
+            mpu = self._make_mpu(memory=memory)
+            mpu.pc = rng.randrange(0x10000)
+            mpu.p = rng.randrange(256)
+            mpus.append(mpu)
+            batch.load(mpu, lane)
+        stop_pcs = [rng.randrange(0x10000) for _ in range(16)]
+
+        reasons, cycles, instructions = batch.run(max_cycles=2000,
+                                                  stop_pcs=stop_pcs)
+        for lane, mpu in enumerate(mpus):
+            self.assertEqual((reasons[lane], cycles[lane], instructions[lane]),
+                             mpu.run(max_cycles=2000, stop_pcs=stop_pcs))
+            self._assertSameState(mpu, batch.lane(lane))
+
+    # Test Helpers
+
+    def _assertSameState(self, expected, actual):
+        self.assertEqual(repr(expected), repr(actual))
+        self.assertEqual(expected.processorCycles, actual.processorCycles)
+        self.assertEqual(expected.memory[:], actual.memory[:])
+
+    def _write(self, memory, start_address, bytes):
+        memory[start_address:start_address + len(bytes)] = bytes
+
+    def _make_mpu(self, *args, **kargs):
+        kargs.setdefault('pc', 0x200)
+        return mpu6502.MPU(*args, **kargs)
+
+
+def test_suite():
+    return unittest.findTestCases(sys.modules[__name__])
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
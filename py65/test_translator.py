@@ -0,0 +1,162 @@
+import random
+import unittest
+import os
+import sys
+
+sys.path.append(os.getcwd())
+
+from devices import mpu6502, mpu65c02
+from translator import Translator
+
+
+class TranslatorTests(unittest.TestCase):
+
+    def test_block_ends_at_branch(self):
+        mpu = self._make_mpu()
+        # $0200 LDX #$05
+        # $0202 INX
+        # $0203 BNE $0202
+        self._write(mpu.memory, 0x200, (0xA2, 0x05, 0xE8, 0xD0, 0xFD))
+        translator = Translator(mpu)
+        block = translator.translate(0x200)
+        self.assertEqual(3, block.count)
+        self.assertEqual(frozenset((0x202, 0x203)), block.pcs)
+
+    def test_block_runs_like_step(self):
+        stepped = self._make_mpu()
+        translated = self._make_mpu()
+        # $0200 LDA #$80
+        # $0202 STA $10
+        # $0204 ASL $10
+        # $0206 ROL A
+        # $0207 ADC #$7F
+        # $0209 PHA
+        # $020A PHP
+        # $020B PLA
+        # $020C JSR $0300
+        # $0300 RTS
+        program = (0xA9, 0x80, 0x85, 0x10, 0x06, 0x10, 0x2A, 0x69, 0x7F,
+                   0x48, 0x08, 0x68, 0x20, 0x00, 0x03)
+        for mpu in (stepped, translated):
+            self._write(mpu.memory, 0x200, program)
+            mpu.memory[0x300] = 0x60
+        translated.enable_translation()
+        for _ in range(10):
+            stepped.step()
+        translated.run(max_instructions=10)
+        self.assertEqual(0x020F, stepped.pc)
+        self._assertSameState(stepped, translated)
+
+    def test_decimal_mode_uses_handler(self):
+        mpu = self._make_mpu()
+        # $0200 SED
+        # $0201 CLC
+        # $0202 LDA #$19
+        # $0204 ADC #$01
+        # $0206 BRK
+        self._write(mpu.memory, 0x200, (0xF8, 0x18, 0xA9, 0x19,
+                                        0x69, 0x01, 0x00))
+        mpu.enable_translation()
+        mpu.run(stop_opcodes=[0x00])
+        self.assertEqual(0x20, mpu.a)
+        self.assertEqual(0x206, mpu.pc)
+
+    def test_self_modifying_code_is_retranslated(self):
+        mpu = self._make_mpu()
+        # $0200 LDA #$01
+        # $0202 STA $0206
+        # $0205 LDX #$00
+        # $0207 BRK
+        self._write(mpu.memory, 0x200, (0xA9, 0x01, 0x8D, 0x06, 0x02,
+                                        0xA2, 0x00, 0x00))
+        mpu.enable_translation()
+        mpu.run(stop_opcodes=[0x00])
+        self.assertEqual(0x01, mpu.x)
+        self.assertEqual(0x207, mpu.pc)
+
+    def test_stop_pc_inside_block(self):
+        mpu = self._make_mpu()
+        # $0200 INX
+        # $0201 INX
+        # $0202 INX
+        # $0203 BRK
+        self._write(mpu.memory, 0x200, (0xE8, 0xE8, 0xE8, 0x00))
+        mpu.enable_translation()
+        reason, cycles, instructions = mpu.run(stop_pcs=[0x202])
+        self.assertEqual(('pc', 4, 2), (reason, cycles, instructions))
+        self.assertEqual(2, mpu.x)
+
+    def test_cycle_budget_inside_block(self):
+        stepped = self._make_mpu()
+        translated = self._make_mpu()
+        # $0200 INX (x8)
+        # $0208 BRA $0200
+        program = (0xE8,) * 8 + (0x80, 0xF6)
+        for mpu in (stepped, translated):
+            self._write(mpu.memory, 0x200, program)
+        translated.enable_translation()
+        self.assertEqual(stepped.run(max_cycles=7),
+                         translated.run(max_cycles=7))
+        self._assertSameState(stepped, translated)
+
+    def test_overridden_helpers_disable_inlining(self):
+        base = self.MPU
+
+        class MPU(base):
+            def FlagsNZ(self, value):
+                base.FlagsNZ(self, value)
+
+        mpu = MPU()
+        self.assertEqual({}, Translator(mpu)._specs)
+
+    def test_random_programs_match_step(self):
+        rng = random.Random(6502)
+        for _ in range(10):
+            memory = [rng.randrange(256) for _ in range(0x10000)]
+            stepped = self._make_mpu(memory=memory[:])
+            translated = self._make_mpu(memory=memory[:])
+            stepped.pc = translated.pc = rng.randrange(0x10000)
+            stepped.p = translated.p = rng.randrange(256)
+            translated.enable_translation()
+            stop_pcs = [rng.randrange(0x10000) for _ in range(16)]
+            self.assertEqual(stepped.run(max_cycles=2000, stop_pcs=stop_pcs),
+                             translated.run(max_cycles=2000,
+                                            stop_pcs=stop_pcs))
+            self._assertSameState(stepped, translated)
+
+    # Test Helpers
+
+    MPU = mpu6502.MPU
+
+    def _assertSameState(self, expected, actual):
+        self.assertEqual(repr(expected), repr(actual))
+        self.assertEqual(expected.processorCycles, actual.processorCycles)
+        self.assertEqual(expected.memory[:], actual.memory[:])
+
+    def _write(self, memory, start_address, bytes):
+        memory[start_address:start_address + len(bytes)] = bytes
+
+    def _make_mpu(self, *args, **kargs):
+        kargs.setdefault('pc', 0x200)
+        return self.MPU(*args, **kargs)
+
+
+class Translator65C02Tests(TranslatorTests):
+
+    MPU = mpu65c02.MPU
+
+    def test_cmos_instructions_are_inlined(self):
+        mpu = self._make_mpu()
+        translator = Translator(mpu)
+        for opcode in (0x12, 0x1a, 0x5a, 0x64, 0x80, 0x9e, 0xfa):
+            self.assertTrue(opcode in translator._specs)
+        # WAI and TSB are always left to their handlers
+        for opcode in (0xcb, 0x04):
+            self.assertFalse(opcode in translator._specs)
+
+
+def test_suite():
+    return unittest.findTestCases(sys.modules[__name__])
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
@@ -146,6 +146,39 @@ class ObservableMemoryTests(unittest.TestCase):
         self.assertEqual(0x01, subject[0xC000])
         self.assertEqual(0x02, subject[0xC001])
 
+    # copy
+
+    def test_copy_copies_subject_and_keeps_subscribers(self):
+        subject = self._make_subject()
+        mem = ObservableMemory(subject=subject)
+        calls = []
+
+        def write_subscriber(address, value):
+            calls.append(address)
+
+        mem.subscribe_to_write([0xC000], write_subscriber)
+        mem[0xC001] = 0xAB
+        other = mem.copy()
+        other[0xC000] = 0x01
+        other[0xC001] = 0x02
+        self.assertEqual([0xC000], calls)
+        self.assertEqual(0x02, other[0xC001])
+        self.assertEqual(0xAB, subject[0xC001])
+
+    def test_copy_leaves_out_subscribers_of_owners(self):
+        mem = ObservableMemory(subject=self._make_subject())
+        calls = []
+
+        class Owner:
+            def write_subscriber(self, address, value):
+                calls.append(address)
+
+        owner = Owner()
+        mem.subscribe_to_write([0xC000], owner.write_subscriber)
+        other = mem.copy(owners=[owner])
+        other[0xC000] = 0x01
+        self.assertEqual([], calls)
+
     # Test Helpers
 
     def _make_subject(self):
@@ -2,7 +2,9 @@ import unittest
 import sys
 import os
 import tempfile
+import json
 from py65.monitor import Monitor
+from py65.bustrace import read_records
 
 try:
     from StringIO import StringIO
@@ -995,6 +997,360 @@ class MonitorTests(unittest.TestCase):
         out = stdout.getvalue()
         self.assertTrue(out.startswith('save'))
 
+    # save_state / load_state
+
+    def test_save_state_syntax_error(self):
+        stdout = StringIO()
+        mon = Monitor(stdout=stdout)
+        mon.do_save_state('filename zip')
+        out = stdout.getvalue()
+        self.assertTrue(out.startswith('Syntax error'))
+
+    def test_load_state_resumes_saved_state(self):
+        for compress in ('', ' compress'):
+            stdout = StringIO()
+            mon = Monitor(stdout=stdout)
+            mon._mpu.memory[0xC000:0xC003] = [0xAA, 0xBB, 0xCC]
+            mon._mpu.pc = 0xC000
+            mon._mpu.processorCycles = 1234
+
+            filename = tempfile.mktemp()
+            try:
+                mon.do_save_state("'%s'%s" % (filename, compress))
+                mon._mpu.memory[0xC000] = 0x00
+                mon._mpu.pc = 0x0000
+                mon.do_load_state("'%s'" % filename)
+            finally:
+                os.unlink(filename)
+            self.assertEqual([0xAA, 0xBB, 0xCC], mon._mpu.memory[0xC000:0xC003])
+            self.assertEqual(0xC000, mon._mpu.pc)
+            self.assertEqual(1234, mon._mpu.processorCycles)
+
+    def test_load_state_switches_mpu(self):
+        stdout = StringIO()
+        mon = Monitor(stdout=stdout)
+        mon.do_mpu('65Org16')
+        mon._mpu.memory[0x3FFFF] = 0xBEEF
+
+        filename = tempfile.mktemp()
+        try:
+            mon.do_save_state("'%s'" % filename)
+            mon.do_mpu('6502')
+            mon.do_load_state("'%s'" % filename)
+        finally:
+            os.unlink(filename)
+        self.assertEqual('65Org16', mon._mpu.name)
+        self.assertEqual(0xBEEF, mon._mpu.memory[0x3FFFF])
+
+    def test_load_state_rejects_other_files(self):
+        stdout = StringIO()
+        mon = Monitor(stdout=stdout)
+        filename = tempfile.mktemp()
+        try:
+            f = open(filename, 'wb')
+            f.write(b'\xaa\xbb\xcc')
+            f.close()
+            mon.do_load_state("'%s'" % filename)
+        finally:
+            os.unlink(filename)
+        out = stdout.getvalue()
+        self.assertTrue(out.startswith('Cannot load state'))
+
+    def test_help_save_state(self):
+        stdout = StringIO()
+        mon = Monitor(stdout=stdout)
+        mon.help_save_state()
+        mon.help_load_state()
+        out = stdout.getvalue()
+        self.assertTrue(out.startswith('save_state'))
+        self.assertTrue('load_state' in out)
+
+    # bus_trace
+
+    def test_bus_trace_records_to_file(self):
+        stdout = StringIO()
+        mon = Monitor(stdout=stdout)
+        mon._mpu.memory[0xC000] = 0xEA  # NOP
+        mon._mpu.pc = 0xC000
+        filename = tempfile.mktemp()
+        try:
+            mon.do_bus_trace(filename)
+            mon.do_step('')
+            mon.do_bus_trace('')
+            mon.do_bus_trace('off')
+            self.assertFalse(mon._mpu.INSTRUMENTED)
+            records = list(read_records(filename))
+        finally:
+            os.unlink(filename)
+        self.assertEqual(0xC000, records[0][2])
+        out = stdout.getvalue()
+        self.assertTrue("Bus trace to %s holds" % filename in out)
+        self.assertTrue("Bus trace is off" in out)
+
+    def test_bus_trace_needs_the_m65c02a(self):
+        stdout = StringIO()
+        mon = Monitor(stdout=stdout)
+        mon.do_mpu('6502')
+        mon.do_bus_trace('trace.bus')
+        out = stdout.getvalue()
+        self.assertTrue("The 6502 has no bus trace" in out)
+
+    def test_reset_keeps_the_plain_mpu_class(self):
+        stdout = StringIO()
+        mon = Monitor(stdout=stdout)
+        klass = type(mon._mpu)
+        mon.do_mode('functional')
+        mon.do_reset('')
+        self.assertTrue(type(mon._mpu) is klass)
+
+    def test_help_bus_trace(self):
+        stdout = StringIO()
+        mon = Monitor(stdout=stdout)
+        mon.help_bus_trace()
+        out = stdout.getvalue()
+        self.assertTrue(out.startswith('bus_trace'))
+
+    # histogram
+
+    def test_histogram_counts_and_exports(self):
+        stdout = StringIO()
+        mon = Monitor(stdout=stdout)
+        # $C000 INX
+        # $C001 INX
+        # $C002 NOP
+        mon._mpu.memory[0xC000:0xC003] = [0xE8, 0xE8, 0xEA]
+        mon._mpu.pc = 0xC000
+        mon.do_histogram('on')
+        mon.do_step('')
+        mon.do_step('')
+        mon.do_step('')
+        mon.do_histogram('')
+        filename = tempfile.mktemp() + '.json'
+        try:
+            mon.do_histogram('export %s' % filename)
+            with open(filename) as f:
+                exported = json.load(f)
+        finally:
+            os.unlink(filename)
+        self.assertEqual(3, exported['total'])
+        self.assertEqual(0xE8, exported['opcodes'][0]['opcode'])
+        self.assertEqual(2, exported['opcodes'][0]['count'])
+        mon.do_histogram('reset')
+        self.assertEqual(0, mon._opcode_profile.total())
+        mon.do_histogram('off')
+        self.assertFalse(mon._mpu.INSTRUMENTED)
+        out = stdout.getvalue()
+        self.assertTrue("Instruction Histogram: 3 executed" in out)
+        self.assertTrue("Wrote 2 opcodes to %s" % filename in out)
+        self.assertTrue("Histogram is off" in out)
+
+    def test_histogram_show_when_off(self):
+        stdout = StringIO()
+        mon = Monitor(stdout=stdout)
+        mon.do_histogram('show')
+        out = stdout.getvalue()
+        self.assertTrue("Histogram is off" in out)
+
+    def test_help_histogram(self):
+        stdout = StringIO()
+        mon = Monitor(stdout=stdout)
+        mon.help_histogram()
+        out = stdout.getvalue()
+        self.assertTrue(out.startswith('histogram'))
+
+    # profile
+
+    def test_profile_reports_hot_addresses_of_goto(self):
+        stdout = StringIO()
+        mon = Monitor(stdout=stdout)
+        # $C000 LDX #$05
+        # $C002 DEX
+        # $C003 BNE $C002
+        # $C005 BRK
+        mon._mpu.memory[0xC000:0xC006] = [0xA2, 0x05, 0xCA, 0xD0, 0xFD, 0x00]
+        mon.do_add_label('c002 loop')
+        mon.do_profile('on')
+        mon.do_goto('c000')
+        self.assertFalse(mon._mpu.INSTRUMENTED)
+        mon.do_profile('show 2')
+        out = stdout.getvalue()
+        self.assertTrue("Address profile: 11 instructions, 17 cycles" in out)
+        self.assertTrue("$C002          5          5  29.41  loop"
+                        "         DEX" in out)
+        self.assertTrue("$C000-$C003         11         17 100.00" in out)
+        mon.do_profile('reset')
+        self.assertEqual(0, mon._address_profile.total())
+
+    def test_profile_of_65org16_is_sparse(self):
+        stdout = StringIO()
+        mon = Monitor(stdout=stdout)
+        mon.do_mpu('65Org16')
+        mon._mpu.memory[0xC000:0xC002] = [0xE8, 0x00]  # INX, BRK
+        mon.do_profile('on')
+        mon.do_goto('c000')
+        self.assertFalse(mon._address_profile.dense)
+        self.assertEqual([(0xC000, 1, 2)], mon._address_profile.addresses())
+
+    def test_profile_show_when_off(self):
+        stdout = StringIO()
+        mon = Monitor(stdout=stdout)
+        mon.do_profile('')
+        out = stdout.getvalue()
+        self.assertTrue("Profile is off" in out)
+
+    def test_help_profile(self):
+        stdout = StringIO()
+        mon = Monitor(stdout=stdout)
+        mon.help_profile()
+        out = stdout.getvalue()
+        self.assertTrue(out.startswith('profile'))
+
+    # callgraph
+
+    def test_callgraph_reports_and_exports_routines(self):
+        stdout = StringIO()
+        mon = Monitor(stdout=stdout)
+        # $C000 JSR $C010
+        # $C003 BRK
+        # $C010 RTS
+        mon._mpu.memory[0xC000:0xC004] = [0x20, 0x10, 0xC0, 0x00]
+        mon._mpu.memory[0xC010] = 0x60
+        mon.do_add_label('c000 main')
+        mon.do_add_label('c010 sub')
+        mon.do_callgraph('on')
+        mon.do_goto('c000')
+        mon.do_callgraph('show')
+        filename = tempfile.mktemp() + '.folded'
+        try:
+            mon.do_callgraph('export %s' % filename)
+            with open(filename) as f:
+                folded = f.read().splitlines()
+            mon.do_callgraph('export %s callgrind' % filename)
+            with open(filename) as f:
+                callgrind = f.read()
+        finally:
+            os.unlink(filename)
+        self.assertEqual('main;sub', folded[1].split()[0])
+        self.assertTrue('cfn=sub\ncalls=1 0xC010\n' in callgrind)
+        out = stdout.getvalue()
+        self.assertTrue("Call graph is on" in out)
+        self.assertTrue(out.find("  sub ") > out.find("routine"))
+
+    def test_help_callgraph(self):
+        stdout = StringIO()
+        mon = Monitor(stdout=stdout)
+        mon.help_callgraph()
+        out = stdout.getvalue()
+        self.assertTrue(out.startswith('callgraph'))
+
+    # mode
+
+    def test_mode_switches_to_functional_and_back(self):
+        stdout = StringIO()
+        mon = Monitor(stdout=stdout)
+        # $C000 INX
+        # $C001 JMP $C000
+        mon._mpu.memory[0xC000:0xC004] = [0xE8, 0x4C, 0x00, 0xC0]
+        mon.do_mode('functional')
+        self.assertTrue(mon._mpu.FUNCTIONAL)
+        mon.do_add_breakpoint('c001')
+        mon.do_goto('c000')
+        self.assertEqual(0, mon._mpu.processorCycles)
+        mon.do_mode('accurate')
+        self.assertFalse(mon._mpu.FUNCTIONAL)
+        mon.do_step('')
+        self.assertTrue(mon._mpu.processorCycles > 0)
+        out = stdout.getvalue()
+        self.assertTrue("Mode is functional" in out)
+        self.assertTrue("Breakpoint 0 reached." in out)
+        self.assertTrue("Mode is accurate" in out)
+
+    def test_mode_functional_refused_while_recording_history(self):
+        stdout = StringIO()
+        mon = Monitor(stdout=stdout)
+        mon.do_history('on')
+        mon.do_mode('functional')
+        self.assertFalse(mon._mpu.FUNCTIONAL)
+        out = stdout.getvalue()
+        self.assertTrue("History needs the accurate mode" in out)
+
+    def test_help_mode(self):
+        stdout = StringIO()
+        mon = Monitor(stdout=stdout)
+        mon.help_mode()
+        out = stdout.getvalue()
+        self.assertTrue(out.startswith('mode'))
+
+    # history / step_back / reverse_continue / seek
+
+    def test_step_back_needs_history(self):
+        stdout = StringIO()
+        mon = Monitor(stdout=stdout)
+        mon.do_step_back('')
+        out = stdout.getvalue()
+        self.assertEqual("History is off\n", out)
+
+    def test_step_back_undoes_step(self):
+        stdout = StringIO()
+        mon = Monitor(stdout=stdout)
+        mon._mpu.memory[0xC000:0xC003] = [0x8D, 0x00, 0xC1]  # STA $C100
+        mon._mpu.pc = 0xC000
+        mon._mpu.a[0] = 0x42
+        mon.do_history('on')
+        mon.do_step('')
+        self.assertEqual(0x42, mon._mpu.memory[0xC100])
+        mon.do_step_back('')
+        self.assertEqual(0x00, mon._mpu.memory[0xC100])
+        self.assertEqual(0xC000, mon._mpu.pc)
+        mon.do_step_back('1')
+        out = stdout.getvalue()
+        self.assertTrue("Reached the start of history" in out)
+
+    def test_reverse_continue_stops_at_breakpoint(self):
+        stdout = StringIO()
+        mon = Monitor(stdout=stdout)
+        # $C000 INX
+        # $C001 JMP $C000
+        mon._mpu.memory[0xC000:0xC004] = [0xE8, 0x4C, 0x00, 0xC0]
+        mon._mpu.pc = 0xC000
+        mon.do_history('on')
+        for _ in range(5):
+            mon.do_step('')
+        mon.do_add_breakpoint('c001')
+        mon.do_reverse_continue('')
+        out = stdout.getvalue()
+        self.assertTrue("Breakpoint 0 reached." in out)
+        self.assertEqual(0xC001, mon._mpu.pc)
+        self.assertEqual(2, mon._mpu.x[0])
+
+    def test_seek_goes_back_to_cycle(self):
+        stdout = StringIO()
+        mon = Monitor(stdout=stdout)
+        # $C000 INX
+        # $C001 JMP $C000
+        mon._mpu.memory[0xC000:0xC004] = [0xE8, 0x4C, 0x00, 0xC0]
+        mon._mpu.pc = 0xC000
+        start = mon._mpu.processorCycles
+        mon.do_history('on')
+        for _ in range(10):
+            mon.do_step('')
+        mon.do_seek(str(start))
+        self.assertEqual(start, mon._mpu.processorCycles)
+        self.assertEqual(0xC000, mon._mpu.pc)
+        self.assertEqual(0, mon._mpu.x[0])
+
+    def test_help_history(self):
+        stdout = StringIO()
+        mon = Monitor(stdout=stdout)
+        mon.help_history()
+        mon.help_step_back()
+        mon.help_reverse_continue()
+        mon.help_seek()
+        out = stdout.getvalue()
+        self.assertTrue(out.startswith('history'))
+        for command in ('step_back', 'reverse_continue', 'seek'):
+            self.assertTrue(command in out)
+
     # step
 
     def test_shortcut_for_step(self):
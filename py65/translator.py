@@ -0,0 +1,783 @@
+from collections import defaultdict
+
+from devices import mpu6502, mpu65c02
+from memory import ObservableMemory
+
+
+class Block:
+    """A translated run of straight-line guest code.
+    """
+
+    def __init__(self, start, function, count, bound, pcs, opcodes, source):
+        self.start = start        # address of the first instruction
+        self.function = function  # function(mpu) -> instructions executed
+        self.count = count        # instructions in the block
+        self.bound = bound        # worst-case cycles before the last one
+        self.pcs = pcs            # addresses of all but the first instruction
+        self.opcodes = opcodes    # opcodes of all but the first instruction
+        self.source = source      # generated Python source, for debugging
+
+
+class Translator:
+    """Translate basic blocks of 6502-family guest code into Python
+    functions.  A block runs from its start address up to and including
+    the first branch, JMP, JSR, RTS, RTI, BRK or instruction that has no
+    inline translation.  Each block is compiled once and cached by its
+    start address, and is dropped when ObservableMemory sees a write to
+    any of its bytes.
+
+    Instructions are only inlined when the MPU still uses the stock 6502
+    or 65C02 handler for the opcode; anything else, and decimal mode
+    ADC/SBC, is executed by calling the MPU's own handler.
+    """
+
+    MAX_BLOCK = 32
+
+    # helpers and operations the inlined code reproduces
+    _helpers = ('ByteAt', 'WordAt', 'WrapAt', 'stPush', 'stPop',
+                'stPushWord', 'stPopWord', 'FlagsNZ', 'BranchRelAddr',
+                'ProgramCounter', 'ImmediateByte', 'ZeroPageAddr',
+                'ZeroPageXAddr', 'ZeroPageYAddr', 'IndirectXAddr',
+                'IndirectYAddr', 'AbsoluteAddr', 'AbsoluteXAddr',
+                'AbsoluteYAddr', 'opORA', 'opASL', 'opLSR', 'opBCL', 'opBST',
+                'opCLR', 'opSET', 'opAND', 'opBIT', 'opROL', 'opEOR',
+                'opROR', 'opSTA', 'opSTY', 'opSTX', 'opCMPR', 'opDECR',
+                'opINCR', 'opLDA', 'opLDY', 'opLDX')
+
+    # operations that are left to the MPU's handlers when overridden
+    _operations = {'opADC': 'ADC', 'opSBC': 'SBC'}
+
+    _cmos_helpers = ('ZeroPageIndirectAddr', 'opSTZ')
+
+    # 65C02 opcodes with an inline translation, as (name, mode)
+    _cmos = {0x12: ('ORA', 'zpi'), 0x1a: ('INC', 'acc'),
+             0x32: ('AND', 'zpi'), 0x34: ('BIT', 'zpx'),
+             0x3a: ('DEC', 'acc'), 0x3c: ('BIT', 'abx'),
+             0x52: ('EOR', 'zpi'), 0x5a: ('PHY', 'imp'),
+             0x64: ('STZ', 'zpg'), 0x72: ('ADC', 'zpi'),
+             0x74: ('STZ', 'zpx'), 0x7a: ('PLY', 'imp'),
+             0x80: ('BRA', 'rel'), 0x92: ('STA', 'zpi'),
+             0x9c: ('STZ', 'abs'), 0x9e: ('STZ', 'abx'),
+             0xb2: ('LDA', 'zpi'), 0xd2: ('CMP', 'zpi'),
+             0xda: ('PHX', 'imp'), 0xf2: ('SBC', 'zpi'),
+             0xfa: ('PLX', 'imp')}
+
+    # instructions that end a block
+    _terminators = ('BRA', 'JMP', 'JSR', 'RTS')
+
+    _lengths = {'imp': 1, 'acc': 1, 'imm': 2, 'zpg': 2, 'zpx': 2, 'zpy': 2,
+                'inx': 2, 'iny': 2, 'zpi': 2, 'rel': 2,
+                'abs': 3, 'abx': 3, 'aby': 3}
+
+    # branch name: (flag attribute, taken when the flag is set)
+    _branches = {'BPL': ('NEGATIVE', False), 'BMI': ('NEGATIVE', True),
+                 'BVC': ('OVERFLOW', False), 'BVS': ('OVERFLOW', True),
+                 'BCC': ('CARRY', False), 'BCS': ('CARRY', True),
+                 'BNE': ('ZERO', False), 'BEQ': ('ZERO', True)}
+
+    def __init__(self, mpu):
+        if not isinstance(mpu.memory, ObservableMemory):
+            mpu.memory = ObservableMemory(subject=mpu.memory,
+                                          addrWidth=mpu.ADDR_WIDTH)
+        self._mpu = mpu
+        self._memory = mpu.memory
+        self._blocks = {}
+        self._owners = defaultdict(list)
+        self._dirty = [False]
+        self._specs = self._inline_specs()
+
+    def _inline_specs(self):
+        mpu = self._mpu
+        klass = type(mpu)
+        nmos = mpu6502.MPU
+        for name in self._helpers:
+            if getattr(klass, name) is not getattr(nmos, name):
+                return {}
+
+        overridden = set()
+        for method, name in self._operations.items():
+            if getattr(klass, method) is not getattr(nmos, method):
+                overridden.add(name)
+
+        cmos = None
+        if isinstance(mpu, mpu65c02.MPU):
+            cmos = mpu65c02.MPU
+            for name in self._cmos_helpers:
+                if getattr(klass, name) is not getattr(cmos, name):
+                    cmos = None
+                    break
+
+        specs = {}
+        for opcode in range(256):
+            handler = mpu.instruct[opcode]
+            if handler is nmos.instruct[opcode]:
+                name, mode = nmos.disassemble[opcode]
+            elif (cmos is not None and opcode in self._cmos and
+                  handler is cmos.instruct[opcode]):
+                name, mode = self._cmos[opcode]
+            else:
+                continue
+            if name in overridden:
+                continue
+            if mode in self._lengths and self._supports(name):
+                specs[opcode] = (name, mode)
+        return specs
+
+    def _supports(self, name):
+        return hasattr(self, '_op_' + name) or name in self._branches
+
+    # Execution
+
+    def run(self, max_cycles=None, max_instructions=None,
+            stop_pcs=(), stop_opcodes=()):
+        """ Same contract as MPU.run().  Whole blocks are executed when no
+        stop condition can be met inside them; otherwise the MPU steps
+        one instruction at a time until it is past the stop point.
+        """
+        mpu = self._mpu
+        memory = self._memory
+        blocks = self._blocks
+        dirty = self._dirty
+        stop_pcs = frozenset(stop_pcs)
+        stop_opcodes = frozenset(stop_opcodes)
+        clear = {}
+
+        start_cycles = mpu.processorCycles
+        if max_cycles is None:
+            cycle_limit = None
+        else:
+            cycle_limit = start_cycles + max_cycles
+        instructions = 0
+
+        while True:
+            if cycle_limit is not None and mpu.processorCycles >= cycle_limit:
+                reason = 'cycles'
+                break
+            if instructions == max_instructions:
+                reason = 'instructions'
+                break
+
+            if mpu.waiting:
+                if cycle_limit is None:
+                    reason = 'waiting'
+                    break
+                mpu.processorCycles += 1
+                continue
+
+            pc = mpu.pc
+            block = blocks.get(pc)
+            if block is None:
+                block = self.translate(pc)
+
+            fits = clear.get(block)
+            if fits is None:
+                fits = not ((block.pcs & stop_pcs) or
+                            (block.opcodes & stop_opcodes))
+                clear[block] = fits
+            if fits and max_instructions is not None:
+                fits = instructions + block.count <= max_instructions
+            if fits and cycle_limit is not None:
+                fits = mpu.processorCycles + block.bound < cycle_limit
+
+            if fits:
+                dirty[0] = False
+                instructions += block.function(mpu)
+            else:
+                mpu.step()
+                instructions += 1
+
+            if stop_opcodes and memory[mpu.pc] in stop_opcodes:
+                reason = 'opcode'
+                break
+            if mpu.pc in stop_pcs:
+                reason = 'pc'
+                break
+
+        return reason, mpu.processorCycles - start_cycles, instructions
+
+    def invalidate(self, address, value=None):
+        starts = self._owners.pop(address, None)
+        if starts:
+            for start in starts:
+                self._blocks.pop(start, None)
+            self._dirty[0] = True
+
+    def flush(self):
+        self._blocks.clear()
+        self._owners.clear()
+        self._dirty[0] = True
+
+    # Translation
+
+    def translate(self, start):
+        """ Translate the block starting at the given address, cache it
+        and return it.
+        """
+        mpu = self._mpu
+        memory = self._memory
+        physMask = memory.physMask
+        addrMask = mpu.addrMask
+
+        emitter = _Emitter(mpu)
+        pcs = []
+        opcodes = []
+        covered = []
+        pc = start
+        bound = 0
+        cost = 0
+
+        while True:
+            opcode = memory[pc]
+            spec = self._specs.get(opcode)
+            pcs.append(pc)
+            opcodes.append(opcode)
+            covered.append(pc)
+            bound += cost
+            # page crossing, branches and decimal mode cost at most 2 more
+            cost = mpu.cycletime[opcode] + 2
+
+            if spec is None:
+                emitter.fallback(pc, opcode)
+                break
+
+            name, mode = spec
+            length = self._lengths[mode]
+            operand = (pc + 1) & addrMask
+            value = None
+            if length > 1:
+                value = memory[operand]
+                covered.append(operand)
+            if length > 2:
+                operand = (operand + 1) & addrMask
+                value += memory[operand] << mpu.BYTE_WIDTH
+                covered.append(operand)
+
+            if name in self._branches:
+                self._op_branch(emitter, pc, opcode, name, value)
+                break
+            getattr(self, '_op_' + name)(emitter, pc, opcode, mode, value)
+            if name in self._terminators:
+                break
+            emitter.advance(pc, opcode, length)
+
+            pc = (pc + length) & addrMask
+            if len(pcs) == self.MAX_BLOCK:
+                emitter.finish(pc)
+                break
+
+        function, source = emitter.compile(start, self._dirty)
+        block = Block(start, function, len(pcs), bound,
+                      frozenset(pcs[1:]), frozenset(opcodes[1:]), source)
+
+        covered = set(address & physMask for address in covered)
+        for address in covered:
+            self._owners[address].append(start)
+        memory.subscribe_to_write(covered, self.invalidate)
+        self._blocks[start] = block
+        return block
+
+    # Inline translations: each emits the instruction at pc, whose operand
+    # is value, except for control flow which also emits the block exit.
+
+    def _op_LDA(self, e, pc, opcode, mode, value):
+        e.line('a = %s' % e.read(pc, opcode, mode, value))
+        e.flags_nz('a')
+
+    def _op_LDX(self, e, pc, opcode, mode, value):
+        e.line('x = %s' % e.read(pc, opcode, mode, value))
+        e.flags_nz('x')
+
+    def _op_LDY(self, e, pc, opcode, mode, value):
+        e.line('y = %s' % e.read(pc, opcode, mode, value))
+        e.flags_nz('y')
+
+    def _op_STA(self, e, pc, opcode, mode, value):
+        e.write(e.address(pc, opcode, mode, value), 'a')
+
+    def _op_STX(self, e, pc, opcode, mode, value):
+        e.write(e.address(pc, opcode, mode, value), 'x')
+
+    def _op_STY(self, e, pc, opcode, mode, value):
+        e.write(e.address(pc, opcode, mode, value), 'y')
+
+    def _op_STZ(self, e, pc, opcode, mode, value):
+        e.write(e.address(pc, opcode, mode, value), '0')
+
+    def _op_ORA(self, e, pc, opcode, mode, value):
+        e.line('a |= %s' % e.read(pc, opcode, mode, value))
+        e.flags_nz('a')
+
+    def _op_AND(self, e, pc, opcode, mode, value):
+        e.line('a &= %s' % e.read(pc, opcode, mode, value))
+        e.flags_nz('a')
+
+    def _op_EOR(self, e, pc, opcode, mode, value):
+        e.line('a ^= %s' % e.read(pc, opcode, mode, value))
+        e.flags_nz('a')
+
+    def _op_ADC(self, e, pc, opcode, mode, value):
+        e.decimal_fallback(pc, opcode)
+        e.line('data = %s' % e.read(pc, opcode, mode, value))
+        e.line('result = data + a + (p & %d)' % e.C)
+        e.line('p &= %d' % ~(e.C | e.V | e.N | e.Z))
+        e.line('if (~(a ^ data) & (a ^ result)) & %d:' % e.N)
+        e.line('    p |= %d' % e.V)
+        e.line('if result > %d:' % e.BM)
+        e.line('    p |= %d' % e.C)
+        e.line('    result &= %d' % e.BM)
+        e.line('a = result')
+        e.line('p |= (a & %d) if a else %d' % (e.N, e.Z))
+        e.dedent()
+
+    def _op_SBC(self, e, pc, opcode, mode, value):
+        e.decimal_fallback(pc, opcode)
+        e.line('data = %s' % e.read(pc, opcode, mode, value))
+        e.line('result = a + (~data & %d) + (p & %d)' % (e.BM, e.C))
+        e.line('p &= %d' % ~(e.C | e.V | e.N | e.Z))
+        e.line('if ((a ^ data) & (a ^ result)) & %d:' % e.N)
+        e.line('    p |= %d' % e.V)
+        e.line('a = result & %d' % e.BM)
+        e.line('if a == 0:')
+        e.line('    p |= %d' % e.Z)
+        e.line('if result > %d:' % e.BM)
+        e.line('    p |= %d' % e.C)
+        e.line('p |= a & %d' % e.N)
+        e.dedent()
+
+    def _compare(self, e, pc, opcode, mode, value, register):
+        e.line('data = %s' % e.read(pc, opcode, mode, value))
+        e.line('p &= %d' % ~(e.C | e.Z | e.N))
+        e.line('if %s == data:' % register)
+        e.line('    p |= %d' % (e.C | e.Z))
+        e.line('elif %s > data:' % register)
+        e.line('    p |= %d' % e.C)
+        e.line('p |= (%s - data) & %d' % (register, e.N))
+
+    def _op_CMP(self, e, pc, opcode, mode, value):
+        self._compare(e, pc, opcode, mode, value, 'a')
+
+    def _op_CPX(self, e, pc, opcode, mode, value):
+        self._compare(e, pc, opcode, mode, value, 'x')
+
+    def _op_CPY(self, e, pc, opcode, mode, value):
+        self._compare(e, pc, opcode, mode, value, 'y')
+
+    def _op_BIT(self, e, pc, opcode, mode, value):
+        e.line('data = %s' % e.read(pc, opcode, mode, value))
+        e.line('p &= %d' % ~(e.Z | e.N | e.V))
+        e.line('if (a & data) == 0:')
+        e.line('    p |= %d' % e.Z)
+        e.line('p |= data & %d' % (e.N | e.V))
+
+    def _read_modify_write(self, e, pc, opcode, mode, value, lines):
+        if mode == 'acc':
+            e.line('data = a')
+        else:
+            e.line('ea = %s' % e.address(pc, opcode, mode, value))
+            e.line('data = memory[ea]')
+        for line in lines:
+            e.line(line)
+        if mode == 'acc':
+            e.line('a = data')
+        else:
+            e.write('ea', 'data')
+
+    def _op_ASL(self, e, pc, opcode, mode, value):
+        self._read_modify_write(e, pc, opcode, mode, value, [
+            'p &= %d' % ~(e.C | e.N | e.Z),
+            'if data & %d:' % e.N,
+            '    p |= %d' % e.C,
+            'data = (data << 1) & %d' % e.BM,
+            'p |= (data & %d) if data else %d' % (e.N, e.Z)])
+
+    def _op_LSR(self, e, pc, opcode, mode, value):
+        self._read_modify_write(e, pc, opcode, mode, value, [
+            'p &= %d' % ~(e.C | e.N | e.Z),
+            'p |= data & 1',
+            'data = data >> 1',
+            'if not data:',
+            '    p |= %d' % e.Z])
+
+    def _op_ROL(self, e, pc, opcode, mode, value):
+        self._read_modify_write(e, pc, opcode, mode, value, [
+            'if p & %d:' % e.C,
+            '    if not data & %d:' % e.N,
+            '        p &= %d' % ~e.C,
+            '    data = (data << 1) | 1',
+            'else:',
+            '    if data & %d:' % e.N,
+            '        p |= %d' % e.C,
+            '    data = data << 1',
+            'data &= %d' % e.BM,
+            e.nz('data')])
+
+    def _op_ROR(self, e, pc, opcode, mode, value):
+        self._read_modify_write(e, pc, opcode, mode, value, [
+            'if p & %d:' % e.C,
+            '    if not data & 1:',
+            '        p &= %d' % ~e.C,
+            '    data = (data >> 1) | %d' % e.N,
+            'else:',
+            '    if data & 1:',
+            '        p |= %d' % e.C,
+            '    data = data >> 1',
+            e.nz('data')])
+
+    def _op_INC(self, e, pc, opcode, mode, value):
+        self._read_modify_write(e, pc, opcode, mode, value, [
+            'data = (data + 1) & %d' % e.BM,
+            e.nz('data')])
+
+    def _op_DEC(self, e, pc, opcode, mode, value):
+        self._read_modify_write(e, pc, opcode, mode, value, [
+            'data = (data - 1) & %d' % e.BM,
+            e.nz('data')])
+
+    def _step_register(self, e, register, delta):
+        e.line('%s = (%s %s 1) & %d' % (register, register, delta, e.BM))
+        e.flags_nz(register)
+
+    def _op_INX(self, e, pc, opcode, mode, value):
+        self._step_register(e, 'x', '+')
+
+    def _op_INY(self, e, pc, opcode, mode, value):
+        self._step_register(e, 'y', '+')
+
+    def _op_DEX(self, e, pc, opcode, mode, value):
+        self._step_register(e, 'x', '-')
+
+    def _op_DEY(self, e, pc, opcode, mode, value):
+        self._step_register(e, 'y', '-')
+
+    def _transfer(self, e, source, destination, flags=True):
+        e.line('%s = %s' % (destination, source))
+        if flags:
+            e.flags_nz(destination)
+
+    def _op_TAX(self, e, pc, opcode, mode, value):
+        self._transfer(e, 'a', 'x')
+
+    def _op_TAY(self, e, pc, opcode, mode, value):
+        self._transfer(e, 'a', 'y')
+
+    def _op_TXA(self, e, pc, opcode, mode, value):
+        self._transfer(e, 'x', 'a')
+
+    def _op_TYA(self, e, pc, opcode, mode, value):
+        self._transfer(e, 'y', 'a')
+
+    def _op_TSX(self, e, pc, opcode, mode, value):
+        self._transfer(e, 'sp', 'x')
+
+    def _op_TXS(self, e, pc, opcode, mode, value):
+        self._transfer(e, 'x', 'sp', flags=False)
+
+    def _op_CLC(self, e, pc, opcode, mode, value):
+        e.line('p &= %d' % ~e.C)
+
+    def _op_CLD(self, e, pc, opcode, mode, value):
+        e.line('p &= %d' % ~e.D)
+
+    def _op_CLI(self, e, pc, opcode, mode, value):
+        e.line('p &= %d' % ~e.I)
+
+    def _op_CLV(self, e, pc, opcode, mode, value):
+        e.line('p &= %d' % ~e.V)
+
+    def _op_SEC(self, e, pc, opcode, mode, value):
+        e.line('p |= %d' % e.C)
+
+    def _op_SED(self, e, pc, opcode, mode, value):
+        e.line('p |= %d' % e.D)
+
+    def _op_SEI(self, e, pc, opcode, mode, value):
+        e.line('p |= %d' % e.I)
+
+    def _op_NOP(self, e, pc, opcode, mode, value):
+        e.line('pass')
+
+    def _op_PHA(self, e, pc, opcode, mode, value):
+        e.push('a')
+
+    def _op_PHX(self, e, pc, opcode, mode, value):
+        e.push('x')
+
+    def _op_PHY(self, e, pc, opcode, mode, value):
+        e.push('y')
+
+    def _op_PHP(self, e, pc, opcode, mode, value):
+        e.push('p | %d' % (e.B | e.U))
+
+    def _op_PLA(self, e, pc, opcode, mode, value):
+        e.pop('a')
+        e.flags_nz('a')
+
+    def _op_PLX(self, e, pc, opcode, mode, value):
+        e.pop('x')
+        e.flags_nz('x')
+
+    def _op_PLY(self, e, pc, opcode, mode, value):
+        e.pop('y')
+        e.flags_nz('y')
+
+    def _op_PLP(self, e, pc, opcode, mode, value):
+        e.pop('p')
+        e.line('p |= %d' % (e.B | e.U))
+
+    # Control flow: these end the block
+
+    def _op_branch(self, e, pc, opcode, name, value):
+        flag, taken_when_set = self._branches[name]
+        flag = getattr(self._mpu, flag)
+        not_taken, taken, extra = e.branch_targets(pc, value)
+        e.cycles(opcode)
+        if taken_when_set:
+            e.line('if not p & %d:' % flag)
+        else:
+            e.line('if p & %d:' % flag)
+        e.indent()
+        e.exit(not_taken)
+        e.dedent()
+        e.line('cyc += %d' % extra)
+        e.exit(taken)
+
+    def _op_BRA(self, e, pc, opcode, mode, value):
+        not_taken, taken, extra = e.branch_targets(pc, value)
+        e.cycles(opcode)
+        e.line('cyc += %d' % extra)
+        e.exit(taken)
+
+    def _op_JMP(self, e, pc, opcode, mode, value):
+        e.cycles(opcode)
+        e.exit(value & e.AM)
+
+    def _op_JSR(self, e, pc, opcode, mode, value):
+        operand = (pc + 1) & e.AM
+        ret = (operand + 1) & e.AM
+        e.push(str((ret >> e.BW) & e.BM))
+        e.push(str(ret & e.BM))
+        e.cycles(opcode)
+        e.exit(value & e.AM)
+
+    def _op_RTS(self, e, pc, opcode, mode, value):
+        e.pop('lo')
+        e.pop('hi')
+        e.cycles(opcode)
+        e.exit('(lo + (hi << %d) + 1) & %d' % (e.BW, e.AM))
+
+
+class _Emitter:
+    """Accumulate the Python source of one block.
+    """
+
+    def __init__(self, mpu):
+        self._mpu = mpu
+        self._lines = []
+        self._indent = 1
+        self._handlers = {}
+        self._static = 0    # cycles of the instructions emitted so far
+        self._count = 0     # instructions emitted so far
+        self._pending = 0   # cycles of the current instruction, once known
+        self._stored = False
+
+        self.N = mpu.NEGATIVE
+        self.V = mpu.OVERFLOW
+        self.B = mpu.BREAK
+        self.U = mpu.UNUSED
+        self.D = mpu.DECIMAL
+        self.I = mpu.INTERRUPT
+        self.Z = mpu.ZERO
+        self.C = mpu.CARRY
+        self.BM = mpu.byteMask
+        self.AM = mpu.addrMask
+        self.HM = mpu.addrHighMask
+        self.BW = mpu.BYTE_WIDTH
+        self.SB = mpu.spBase
+
+    # source
+
+    def line(self, text):
+        self._lines.append('    ' * self._indent + text)
+
+    def indent(self):
+        self._indent += 1
+
+    def dedent(self):
+        self._indent -= 1
+
+    def compile(self, start, dirty):
+        source = ['def block(self):',
+                  '    memory = self.memory',
+                  '    a = self.a; x = self.x; y = self.y',
+                  '    p = self.p; sp = self.sp',
+                  '    cyc = 0']
+        source.extend(self._lines)
+        source = '\n'.join(source) + '\n'
+        namespace = {'dirty': dirty}
+        namespace.update(self._handlers)
+        code = compile(source, '<block $%x>' % start, 'exec')
+        exec(code, namespace)
+        return namespace['block'], source
+
+    # flags
+
+    def nz(self, register):
+        return 'p = (p & %d) | ((%s & %d) if %s else %d)' % (
+            ~(self.Z | self.N), register, self.N, register, self.Z)
+
+    def flags_nz(self, register):
+        self.line(self.nz(register))
+
+    # operands
+
+    def address(self, pc, opcode, mode, value):
+        """ Return an expression for the effective address, emitting any
+        lines needed to compute it.  Page crossing cycles are added when
+        the opcode is marked for them, as the addressing helpers do.
+        """
+        extra = self._mpu.extracycles[opcode]
+        if mode in ('zpg', 'abs'):
+            return str(value)
+        if mode == 'zpx':
+            return '%d & (x + %d)' % (self.BM, value)
+        if mode == 'zpy':
+            return '%d & (y + %d)' % (self.BM, value)
+        if mode in ('abx', 'aby'):
+            register = mode[-1]
+            self.line('ea = (%d + %s) & %d' % (value, register, self.AM))
+            if extra:
+                self.line('if (ea & %d) != %d:' % (self.HM, value & self.HM))
+                self.line('    cyc += 1')
+            return 'ea'
+        if mode == 'inx':
+            self.line('ea = %d & (%d + x)' % (self.BM, value))
+            self.line('ea = memory[ea] + '
+                      '(memory[(ea & %d) + ((ea + 1) & %d)] << %d)' %
+                      (self.HM, self.BM, self.BW))
+            return 'ea'
+        if mode == 'iny':
+            wrap = (value & self.HM) + ((value + 1) & self.BM)
+            self.line('ea = memory[%d] + (memory[%d] << %d)' %
+                      (value, wrap, self.BW))
+            if extra:
+                self.line('ea2 = (ea + y) & %d' % self.AM)
+                self.line('if (ea & %d) != (ea2 & %d):' % (self.HM, self.HM))
+                self.line('    cyc += 1')
+                self.line('ea = ea2')
+            else:
+                self.line('ea = (ea + y) & %d' % self.AM)
+            return 'ea'
+        if mode == 'zpi':
+            value &= 255
+            self.line('ea = memory[%d] + (memory[%d] << %d)' %
+                      (value, value + 1, self.BW))
+            return 'ea'
+        raise ValueError(mode)
+
+    def read(self, pc, opcode, mode, value):
+        if mode == 'imm':
+            return str(value)
+        return 'memory[%s]' % self.address(pc, opcode, mode, value)
+
+    def write(self, address, value):
+        self.line('memory[%s] = %s' % (address, value))
+        self._stored = True
+
+    def push(self, value):
+        self.line('memory[sp + %d] = (%s) & %d' % (self.SB, value, self.BM))
+        self.line('sp = (sp - 1) & %d' % self.BM)
+        self._stored = True
+
+    def pop(self, register):
+        self.line('sp = (sp + 1) & %d' % self.BM)
+        self.line('%s = memory[sp + %d]' % (register, self.SB))
+
+    def branch_targets(self, pc, value):
+        """ Return (not taken PC, taken PC, extra cycles when taken)
+        computed the way BranchRelAddr does.
+        """
+        after = ((pc + 1) & self.AM) + 1
+        if value & self.N:
+            target = after - (value ^ self.BM) - 1
+        else:
+            target = after + value
+        extra = 1
+        if (after & self.HM) != (target & self.HM):
+            extra += 1
+        return after & self.AM, target & self.AM, extra
+
+    # bookkeeping
+
+    def cycles(self, opcode):
+        self._pending = self._mpu.cycletime[opcode]
+
+    def advance(self, pc, opcode, length):
+        """ Close the instruction at pc.  If it stored to memory and that
+        store hit translated code, leave the block before the next one.
+        """
+        self._static += self._mpu.cycletime[opcode]
+        self._count += 1
+        if self._stored:
+            self._stored = False
+            self.line('if dirty[0]:')
+            self.indent()
+            self.finish((pc + length) & self.AM)
+            self.dedent()
+
+    def exit(self, pc):
+        """ Emit a block exit at the end of the current instruction.
+        """
+        self._write_back()
+        self.line('self.pc = %s' % pc)
+        self.line('self.processorCycles += %d + cyc' %
+                  (self._static + self._pending))
+        self.line('return %d' % (self._count + 1))
+
+    def finish(self, pc):
+        """ Emit a block exit after the instructions closed so far.
+        """
+        self._write_back()
+        self.line('self.pc = %d' % pc)
+        self.line('self.processorCycles += %d + cyc' % self._static)
+        self.line('return %d' % self._count)
+
+    def _write_back(self):
+        self.line('self.a = a; self.x = x; self.y = y')
+        self.line('self.p = p; self.sp = sp')
+
+    def decimal_fallback(self, pc, opcode):
+        """ Emit the MPU's own handler for decimal mode, and open the
+        binary mode branch for the inline code that follows.
+        """
+        name = self._handler(opcode)
+        self.line('if p & %d:' % self.D)
+        self.indent()
+        self._write_back()
+        self.line('self.pc = %d' % ((pc + 1) & self.AM))
+        self.line('self.excycles = 0')
+        self.line('self.addcycles = %d' % self._mpu.extracycles[opcode])
+        self.line('%s(self)' % name)
+        self.line('a = self.a; p = self.p')
+        self.line('cyc += self.excycles')
+        self.dedent()
+        self.line('else:')
+        self.indent()
+
+    def fallback(self, pc, opcode):
+        """ Emit a call to the MPU's own handler and end the block.
+        """
+        name = self._handler(opcode)
+        self._write_back()
+        self.line('self.pc = %d' % ((pc + 1) & self.AM))
+        self.line('self.excycles = 0')
+        self.line('self.addcycles = %d' % self._mpu.extracycles[opcode])
+        self.line('%s(self)' % name)
+        self.line('self.pc &= %d' % self.AM)
+        self.line('self.processorCycles += %d + cyc + self.excycles' %
+                  (self._static + self._mpu.cycletime[opcode]))
+        self.line('return %d' % (self._count + 1))
+
+    def _handler(self, opcode):
+        name = 'handler_%02x' % opcode
+        self._handlers[name] = self._mpu.instruct[opcode]
+        return name
@@ -0,0 +1,185 @@
+from array import array
+
+# Precomputed 8-bit ADC and SBC results.  Each table covers one carry-in
+# and decimal flag setting and is indexed by (A << 8) | operand.  Entries
+# hold the result in the low byte and the C, Z, V and N flag bits, in
+# their usual 6502 positions, in the high byte.  Tables are built on
+# first use and shared by every MPU.
+#
+# The 6502 sets the flags of a decimal ADC from the unadjusted binary
+# result; the M65C02A sets them from the decimally adjusted one.  Binary
+# mode is the same for both.
+
+CARRY = 1
+ZERO = 2
+OVERFLOW = 64
+NEGATIVE = 128
+
+_tables = {}
+
+
+def adc_table(carry, decimal, variant='6502'):
+    """ Return the ADC table for the given carry-in and decimal flags.
+    """
+    if not decimal:
+        variant = None
+    return _table('adc', bool(carry), bool(decimal), variant)
+
+
+def sbc_table(carry, decimal, variant='6502'):
+    """ Return the SBC table for the given carry-in and decimal flags.
+    """
+    if not decimal:
+        variant = None
+    return _table('sbc', bool(carry), bool(decimal), variant)
+
+
+def _table(operation, carry, decimal, variant):
+    key = (operation, carry, decimal, variant)
+    table = _tables.get(key)
+    if table is None:
+        if decimal:
+            function = _builders[operation, variant]
+        else:
+            function = _builders[operation, None]
+        table = array('H', [function(a, b, carry)
+                            for a in range(256) for b in range(256)])
+        _tables[key] = table
+    return table
+
+
+def _entry(result, flags):
+    if result == 0:
+        flags |= ZERO
+    return result | ((flags | (result & NEGATIVE)) << 8)
+
+
+def _adc_binary(a, b, carry):
+    result = a + b + carry
+    flags = 0
+    if (~(a ^ b) & (a ^ result)) & NEGATIVE:
+        flags |= OVERFLOW
+    if result > 0xff:
+        flags |= CARRY
+    return _entry(result & 0xff, flags)
+
+
+def _sbc_binary(a, b, carry):
+    result = a + (~b & 0xff) + carry
+    flags = 0
+    if ((a ^ b) & (a ^ result)) & NEGATIVE:
+        flags |= OVERFLOW
+    if result > 0xff:
+        flags |= CARRY
+    return _entry(result & 0xff, flags)
+
+
+def _adc_decimal_6502(a, b, carry):
+    halfcarry = 0
+    adjust0 = 0
+    adjust1 = 0
+    flags = 0
+    nibble0 = (b & 0xf) + (a & 0xf) + carry
+    if nibble0 > 9:
+        adjust0 = 6
+        halfcarry = 1
+    nibble1 = ((b >> 4) & 0xf) + ((a >> 4) & 0xf) + halfcarry
+    if nibble1 > 9:
+        adjust1 = 6
+        flags |= CARRY
+
+    # the flags come from the unadjusted ALU output
+    nibble0 = nibble0 & 0xf
+    nibble1 = nibble1 & 0xf
+    aluresult = (nibble1 << 4) + nibble0
+    if aluresult == 0:
+        flags |= ZERO
+    else:
+        flags |= aluresult & NEGATIVE
+    if (~(a ^ b) & (a ^ aluresult)) & NEGATIVE:
+        flags |= OVERFLOW
+
+    result = (((nibble1 + adjust1) & 0xf) << 4) + ((nibble0 + adjust0) & 0xf)
+    return result | (flags << 8)
+
+
+def _sbc_decimal_6502(a, b, carry):
+    halfcarry = 1
+    adjust0 = 0
+    adjust1 = 0
+    flags = 0
+    nibble0 = (a & 0xf) + (~b & 0xf) + carry
+    if nibble0 <= 0xf:
+        halfcarry = 0
+        adjust0 = 10
+    nibble1 = ((a >> 4) & 0xf) + ((~b >> 4) & 0xf) + halfcarry
+    if nibble1 <= 0xf:
+        adjust1 = 10 << 4
+
+    # the flags come from the unadjusted ALU output
+    aluresult = a + (~b & 0xff) + carry
+    if aluresult > 0xff:
+        flags |= CARRY
+    aluresult &= 0xff
+    if aluresult == 0:
+        flags |= ZERO
+    else:
+        flags |= aluresult & NEGATIVE
+    if ((a ^ b) & (a ^ aluresult)) & NEGATIVE:
+        flags |= OVERFLOW
+
+    nibble0 = (aluresult + adjust0) & 0xf
+    nibble1 = ((aluresult + adjust1) >> 4) & 0xf
+    return ((nibble1 << 4) + nibble0) | (flags << 8)
+
+
+def _adc_decimal_m65c02a(a, b, carry):
+    cy3 = 0
+    da0 = 0
+    da1 = 0
+    flags = 0
+    loSum = (a & 0xf) + (b & 0xf) + carry
+    if loSum > 9:
+        da0 = 6
+        cy3 = 1
+    hiSum = ((a >> 4) & 0xf) + ((b >> 4) & 0xf) + cy3
+    if hiSum > 9:
+        da1 = 6
+        flags |= CARRY
+
+    # the flags come from the decimally adjusted result
+    result = (((hiSum + da1) & 0xf) << 4) + ((loSum + da0) & 0xf)
+    if (~(a ^ b) & (a ^ result)) & NEGATIVE:
+        flags |= OVERFLOW
+    return _entry(result, flags)
+
+
+def _sbc_decimal_m65c02a(a, b, carry):
+    b = ~b & 0xff
+    cy3 = 1
+    da0 = 0
+    da1 = 0
+    flags = 0
+    loSum = (a & 0xf) + (b & 0xf) + carry
+    if loSum <= 15:
+        cy3 = 0
+        da0 = 10
+    hiSum = ((a >> 4) & 0xf) + ((b >> 4) & 0xf) + cy3
+    if hiSum <= 15:
+        da1 = 10
+    else:
+        flags |= CARRY
+
+    # the flags come from the decimally adjusted result
+    result = (((hiSum + da1) & 0xf) << 4) + ((loSum + da0) & 0xf)
+    if (~(a ^ b) & (a ^ result)) & NEGATIVE:
+        flags |= OVERFLOW
+    return _entry(result, flags)
+
+
+_builders = {('adc', None): _adc_binary,
+             ('sbc', None): _sbc_binary,
+             ('adc', '6502'): _adc_decimal_6502,
+             ('sbc', '6502'): _sbc_decimal_6502,
+             ('adc', 'M65C02A'): _adc_decimal_m65c02a,
+             ('sbc', 'M65C02A'): _sbc_decimal_m65c02a}
@@ -11,3 +11,23 @@ def make_instruction_decorator(instruct, disasm, allcycles, allextras):
             return f  # Return the original function
         return decorate
     return instruction
+
+
+_variants = {}
+
+
+def make_variant_class(klass, mixins):
+    """ Return a subclass of klass with the methods of the mixins, in
+    order, in front of its own, made once and then cached; klass itself
+    if there are no mixins.  None of them add slots, so an MPU can be
+    switched between klass and its variants by assigning to __class__.
+    """
+    if not mixins:
+        return klass
+    variant = _variants.get((klass, mixins))
+    if variant is None:
+        variant = type(klass.__name__, mixins + (klass,),
+                       {'__slots__': (), '__module__': klass.__module__,
+                        'base_class': klass})
+        _variants[klass, mixins] = variant
+    return variant
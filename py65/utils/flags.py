@@ -0,0 +1,38 @@
+# Precomputed processor status flag tables.  They are built on first use
+# and shared by every MPU with the same flag layout.
+
+_tables = {}
+
+
+def nz_table(width, negative, zero):
+    """ Return a tuple, indexed by a value of the given width, holding the
+    N and Z flag bits that value produces.  negative is the N bit of the
+    status register; it is set when the top bit of the value is set.
+    """
+    key = ('nz', width, negative, zero)
+    table = _tables.get(key)
+    if table is None:
+        sign = 1 << (width - 1)
+        table = tuple([(negative if value & sign else 0)
+                       for value in range(1 << width)])
+        table = (zero,) + table[1:]
+        _tables[key] = table
+    return table
+
+
+def compare_table(width, negative, zero, carry):
+    """ Return a tuple, indexed by (register << width) | operand, holding
+    the N, Z and C flag bits of the comparison.  Only practical for 8-bit
+    operands.
+    """
+    key = ('cmp', width, negative, zero, carry)
+    table = _tables.get(key)
+    if table is None:
+        mask = (1 << width) - 1
+        nz = nz_table(width, negative, zero)
+        table = tuple([nz[(register - operand) & mask] |
+                       (carry if register >= operand else 0)
+                       for register in range(1 << width)
+                       for operand in range(1 << width)])
+        _tables[key] = table
+    return table
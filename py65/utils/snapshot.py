@@ -0,0 +1,252 @@
+import json
+import mmap
+import struct
+import sys
+import zlib
+
+from array import array
+
+from memory import ObservableMemory
+
+# Machine snapshots.  A snapshot holds a copy of every register an MPU
+# keeps in its instance (its __slots__, or its __dict__ for unslotted
+# classes), which covers the prefix flags and cycle counters of the
+# M65C02A as well as the 6502 registers, and a copy of memory packed
+# into bytes (an array for the 16-bit bytes of the 65Org16).  Caches
+# that belong to the memory rather than the machine state, bus traces
+# and profiles are never captured.
+
+_transient = frozenset(('memory', '_decoded', '_translator', '_busTrace',
+                        '_opcode_profile', '_opcodeProfile',
+                        '_address_profile', '_addressProfile',
+                        '_call_profile', '_callProfile'))
+
+
+class Snapshot:
+    def __init__(self, registers, memory):
+        self.registers = registers  # name -> value
+        self.memory = memory        # bytes or array, a list for odd values
+
+
+def register_names(mpu):
+    names = []
+    for klass in type(mpu).__mro__:
+        for name in getattr(klass, '__slots__', ()):
+            if name not in _transient and name not in names:
+                names.append(name)
+    for name in getattr(mpu, '__dict__', ()):
+        if name not in _transient and name not in names:
+            names.append(name)
+    return names
+
+
+def _copy(value):
+    if isinstance(value, list):
+        return value[:]
+    if isinstance(value, array):
+        return array(value.typecode, value)
+    if isinstance(value, dict):
+        return value.copy()
+    return value
+
+
+def _cells(memory):
+    if isinstance(memory, ObservableMemory):
+        return memory.subject
+    return memory
+
+
+def take_snapshot(mpu):
+    """ Return a Snapshot of the registers and memory of an MPU.
+    """
+    registers = {}
+    for name in register_names(mpu):
+        if hasattr(mpu, name):
+            registers[name] = _copy(getattr(mpu, name))
+
+    cells = _cells(mpu.memory)
+    try:
+        if mpu.BYTE_WIDTH <= 8:
+            # bytearray() packs a list of ints fastest
+            memory = bytes(bytearray(cells))
+        elif mpu.BYTE_WIDTH <= 16:
+            memory = array('H', cells)
+        else:
+            memory = array('L', cells)
+    except (OverflowError, TypeError, ValueError):
+        memory = list(cells)
+    return Snapshot(registers, memory)
+
+
+def restore_snapshot(mpu, snapshot):
+    """ Put an MPU back into the state held by a snapshot.  Memory is
+    overwritten in place, so ObservableMemory subscriptions are kept.
+    """
+    for name, value in snapshot.registers.items():
+        setattr(mpu, name, _copy(value))
+
+    memory = snapshot.memory
+    if isinstance(memory, array):
+        memory = memory.tolist()
+    elif isinstance(memory, bytes):
+        memory = list(memory)
+    cells = _cells(mpu.memory)
+    cells[:len(memory)] = memory
+
+
+def clone_mpu(mpu):
+    """ Return an independent MPU of the same class in the same state.
+    Its memory is a copy; an ObservableMemory keeps the subscribers of
+    the original, other than those that belong to the original MPU.
+    """
+    klass = type(mpu)
+    twin = klass.__new__(klass)
+    for name in register_names(mpu):
+        if hasattr(mpu, name):
+            setattr(twin, name, _copy(getattr(mpu, name)))
+
+    memory = mpu.memory
+    if isinstance(memory, ObservableMemory):
+        owners = [mpu, getattr(mpu, '_translator', None)]
+        twin.memory = memory.copy(owners=[o for o in owners if o is not None])
+    else:
+        twin.memory = memory[:]
+    return twin
+
+
+# State files.  A state file holds a snapshot on disk:
+#
+#   magic       8 bytes, STATE_MAGIC
+#   length      little-endian 32-bit length of the header
+#   header      JSON: the MPU name, its registers and counters, and the
+#               offset, cell count, cell size and encoding of memory
+#   padding     zeros up to a page boundary
+#   memory      the memory cells, little-endian, raw or zlib compressed
+#
+# Raw memory is page aligned so that it can be mapped rather than read
+# and parsed.  Registers that are rebuilt by the constructor, such as
+# the flag tables, and values that cannot be written, such as the trace
+# file, are left out.
+
+STATE_MAGIC = b'py65stat'
+STATE_PAGE = mmap.ALLOCATIONGRANULARITY
+
+
+def _encode(value):
+    if isinstance(value, array):
+        return {'typecode': value.typecode, 'values': value.tolist()}
+    return value
+
+
+def _decode(value):
+    if isinstance(value, dict):
+        return array(str(value['typecode']), value['values'])
+    return value
+
+
+def _savable(value):
+    if isinstance(value, (bool, int, str, array)):
+        return True
+    if isinstance(value, list):
+        return all([isinstance(item, int) for item in value])
+    return False
+
+
+def write_state_file(mpu, path, compress=False):
+    """ Save the registers, counters and memory of an MPU to a file.
+    """
+    cells = _cells(mpu.memory)
+    if mpu.BYTE_WIDTH <= 8:
+        typecode = 'B'
+    else:
+        typecode = 'H'
+    memory = array(typecode, [cell & mpu.byteMask for cell in cells])
+    if sys.byteorder != 'little':
+        memory.byteswap()
+    memory = memory.tobytes()
+    if compress:
+        memory = zlib.compress(memory)
+
+    registers = {}
+    for name in register_names(mpu):
+        value = getattr(mpu, name, None)
+        if _savable(value):
+            registers[name] = _encode(value)
+
+    header = {'name': mpu.name,
+              'registers': registers,
+              'cells': len(cells),
+              'typecode': typecode,
+              'compressed': bool(compress),
+              'size': len(memory)}
+    # the offset depends on the header length, which depends on the offset
+    offset = STATE_PAGE
+    while True:
+        header['offset'] = offset
+        encoded = json.dumps(header, sort_keys=True).encode('utf-8')
+        start = len(STATE_MAGIC) + 4 + len(encoded)
+        if start <= offset:
+            break
+        offset += STATE_PAGE
+
+    f = open(path, 'wb')
+    try:
+        f.write(STATE_MAGIC)
+        f.write(struct.pack('<I', len(encoded)))
+        f.write(encoded)
+        f.write(b'\0' * (offset - start))
+        f.write(memory)
+    finally:
+        f.close()
+
+
+def read_state_header(path):
+    """ Return the header of a state file as a dictionary.
+    """
+    f = open(path, 'rb')
+    try:
+        if f.read(len(STATE_MAGIC)) != STATE_MAGIC:
+            raise ValueError("%s is not a state file" % path)
+        length, = struct.unpack('<I', f.read(4))
+        return json.loads(f.read(length).decode('utf-8'))
+    finally:
+        f.close()
+
+
+def read_state_file(mpu, path):
+    """ Return the Snapshot held by a state file, which must have been
+    saved from the same kind of MPU.  Raw memory is mapped rather than
+    read.
+    """
+    header = read_state_header(path)
+    if header['name'] != mpu.name:
+        raise ValueError("%s holds a %s, not a %s" % (path, header['name'],
+                                                      mpu.name))
+    typecode = str(header['typecode'])
+    f = open(path, 'rb')
+    try:
+        if header['compressed']:
+            f.seek(header['offset'])
+            memory = array(typecode, zlib.decompress(f.read(header['size'])))
+        else:
+            mapped = mmap.mmap(f.fileno(), header['size'],
+                               access=mmap.ACCESS_READ,
+                               offset=header['offset'])
+            try:
+                if sys.byteorder == 'little':
+                    view = memoryview(mapped)
+                    memory = view.cast(typecode).tolist()
+                    view.release()
+                else:
+                    memory = array(typecode, mapped[:])
+            finally:
+                mapped.close()
+    finally:
+        f.close()
+    if isinstance(memory, array) and sys.byteorder != 'little':
+        memory.byteswap()
+
+    registers = {}
+    for name, value in header['registers'].items():
+        registers[str(name)] = _decode(value)
+    return Snapshot(registers, memory)
@@ -55,7 +55,7 @@ setup(
     maintainer_email="mike@naberezny.com",
     packages=find_packages(),
     install_requires=[],
-    extras_require={},
+    extras_require={'batch': ['numpy']},
     tests_require=[],
     include_package_data=True,
     zip_safe=False,
@@ -64,6 +64,7 @@ setup(
     entry_points={
         'console_scripts': [
             'py65mon = py65.monitor:main',
+            'py65bustrace = py65.bustrace:main',
         ],
     },
 )